@@ -1,16 +1,50 @@
 from PyQt5 import QtCore
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+import json
+import multiprocessing
 import os
 import platform
 import shlex
-from subprocess import Popen
-import signal
+import sys
+from subprocess import PIPE, DEVNULL
 import re
-import tempfile
+import queue
+from threading import Thread, Event
 from time import time as epoch_time
-import psutil
-from operator import itemgetter
+import subprocess
+import objcache
+import tracing
+from dirindex import DirIndex
+from limits import RunLimits, run_limited
+from matpool import InterpreterPool
+from supervisor import ProcessSupervisor
 # TODO: import PyQt5 if needed: if importlib.util.find_spec("PyQt5") != None:
 
+# Generated Makefiles compile through this script if cache_dir is set
+OBJCACHE_SCRIPT = os.path.abspath(objcache.__file__)
+RUN_RECORD = ".run_metrics.json"  # resources used by the last run, see limits
+# sources, dependencies, flags and target of a generated Makefile
+BUILD_MANIFEST = ".build_manifest.json"
+PY_MAIN_RE = re.compile(r"""^if\s+__name__\s*==\s*['"]__main__['"]""",
+                        re.MULTILINE)
+
+
+def read_manifest(makefile_path):
+    """ Build manifest written with a generated Makefile, None if there is
+    none (not generated or a Makefile of the student)."""
+    try:
+        with open(os.path.join(makefile_path, BUILD_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _span_attrs(comp):
+    """ Attributes of the spans of a compiler, see tracing """
+    return {"student": os.path.basename(comp.root or "")}
+
+
 class CCompiler(QtCore.QThread):
     """ This class receives a root folder. It iterates recursively inside
     folders and tries to check if C++ code exists. If C++ code exists and
@@ -21,16 +55,39 @@ class CCompiler(QtCore.QThread):
         v0.0: #inlucde"myfile.h" no space before, " right after include.
         v0.1: #include "myfile.h" now also works.
         v0.3: cross platform capabilities: added nmake support in windows
+        v0.4: questions are built in parallel in linux, sharing the cores
+        v0.5: object files can be shared between students through objcache
+        v0.6: compiler output is logged while compiling, no temp files
+        v0.7: programs run with resource limits in linux, usage is recorded
+        v0.8: start() builds in the thread with progress, cancel() stops it
+        v0.9: precompiled header and provided objects shared, see prebuilt
+        v1.0: incremental builds, Makefiles are only written if they change
         """
     # Defining triggers
     log_trigger = QtCore.pyqtSignal(str)
+    progress_trigger = QtCore.pyqtSignal(str, str)  # question, status
 
-    def __init__(self, root):
+    def __init__(self, root, index=None):
         QtCore.QThread.__init__(self)
         self._root = root  # root folder
+        self._index = index  # DirIndex of root, built if None
         self.inc_pat = re.compile(r'^ *#include *"(\w+\.h(?:pp)?)"')
         self.makefiles_path = []  # stores their path to make later
-        self._processes = []   # Will hold all the subprocesses
+        self.build_results = []  # result of each makefile_path after compile
+        self.jobs = os.cpu_count() or 1  # max. compilers running at once
+        self.log_interval = 0.1  # s, compiler output is logged in batches
+        self.cache_dir = None  # object cache of the generated Makefiles
+        self.cache_size = 1 << 30  # bytes, old objects are deleted after that
+        self.prebuilt = None  # Prebuilt used by the generated Makefiles
+        self.clean_build = False  # make clean before make, else incremental
+        self._stale = set()  # makefiles_path with objects of other flags
+        # limits of exec, no wall time since the user types the input
+        self.limits = RunLimits(wall=None)
+        # Owns the makes and the terminals, the GUI shares its own
+        self.supervisor = ProcessSupervisor()
+        self._build_group = "c++ build"  # groups of the supervisor
+        self._window_group = "c++ terminal"
+        self._cancel = Event()  # set by cancel(), cleared by change_root
         self._arch = platform.machine()  # x86_64 or i386
         self._env = os.environ.copy()  # environment variables are returned in
         self._plat = platform.system()  # Linux or Windows
@@ -45,101 +102,261 @@ class CCompiler(QtCore.QThread):
             self.make_cmd = shlex.split("make")
             self.make_clean_cmd = shlex.split("make clean")
 
-    def change_root(self, root):
+    def change_root(self, root, index=None):
         """ It is not needed to destroy the object and create another one. By
-        calling this method root is changed while configurations are reused."""
+        calling this method root is changed while configurations are reused.
+        index is the DirIndex of root, if it is already available."""
         self._root = root
+        self._index = index
         self.makefiles_path.clear()  # reset the previous makefiles
+        self._stale.clear()
+        self._cancel.clear()
         self.kill_windows()   # closes all open windows
 
+    def run(self):
+        """ Runs in the thread after start(): the makefiles are generated and
+        compiled. cancel() stops it, the running makes are killed."""
+        self.log_trigger.emit("Generating Makefile if needed ...")
+        self.generate_makefiles()
+        if not self._cancel.is_set():
+            self.log_trigger.emit("\nCompiling the Questions, Wait ...")
+            self.compile()
+
+    def cancel(self):
+        """ Kills the process groups of the running makes (and compilers),
+        the questions not started yet are skipped. Can be called from any
+        thread."""
+        self._cancel.set()
+        self.supervisor.kill_group(self._build_group, timeout=0)
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def root(self):
+        return self._root
+
     def kill_windows(self):
         """ In this function all the open windows including the pdf viewer,
         editor and terminals should be closed."""
-        if self.is_linux:
-            for p in self._processes:
-                os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-            self._processes.clear()
-        elif self.is_windows:  # TODO: Add support for windows
-            pass
+        self.supervisor.kill_group(self._window_group)
 
+    @tracing.traced("CCompiler.generate_makefiles", _span_attrs, "c++")
     def generate_makefiles(self):
         """ It will check the folder if proper C++ code exists and a make file is
-        needed to be generated. output is logged."""
-        for dir_path, dir_names, file_names in os.walk(self._root):
+        needed to be generated. output is logged. The folders are taken from
+        the DirIndex, the file system is only scanned if there is none."""
+        if self._index is None:
+            self._index = DirIndex.build(self._root)
+        if self.is_linux and self.prebuilt is not None:  # once per homework
+            for message in self.prebuilt.prepare(self.inc_pat):
+                self.log_trigger.emit(message)
+        # questions are always in the same order, DirIndex is sorted
+        for node, parent in self._index.walk():
+            dir_path = node.path
             # There might be a src directory inside the folder, and possibly
             # some c++ sources would be there, so check for this.
-            if os.path.isdir(os.path.join(dir_path, "src")):  # if src dir?
+            if node.src is not None:  # if src dir?
                 # Now we should check if any cpp exists in src dir
-                files = [f.lower() for f in
-                         os.listdir(os.path.join(dir_path, "src"))]
-                if sum([f.endswith(".cpp") for f in files]) > 0:  # > 1 cpp
-                    self._write_makefile(dir_path)
+                if len(node.src.with_ext(".cpp")) > 0:  # > 1 cpp
+                    self._write_makefile(node)
                     self.makefiles_path.append(dir_path)
 
             # if the top level directory is named src skip it, because there
             # should be a makefile in top level directory (look at previous if)
-            elif os.path.basename(dir_path).lower() == "src":
-                # Check if cpp exists in this directory, i.e., file_names
-                if sum([f.lower().endswith(".cpp") for f in file_names]) > 0:
-                    # Now there should be a makefile in toplevel directory
-                    top_dir = os.path.dirname(dir_path)
-                    top_dir_files = [f.lower() for f in os.listdir(top_dir)]
-                    assert "makefile" in top_dir_files
+            elif node.name.lower() == "src":
+                # Check if cpp exists in this directory
+                if len(node.with_ext(".cpp")) > 0 and parent is not None:
+                    # Now there should be a makefile in toplevel directory,
+                    # written by the user or generated just before
+                    assert (parent.has_makefile or
+                            parent.path in self.makefiles_path)
 
             # Then we should check if a makefile already created by user
-            # Here we convert all files to lower case
-            elif "makefile" in [f.lower() for f in file_names]:
+            elif node.has_makefile and self.own_manifest(dir_path) is None:
                 self.makefiles_path.append(dir_path)
 
             # Now check if at least 1 cpp file exists, if yes create
-            elif sum([f.lower().endswith(".cpp") for f in file_names]) > 0:
-                    self._write_makefile(dir_path)
+            elif len(node.with_ext(".cpp")) > 0:
+                    self._write_makefile(node)
                     self.makefiles_path.append(dir_path)
 
+    @staticmethod
+    def own_manifest(makefile_path):
+        """ Build manifest of makefile_path if its Makefile was written by
+        _write_makefile and not changed after that, else None """
+        manifest = read_manifest(makefile_path)
+        try:
+            if manifest is not None and manifest["makefile"] == os.stat(
+                    os.path.join(makefile_path, "Makefile")).st_mtime_ns:
+                return manifest
+        except (OSError, KeyError):
+            pass
+        return None
+
+    def _needs_clean(self, makefile_path):
+        return self.clean_build or makefile_path in self._stale
+
+    @tracing.traced("CCompiler.compile", _span_attrs, "c++")
     def compile(self):
         """ This method will compile the code using C++ makefiles """
+        self.build_results = []
         if len(self.makefiles_path) == 0:
             self.log_trigger.emit("No Makefile to compile.")
             return
+        if self.is_linux:
+            self._compile_parallel()
+            return
         windows_cmd = ""  # Holds the final command to execute for windows
         for makefile_path in self.makefiles_path:
-            # Creating two temporary files for stdout and stderr
-            out_fd, out_path = tempfile.mkstemp()
-            err_fd, err_path = tempfile.mkstemp()
-            with os.fdopen(out_fd, 'w') as shell_out:
-                with os.fdopen(err_fd, 'w') as shell_err:
-                    cur_rel_dir = os.path.relpath(makefile_path, self._root)
-                    self.log_trigger.emit(cur_rel_dir + ":")
-                    if self.is_linux:
-                        p = Popen(self.make_clean_cmd, env=self._env,
-                                  cwd=makefile_path, shell=False,
-                                  stderr=shell_err, stdout=shell_out)
-                        p.wait()  # wait for make clean process to finish
-                        p = Popen(self.make_cmd, env=self._env, cwd=makefile_path,
-                                  shell=False, stderr=shell_err, stdout=shell_out)
-                        p.wait()  # wait for make to finish
-                    if self.is_windows:  # Generate command and execute later
-                        windows_cmd += "&& cd \"{}\" && nmake clean -nologo && nmake -nologo ".format(makefile_path)
-            self.log_trigger.emit(open(out_path, 'r').read())
-            self.log_trigger.emit(open(err_path, 'r').read())
-            os.remove(out_path)
-            os.remove(err_path)
+            cur_rel_dir = os.path.relpath(makefile_path, self._root)
+            self.log_trigger.emit(cur_rel_dir + ":")
+            # Generate command and execute later
+            windows_cmd += "&& cd \"{}\" ".format(makefile_path)
+            if self._needs_clean(makefile_path):
+                windows_cmd += "&& nmake clean -nologo "
+            windows_cmd += "&& nmake -nologo "
 
         if self.is_windows:  # here execute the command
             windows_cmd = "\"c:\\Program Files (x86)\\Microsoft Visual Studio 14.0\\VC\\bin\\vcvars32.bat\" " + windows_cmd
-            out_fd, out_path = tempfile.mkstemp()
-            err_fd, err_path = tempfile.mkstemp()
-            with os.fdopen(out_fd, 'w') as shell_out:
-                with os.fdopen(err_fd, 'w') as shell_err:
-                    p = Popen(shlex.split(windows_cmd), shell=True,
-                              stderr=shell_err, stdout=shell_out)
-                    p.wait()
-                    p.terminate()
-            self.log_trigger.emit(open(out_path, 'r').read())
-            self.log_trigger.emit(open(err_path, 'r').read())
-            os.remove(out_path)
-            os.remove(err_path)       
+            lines = queue.Queue()
+            thread = Thread(target=self._run_streamed,
+                            args=(shlex.split(windows_cmd), self._root, lines),
+                            kwargs={"shell": True})
+            thread.start()
+            self._log_streamed(lines, lambda: not thread.is_alive())
+
+    def _compile_parallel(self):
+        """ The questions are built at the same time. Each make gets an equal
+        share of self.jobs with -j, so that at most self.jobs compilers run at
+        once. The output is logged while make is running, the summary at the
+        end is in the order of makefiles_path."""
+        n_parallel = min(len(self.makefiles_path), self.jobs)
+        make_jobs = max(1, self.jobs // n_parallel)  # -j of each make
+        lines = queue.Queue()  # (makefile_path, line) of all the makes
+        with ThreadPoolExecutor(max_workers=n_parallel) as pool:
+            futures = [pool.submit(self._build, makefile_path, make_jobs,
+                                   lines)
+                       for makefile_path in self.makefiles_path]
+            self._log_streamed(lines, lambda: all(f.done() for f in futures))
+        results = [future.result() for future in futures]
+
+        self.build_results = results  # in the order of makefiles_path
+        out = "".join(result["out"] for result in self.build_results)
+        n_hit = out.count(objcache.HIT_MSG)
+        n_miss = out.count(objcache.MISS_MSG)
+        if n_hit + n_miss > 0:  # some generated Makefiles used the cache
+            self.log_trigger.emit("Object cache: {} hits, {} misses".format(
+                n_hit, n_miss))
+        self.log_trigger.emit("Summary:")
+        for result in self.build_results:
+            self.log_trigger.emit("{}: {} in {:.1f} s".format(
+                os.path.relpath(result["path"], self._root),
+                self.build_status(result), result["duration"]))
+
+    def build_status(self, result):
+        """ OK, Failed (returncode) or Cancelled, for one of build_results """
+        if self._cancel.is_set() and result["returncode"] != 0:
+            return "Cancelled"
+        elif result["returncode"] == 0:
+            return "OK"
+        return "Failed ({})".format(result["returncode"])
+
+    def _log_streamed(self, lines, finished):
+        """ Logs the lines put in the queue by _run_streamed until finished()
+        is True. The lines are collected for log_interval seconds and logged
+        in one message per folder, starting with the folder name. Items with
+        a status instead of a line are sent to progress_trigger."""
+        pending = dict()  # path -> lines not logged yet, in arrival order
+        last_log = epoch_time()
+        while True:
+            done = finished()  # checked before the queue is emptied
+            try:
+                self._add_line(pending, *lines.get(timeout=self.log_interval))
+            except queue.Empty:
+                pass
+            if epoch_time() - last_log >= self.log_interval or done:
+                while not lines.empty():  # take the rest without waiting
+                    self._add_line(pending, *lines.get_nowait())
+                for path, path_lines in pending.items():
+                    self.log_trigger.emit("{}:\n{}".format(
+                        os.path.relpath(path, self._root),
+                        "".join(path_lines).rstrip("\n")))
+                pending.clear()
+                last_log = epoch_time()
+            if done and lines.empty():
+                return
+
+    def _add_line(self, pending, path, line, status=None):
+        if status is not None:
+            self.progress_trigger.emit(os.path.relpath(path, self._root),
+                                       status)
+        else:
+            pending.setdefault(path, []).append(line)
+
+    def _build(self, makefile_path, make_jobs, lines):
+        """ Runs make in makefile_path, in a worker thread. make clean is
+        run before it if clean_build is set or the flags have changed."""
+        t = epoch_time()
+        if self._cancel.is_set():  # not started
+            lines.put((makefile_path, None, "Cancelled"))
+            return {"path": makefile_path, "returncode": None,
+                    "duration": 0.0, "out": "", "err": ""}
+        lines.put((makefile_path, None, "Building"))
+        attrs = {"student": os.path.basename(self._root),
+                 "question": os.path.relpath(makefile_path, self._root)}
+        out, err = "", ""
+        try:
+            if self._needs_clean(makefile_path):
+                with tracing.span("make clean", "c++", **attrs):
+                    _, out, err = self._run_streamed(self.make_clean_cmd,
+                                                     makefile_path, lines)
+            with tracing.span("make", "c++", jobs=make_jobs, **attrs) as span:
+                returncode, make_out, make_err = self._run_streamed(
+                    self.make_cmd + ["-j{}".format(make_jobs)], makefile_path,
+                    lines)
+                span.set(returncode=returncode)
+        except OSError as e:  # make is not found etc.
+            lines.put((makefile_path, "{}\n".format(e)))
+            returncode, out, err, make_out, make_err = -1, "", str(e), "", ""
+        result = {"path": makefile_path, "returncode": returncode,
+                  "duration": epoch_time() - t, "out": out + make_out,
+                  "err": err + make_err}
+        lines.put((makefile_path, None, self.build_status(result)))
+        return result
+
+    def _run_streamed(self, cmd, cwd, lines, shell=False):
+        """ Runs cmd, every line of stdout and stderr is put in lines as soon
+        as it is printed. Both pipes are read in their own threads, so none
+        of them blocks the other. Returns returncode, stdout and stderr. The
+        process gets its own group so that cancel() can kill its children."""
+        if self._cancel.is_set():
+            return None, "", ""
+        p = self.supervisor.spawn(cmd, self._build_group, env=self._env,
+                                  cwd=cwd, shell=shell, stdout=PIPE,
+                                  stderr=PIPE, universal_newlines=True,
+                                  errors='replace')
+        if self._cancel.is_set():  # cancel() may have missed it
+            self.cancel()
+        out, err = [], []
+
+        def read(pipe, store):
+            for line in pipe:
+                store.append(line)
+                lines.put((cwd, line))
+            pipe.close()
 
+        readers = [Thread(target=read, args=(p.stdout, out)),
+                   Thread(target=read, args=(p.stderr, err))]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        p.wait()
+        return p.returncode, "".join(out), "".join(err)
+
+    @tracing.traced("CCompiler.exec", _span_attrs, "c++")
     def exec(self):
         """ This method will execute the executable. It should understand what is
         the executable in different platforms. It also assumes that the
@@ -159,75 +376,87 @@ class CCompiler(QtCore.QThread):
                 target = target[0]
                 self.log_trigger.emit("Exec: {}".format(os.path.join(cur_rel_dir,
                                                                      target)))
-                cmd = "start /i cmd /c \"title {} ... & {} & pause\"".format(
+                cmd = "cmd /c \"title {} ... & {} & pause\"".format(
                     # e.g. BP-HW1-9523000/2/a in title of command prompt
                     os.path.join(os.path.dirname(self._root), cur_rel_dir),
                     target)
-                p = Popen(shlex.split(cmd), shell=True, cwd=makefile_path)
-                self._processes.append(p)
-                # TODO: Processes should be managed with psutil to kill properly
+                # its own window, owned by the supervisor to close it later
+                self.supervisor.spawn(
+                    cmd, self._window_group, cwd=makefile_path,
+                    creationflags=subprocess.CREATE_NEW_CONSOLE |
+                    subprocess.CREATE_NEW_PROCESS_GROUP)
 
         elif self.is_linux:
-            targets = []   # Holds all the target paths
-            for makefile_path in self.makefiles_path:
-                cur_rel_dir = os.path.relpath(makefile_path, self._root)
-                makefile_name = list(filter(lambda f: f.lower() == "makefile",
-                                            os.listdir(makefile_path)))[0]
-                makefile_lines = open(os.path.join(makefile_path, makefile_name),
-                                      'r').readlines()
-                target = list(filter(lambda l: l.strip().upper().startswith(
-                    "TARGET"), makefile_lines))
-                if len(target) != 1:
-                    self.log_trigger.emit("Could not find the target line")
-                    continue
-                target = target[0].split()[-1]  # the last part of the line
-                self.log_trigger.emit("Exec: {}".format(os.path.join(cur_rel_dir,
-                                                                     target)))
-                targets.append(os.path.join(makefile_path, target))  # full path
+            targets = self.find_targets()   # Holds all the target paths
+            for target in targets:
+                self.log_trigger.emit("Exec: {}".format(
+                    os.path.relpath(target, self._root)))
 
-            # Now executing the terminal
-            terminal_cmd = "gnome-terminal --disable-factory "
-            tab_cmd = "--tab --working-directory={} -e " +\
-                      """'bash -c "pwd;./{};exec bash" ' """
-            cmd = terminal_cmd  # This holds the final command to execute
+            # Now executing the terminal, each target runs with the limits
+            cmd = ["gnome-terminal", "--disable-factory"]
             for target in targets:
-                cmd += tab_cmd.format(os.path.dirname(target),
-                                      os.path.basename(target))
-            p = Popen(shlex.split(cmd), start_new_session=True)
-            self._processes.append(p)
-
-    def find_dep(self, cpp_h_file):
-        """ This function finds all the included headers recursively. First
-        time cpp is passed but 2nd, 3rd, etc headers are passed.
-        User defined header files should be: #include"myfile.h" and
-        the rest of the libraries like: #include<xxx> """
-        # First we try to know if cpp is passed or .h, since the dirs may differ
-        if cpp_h_file.endswith('.cpp'):  # Should we join src folder to its path?
-            if self.__root != self._src_dir:  # we have src folder here
-                cpp_h_file_path = os.path.join(self.__root, "src", cpp_h_file)
-            else:
-                cpp_h_file_path = os.path.join(self.__root, cpp_h_file)
-        else:  # we have .h file, should we add .inc to its path?
-            if self._inc_dir is not None:  # inc folder exists
-                cpp_h_file_path = os.path.join(self.__root, "inc", cpp_h_file)
-            else:   # inc folder does not exist
-                cpp_h_file_path = os.path.join(self.__root, cpp_h_file)
-        with open(cpp_h_file_path, 'r') as f:
-            src_lines = f.readlines()  # Read whole file into memory
-        inc_files = []  # list of include files
-        for line in src_lines:
-            res = self.inc_pat.match(line)
-            if res is not None:
-                inc_file = res.group(1)
-                if inc_file not in inc_files:
-                    inc_files.append(inc_file)
-                    inc_files.extend(self.find_dep(inc_file))
-        return inc_files
-
-    def _write_makefile(self, root):
-        self.__root = root   # save this parameter, it is needed
+                run_cmd = self.limits.command(
+                    ["./" + os.path.basename(target)],
+                    os.path.join(os.path.dirname(target), RUN_RECORD))
+                cmd += ["--tab", "--working-directory={}".format(
+                    os.path.dirname(target)), "-e", "bash -c {}".format(
+                    shlex.quote("pwd;{};exec bash".format(
+                        " ".join(map(shlex.quote, run_cmd)))))]
+            self.supervisor.spawn(cmd, self._window_group)
+
+    def run_records(self):
+        """ Resources used by the last exec of each makefiles_path (wall, cpu,
+        max_rss, killed, see limits.run_limited), None if not run yet."""
+        records = dict()
+        for makefile_path in self.makefiles_path:
+            try:
+                with open(os.path.join(makefile_path, RUN_RECORD)) as f:
+                    records[makefile_path] = json.load(f)
+            except (OSError, ValueError):  # not run or still running
+                records[makefile_path] = None
+        return records
+
+    def find_targets(self):
+        """ Returns the full path of the executable of each makefiles_path.
+        It is taken from the build manifest, or read from the TARGET line of
+        a Makefile of the student."""
+        targets = map(self.find_target, self.makefiles_path)
+        return [target for target in targets if target is not None]
+
+    def find_target(self, makefile_path):
+        """ Full path of the executable of one makefile_path or None """
+        manifest = self.own_manifest(makefile_path)
+        if manifest is not None:
+            return os.path.join(makefile_path, manifest["target"])
+        makefile_name = list(filter(lambda f: f.lower() == "makefile",
+                                    os.listdir(makefile_path)))[0]
+        with open(os.path.join(makefile_path, makefile_name), 'r') as f:
+            makefile_lines = f.readlines()
+        target = list(filter(lambda l: l.strip().upper().startswith(
+            "TARGET"), makefile_lines))
+        if len(target) != 1:
+            self.log_trigger.emit("{}: Could not find the target line".
+                                  format(os.path.relpath(makefile_path,
+                                                         self._root)))
+            return None
+        target = target[0].split()[-1]  # the last part of the line
+        return os.path.join(makefile_path, target)  # full path
+
+    def _write_makefile(self, node):
+        """ node is the DirIndex of the folder, Makefile is written there.
+        The folder is scanned again, the sources and headers decide if the
+        Makefile has changed and node may be older than them."""
+        node = DirIndex.build(node.path)
+        self.__root = node.path   # save this parameter, it is needed
         # Preamble
-        if "Linux" in self._plat:
+        if "Linux" in self._plat and self.cache_dir is not None:
+            make_file = "CXX      = {} {} {} {} g++\n".format(
+                shlex.quote(sys.executable), shlex.quote(OBJCACHE_SCRIPT),
+                shlex.quote(self.cache_dir), self.cache_size) + \
+                        "LXX      = g++\n" + \
+                        "CXXFLAGS = -std=c++17 -Wall -c -g\n" + \
+                        "LXXFLAGS = -Wall\n"
+        elif "Linux" in self._plat:
             make_file = "CXX      = g++\n" + \
                         "LXX      = g++\n" + \
                         "CXXFLAGS = -std=c++17 -Wall -c -g\n" + \
@@ -240,30 +469,35 @@ class CCompiler(QtCore.QThread):
             
         # if inc folder exists include it otherwise put variable to None
         self._inc_dir = os.path.join(self.__root, "inc")
-        if os.path.exists(self._inc_dir):
-            if os.path.isdir(self._inc_dir):
-                if "Linux" in self._plat:
-                    make_file = make_file.replace("-c", "-I ./inc -c")
-                elif "Windows" in self._plat:
-                    make_file = make_file.replace("/c", "/Iinc\ /c")
-            else:
-                self._inc_dir = None
-        else:
+        if node.inc is not None:
+            if "Linux" in self._plat:
+                # CXX may have paths, only CXXFLAGS is changed
+                make_file = make_file.replace("-Wall -c", "-Wall -I ./inc -c")
+            elif "Windows" in self._plat:
+                make_file = make_file.replace("/c", "/Iinc\ /c")
+        else:  # inc does not exist or it is not dir
             self._inc_dir = None
+        # flags of the .gch are the same, g++ loads it instead of the headers
+        if self.is_linux and self.prebuilt is not None and \
+                self.prebuilt.pch is not None:
+            make_file = make_file.replace("-c -g\n", "-c -g -include {} "
+                                          "-Winvalid-pch\n".format(
+                                              shlex.quote(self.prebuilt.pch)))
 
         # if src folder exists include it otherwise put __root as src
         self._src_dir = os.path.join(self.__root, "src")
-        if os.path.exists(self._src_dir):
-            if not os.path.isdir(self._src_dir): # src exists but it is not dir
-                self._src_dir = self.__root
-        else:  # src does not exist
+        src_node = node.src
+        if src_node is None:  # src does not exist or it is not dir
             self._src_dir = self.__root
+            src_node = node
 
         # Note that many other files may exist other than cpp files
-        src_files = [f for f in os.listdir(self._src_dir) if f.endswith(".cpp")]
+        src_files = [f for f in src_node.files if f.endswith(".cpp")]
         
 
 
+        flags = make_file.splitlines()  # CXX, CXXFLAGS, LXX and LXXFLAGS
+
         # Writing OBJECTS = line
         dep_dic = dict()
         if "Windows" in self._plat:
@@ -278,9 +512,10 @@ class CCompiler(QtCore.QThread):
 
         # Writing TARGET =  line
         if "Windows" in self._plat:
-            make_file += "TARGET   = main.exe\n\n"
+            target = "main.exe"
         elif "Linux" in self._plat:
-            make_file += "TARGET   = main\n\n"
+            target = "main"
+        make_file += "TARGET   = " + target + "\n\n"
         
         # Writing first section of MakeFile
         make_file += "$(TARGET): $(OBJECTS)\n" + \
@@ -289,9 +524,22 @@ class CCompiler(QtCore.QThread):
         if self.is_windows:
             make_file = make_file.replace("-o $(TARGET)", "/out:$(TARGET)")
 
-        # Finding Dependency list
-        for src_file in src_files:
-            dep_dic[src_file] = self.find_dep(src_file)
+        # Finding Dependency list, paths are relative to __root
+        inc_index = IncludeIndex(self.__root, self._src_dir, self._inc_dir,
+                                 self.inc_pat, node.file_paths())
+        src_paths = [os.path.join(self._src_dir, f) for f in src_files]
+        with tracing.span("dependencies", "c++",
+                          student=os.path.basename(self._root),
+                          question=os.path.relpath(self.__root, self._root),
+                          sources=len(src_paths)):
+            dependencies = inc_index.dependencies(src_paths)
+        prebuilt_objs = dict()  # source -> object copied instead
+        for src_file, src_path, deps in zip(src_files, src_paths,
+                                            dependencies):
+            dep_dic[src_file] = [os.path.relpath(d, self.__root) for d in deps]
+            if self.is_linux and self.prebuilt is not None:
+                prebuilt_objs[src_file] = self.prebuilt.object_for(src_path,
+                                                                   deps)
         # Writing 2 lines per each object file: 4 cases
         # 1 : both src and inc exist
         # 2 : src exists but not inc
@@ -302,8 +550,7 @@ class CCompiler(QtCore.QThread):
             if self._src_dir != self.__root:   # src exists
                 if self._inc_dir is not None:  # both src and inc exist
                     first_line = "obj" + os.sep + obj + ": src" + os.sep + src \
-                                 + ' ' + " ".join(["inc" + os.sep + header for
-                                                   header in dep_dic[src]]) + '\n'
+                                 + ' ' + " ".join(dep_dic[src]) + '\n'
                     if self.is_linux:
                         second_line = "\t$(CXX) $(CXXFLAGS) src/" + src\
                                       + " -o " + "obj" + os.sep + obj + '\n'
@@ -323,7 +570,7 @@ class CCompiler(QtCore.QThread):
             # Note that second_line is the same for both cases below
             elif self._inc_dir is not None:  # only inc exists
                 first_line = "obj" + os.sep + obj + ": " + src + ' ' + ' '.join(
-                    ["inc" + os.sep + header for header in dep_dic[src]]) + '\n'
+                    dep_dic[src]) + '\n'
                 if self.is_linux:
                     second_line = "\t$(CXX) $(CXXFLAGS) " + src + " -o " + \
                                   "obj/" + obj + '\n'
@@ -331,12 +578,15 @@ class CCompiler(QtCore.QThread):
                     second_line = "\t$(CXX) $(CXXFLAGS) -Foobj\\" + " " + src
             else:  # neither exists
                 first_line = "obj" + os.sep + obj + ": " + src + ' ' + ' '.join(
-                    [' ' + header for header in dep_dic[src]]) + '\n'
+                    dep_dic[src]) + '\n'
                 if self.is_linux:
                     second_line = "\t$(CXX) $(CXXFLAGS) " + src + " -o " + \
                                   "obj/" + obj + '\n'
                 elif self.is_windows:
                     second_line = "\t$(CXX) $(CXXFLAGS) -Foobj\\" + " " + src
+            if prebuilt_objs.get(src) is not None:  # provided source
+                second_line = "\tcp " + shlex.quote(prebuilt_objs[src]) + \
+                              " obj/" + obj + '\n'
             # The part between first and second line is to make obj directory
             make_file += first_line
             if self.is_linux:
@@ -355,34 +605,168 @@ class CCompiler(QtCore.QThread):
                          "\tif exist $(TARGET) del /F /S /Q $(TARGET)\n" + \
                          "\tif exist obj rmdir /S /Q obj\n"
 
-        # Writing Makefile
-        with open(os.path.join(self.__root, "Makefile"), 'w') as f_handle:
+        # Writing Makefile, only if something has changed so that make
+        # does not rebuild what is up to date
+        manifest = {"sources": sorted(dep_dic), "deps": dep_dic,
+                    "flags": flags, "target": target,
+                    "prebuilt": prebuilt_objs}
+        old = self.own_manifest(self.__root)
+        if old is not None and not self.clean_build and \
+                all(old.get(k) == v for k, v in manifest.items()):
+            self.log_trigger.emit("Makefile up to date in: {}".format(
+                os.path.relpath(self.__root, self._root)))
+            return
+        if old is None or old["flags"] != flags or \
+                old.get("prebuilt") != prebuilt_objs:
+            self._stale.add(self.__root)  # objects of other flags, if any
+        makefile = os.path.join(self.__root, "Makefile")
+        with open(makefile, 'w') as f_handle:
             f_handle.write(make_file)
+        manifest["makefile"] = os.stat(makefile).st_mtime_ns
+        with open(os.path.join(self.__root, BUILD_MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
         self.log_trigger.emit("Makefile generated in: {}".
                               format(os.path.relpath(self.__root, self._root)))
 
+class IncludeIndex:
+    """ The user defined includes of the sources in a question folder, i.e.,
+    #include "myfile.h" lines, the libraries #include<xxx> are ignored. Each
+    file is read once, its includes are cached by path and mtime so the same
+    header is not parsed again, not even by another IncludeIndex. A header is
+    looked up in the folder of the file including it, then inc and root.
+    Include cycles are allowed, the dependencies of all the sources are found
+    in one traversal of the graph. If files (a set of full paths) is given
+    the headers are looked up there instead of the file system."""
+    _cache = dict()  # path -> (mtime, size, names of the included headers)
+
+    def __init__(self, root, src_dir, inc_dir, inc_pat, files=None):
+        self._root = root
+        self._src_dir = src_dir
+        self._inc_dir = inc_dir  # None if there is no inc folder
+        self._inc_pat = inc_pat
+        self._files = files
+        self._edges = dict()  # path -> paths of the included headers
+
+    def included_names(self, path):
+        """ Names in the #include "" lines of path, cached by path and mtime """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        cached = self._cache.get(path)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        names = []
+        with open(path, 'r', errors='replace') as f:
+            for line in f:  # only one line in memory at a time
+                res = self._inc_pat.match(line)
+                if res is not None and res.group(1) not in names:
+                    names.append(res.group(1))
+        self._cache[path] = (st.st_mtime_ns, st.st_size, names)
+        return names
+
+    def includes(self, path):
+        """ Paths of the headers included by path, missing ones are ignored """
+        if path not in self._edges:
+            dirs = [os.path.dirname(path)]
+            if self._inc_dir is not None:
+                dirs.append(self._inc_dir)
+            dirs.append(self._root)
+            headers = []
+            for name in self.included_names(path):
+                for d in dirs:
+                    header = os.path.join(d, name)
+                    if (header in self._files if self._files is not None
+                            else os.path.isfile(header)):
+                        if header not in headers:
+                            headers.append(header)
+                        break
+            self._edges[path] = headers
+        return self._edges[path]
+
+    def dependencies(self, src_paths):
+        """ Returns the list of headers each of src_paths depends on, directly
+        or not. Tarjan's algorithm is used: all the files in an include cycle
+        depend on each other and share the same list."""
+        index = dict()  # path -> order of visit
+        low = dict()
+        stack = []
+        closure = dict()  # path -> all the headers it depends on
+
+        def visit(v):
+            index[v] = low[v] = len(index)
+            stack.append(v)
+            for w in self.includes(v):
+                if w not in index:
+                    visit(w)
+                    low[v] = min(low[v], low[w])
+                elif w not in closure:  # on the stack, i.e., a cycle
+                    low[v] = min(low[v], index[w])
+            if low[v] == index[v]:  # v is the root of a component
+                component = []
+                while True:
+                    w = stack.pop()
+                    component.append(w)
+                    if w == v:
+                        break
+                deps = dict()  # used as an ordered set
+                for u in reversed(component):
+                    for w in self.includes(u):
+                        deps[w] = None
+                        deps.update(dict.fromkeys(closure.get(w, [])))
+                deps = list(deps)
+                for u in component:
+                    closure[u] = deps
+
+        for src_path in src_paths:
+            if src_path not in index:
+                visit(src_path)
+        return [[d for d in closure[src_path] if d != src_path]
+                for src_path in src_paths]
+
+
 class MATCompiler(QtCore.QThread):
     """ This class receives a root folder. It iterates recursively inside folders
     and tries to check if any .m file exists. Then it checks if the file is a
-    script not function by looking at the first line of it. If it did not find
-    the function keyword and it had not started with %, then it can be executed.
+    script not function by looking at the first line of code in it, comments
+    and blank lines are skipped. If it does not start with the function or
+    classdef keyword, then it can be executed (it may have local functions).
     List of Changes:
         v0.0: first release
         v0.2: matlab process management implemented in windows, not tested yet
         v0.3: psutil process management in windows tested and working fine
+        v0.4: scripts run with resource limits in linux, usage is recorded
+        v0.5: scripts can be run in a pool of warm interpreters (matpool)
+        v0.6: files are read until the first line of code, kinds are cached
+        v0.7: start() finds and runs the scripts in the thread
+        v0.8: processes are owned by a ProcessSupervisor, no psutil scan
     """
     # Defining triggers
     log_trigger = QtCore.pyqtSignal(str)
+    _kinds = dict()  # path -> (mtime, size, kind), shared by all the objects
+    _keyword_re = re.compile(r"(function|classdef)\b")
 
-    def __init__(self, root):
+    def __init__(self, root, index=None):
         QtCore.QThread.__init__(self)
         self._root = root
+        self._index = index  # DirIndex of root, built if None
         self.script_files = []   # Hold all the matlab script files
-        self._processes = []  # Holds all the subprocesses
+        self.workers = 1  # threads reading the files in search_scripts
+        # limits of exec, matlab itself needs a lot of memory and cpu time
+        self.limits = RunLimits(cpu=None, wall=None, memory=None)
+        # interpreters of run_scripts, octave or matlab if cmd is None
+        self.interpreter_cmd = None
+        self.pool_size = 2  # interpreters running at the same time
+        self.max_scripts = 50  # an interpreter is restarted after that
+        self.script_timeout = 60  # s, for each script in run_scripts
+        self._pool = None  # started by the first run_scripts
+        # Owns the matlab windows, the GUI shares its own
+        self.supervisor = ProcessSupervisor()
+        self._window_group = "matlab"
+        self._cancel = Event()  # set by cancel(), cleared by change_root
         self._arch = platform.machine()  # x86_64 or i386
         self._env = os.environ.copy()  # environment variables are returned in
         self._plat = platform.system()  # Linux or Windows
-        self._comment_re = re.compile(r"^ *%")
         if "Windows" in self._plat:
             self.is_windows = True
             self.is_linux = False
@@ -390,51 +774,128 @@ class MATCompiler(QtCore.QThread):
             self.is_windows = False
             self.is_linux = True
 
-    def change_root(self, root):
+    def change_root(self, root, index=None):
         """ It is not needed to destroy the object and create another one. By
                 calling this method root is changed while configurations are reused."""
         self._root = root
+        self._index = index
         self.script_files.clear()  # reset the previous makefiles
+        self._cancel.clear()
         self.kill_windows()  # closes all open windows
 
+    def run(self):
+        """ Runs in the thread after start(): the scripts are found (the
+        files of a big cohort may take a while) and executed."""
+        if len(self.search_scripts()) == 0:
+            self.log_trigger.emit("Did not find any script to run.")
+            return
+        if self._cancel.is_set():
+            return
+        self.log_trigger.emit("Matlab: Execute")
+        self.exec()
+
+    def cancel(self):
+        """ The scripts are not executed if they are not yet """
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def root(self):
+        return self._root
+
     def kill_windows(self):
         """ In this function all the open windows including the pdf viewer,
         editor and terminals should be closed."""
-        if self.is_windows:
-            for p in self._processes:
-                if psutil.pid_exists(p.pid): # may be colsed already by user
-                    p.terminate()
-
-        elif self.is_linux:
-            for p in self._processes:
-                if "Linux" in self._plat:
-                    os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-        
-        self._processes.clear()
+        self.supervisor.kill_group(self._window_group)
 
+    @tracing.traced("MATCompiler.search_scripts", _span_attrs, "matlab")
     def search_scripts(self):
-        for dir_path, _, file_names in os.walk(self._root):
-            # Filter out all the non .m files
-            for mat_file in filter(lambda f: f.lower().endswith('.m'),
-                                   file_names):
-                # Now filter out script files
-                mat_file_fullname = os.path.join(dir_path, mat_file)
-                for line in open(mat_file_fullname).readlines():
-                    if line.isspace():
-                        continue
-                    elif 'function' in line:
-                        break
-                    elif self._comment_re.match(line) is not None:  # comment
-                        continue
-                    else:  # The .m file is script, so save it
-                        self.script_files.append(mat_file_fullname)
-                        break
+        """ Returns the scripts under root, the list is made again each time
+        but the files are only read if they changed since the last call."""
+        if self._index is None:
+            self._index = DirIndex.build(self._root)
+        m_files = [os.path.join(node.path, f)
+                   for node, _ in self._index.walk() for f in node.with_ext('.m')]
+        kinds = self.classify(m_files, self.workers)
+        self.script_files = [f for f in m_files if kinds[f] == "script"]
         return self.script_files
 
+    @classmethod
+    def classify(cls, paths, workers=1):
+        """ path -> script, function, class or empty (only comments) for many
+        .m files, e.g. a whole cohort. The files are read by workers threads
+        and the results are cached by path, mtime and size."""
+        kinds = dict()
+        if workers > 1 and len(paths) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for path, kind in zip(paths, pool.map(cls.m_file_kind, paths)):
+                    kinds[path] = kind
+        else:
+            for path in paths:
+                kinds[path] = cls.m_file_kind(path)
+        return kinds
+
+    @classmethod
+    def m_file_kind(cls, path):
+        """ Kind of a .m file given by its first line of code """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return "empty"
+        cached = cls._kinds.get(path)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        kind = "empty"
+        block_comment = 0  # depth of %{ ... %} blocks
+        with open(path, 'r', errors='replace') as f:
+            for line in f:  # stops at the first line of code
+                text = line.strip()
+                if text in ("%{", "#{"):
+                    block_comment += 1
+                elif text in ("%}", "#}") and block_comment > 0:
+                    block_comment -= 1
+                elif block_comment > 0 or text == "" or text[0] in "%#":
+                    continue
+                else:
+                    # the first code line decides: function or classdef,
+                    # otherwise it is a script
+                    res = cls._keyword_re.match(text)
+                    if res is None:  # may still have local functions later
+                        kind = "script"
+                    elif res.group(1) == "function":
+                        kind = "function"
+                    else:
+                        kind = "class"
+                    break
+        cls._kinds[path] = (st.st_mtime_ns, st.st_size, kind)
+        return kind
+
+    def run_scripts(self, scripts=None):
+        """ Runs scripts (default: script_files), e.g. the scripts of a whole
+        cohort, in the warm interpreters without any window. Their output and
+        errors are captured. Returns full path -> result of matpool."""
+        scripts = self.script_files if scripts is None else scripts
+        if self._pool is None:
+            self._pool = InterpreterPool(self.interpreter_cmd, self.pool_size,
+                                         self.max_scripts, self.script_timeout,
+                                         self.log_trigger.emit)
+        return self._pool.run(scripts, self._root)
+
+    def close_pool(self):
+        """ Stops the interpreters of run_scripts """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    @tracing.traced("MATCompiler.exec", _span_attrs, "matlab")
     def exec(self):
         if self.is_windows:
             # TODO: Call scripts one after another
-            terminal_cmd = """matlab -nodesktop -nosplash -r " """
+            # -wait: the launcher lives as long as matlab, so it can be killed
+            terminal_cmd = """matlab -wait -nodesktop -nosplash -r " """
             q_cmd = """ cd('{}'),disp(pwd),input('press any key to run...','s'),{},"""
             # The for loop should be made, now it is wrong, the code after is OK
             for script_file in self.script_files:
@@ -445,37 +906,269 @@ class MATCompiler(QtCore.QThread):
                     self._root)))
             terminal_cmd.rstrip(',')  # remove trailing ,
             terminal_cmd += "\""
-            t = epoch_time()
-            p = Popen(shlex.split(terminal_cmd))
-            # In some computers p.wait() p.terminate() does not do anything
-            # in other systems, it blocks the program.
-            #p.wait()
-            #p.terminate()  # Note that this does not close MATLAB
-            # Use psutil to retrieve all the processes with MATLAB
-            matlab_proc = list(filter(lambda p: "matlab" in p.name().lower(),
-                     psutil.process_iter()))
-            # Sometimes more than one matlab process exist
-            if len(matlab_proc) > 1:
-                diff_time = [abs(p.create_time()-t) for p in matlab_proc]
-                # Find the process created almost the same time as t,
-                # Hopefully this is correct always
-                ind_min = min(enumerate(diff_time), key=itemgetter(1))[0]
-                self._processes.append(matlab_proc[ind_min])
-            elif len(matlab_proc) > 0:  # In fact should be 1
-                self._processes.append(matlab_proc[0])
+            self.supervisor.spawn(shlex.split(terminal_cmd),
+                                  self._window_group)
 
         elif self.is_linux:  # Here the scripts should be run
-            terminal_cmd = "gnome-terminal --disable-factory "
-            tab_cmd = "--tab --working-directory='{}' -e " + \
-                      """'bash -c "matlab -nodesktop -nosplash -r "{}";""" + \
-                      """exec bash" ' """
-            cmd = terminal_cmd
+            cmd = ["gnome-terminal", "--disable-factory"]
             for script_file in self.script_files:  # script_file is absolute path
                 # Note that .m should be removed from the command of matlab
-                matlab_cmd = script_file[:-2]
-                cmd += tab_cmd.format(os.path.dirname(script_file),
-                                      os.path.basename(matlab_cmd))
+                matlab_cmd = os.path.basename(script_file[:-2])
+                run_cmd = self.limits.command(
+                    ["matlab", "-nodesktop", "-nosplash", "-r", matlab_cmd],
+                    script_file[:-2] + RUN_RECORD)
+                cmd += ["--tab", "--working-directory={}".format(
+                    os.path.dirname(script_file)), "-e", "bash -c {}".format(
+                    shlex.quote("{};exec bash".format(
+                        " ".join(map(shlex.quote, run_cmd)))))]
                 rel_script_path = os.path.relpath(script_file, self._root)
                 self.log_trigger.emit("Exec: {}".format(rel_script_path))
-            p = Popen(shlex.split(cmd), shell=False, start_new_session=True)
-            self._processes.append(p)
\ No newline at end of file
+            self.supervisor.spawn(cmd, self._window_group)
+
+    def run_records(self):
+        """ Resources used by the last exec of each script, None if not run
+        yet (see CCompiler.run_records)."""
+        records = dict()
+        for script_file in self.script_files:
+            try:
+                with open(script_file[:-2] + RUN_RECORD) as f:
+                    records[script_file] = json.load(f)
+            except (OSError, ValueError):  # not run or still running
+                records[script_file] = None
+        return records
+
+
+def syntax_check(path):
+    """ Compiles a python file to bytecode without writing a .pyc into the
+    folder of the student. Returns "" or the error. Runs in the workers of
+    PyCompiler.compile."""
+    try:
+        with open(path, 'rb') as f:
+            compile(f.read(), path, 'exec', dont_inherit=True)
+    except SyntaxError as e:  # also IndentationError
+        return "line {}: {}".format(e.lineno, e.msg)
+    except (OSError, ValueError) as e:  # e.g. null bytes
+        return str(e)
+    return ""
+
+
+class PyCompiler(QtCore.QThread):
+    """ This class receives a root folder. It finds the entry script of each
+    question folder: main.py, otherwise the files with a __main__ guard,
+    otherwise the files that are not imported by the others. There is no
+    real compile step, all the .py files are compiled to bytecode in a pool
+    of processes to find syntax errors. Scripts can be run in terminals
+    (exec) or all together with captured output and limits (run_scripts).
+    List of Changes:
+        v0.0: first release
+        v0.1: start() checks the syntax in the thread, cancel() stops it
+    """
+    # Defining triggers
+    log_trigger = QtCore.pyqtSignal(str)
+    progress_trigger = QtCore.pyqtSignal(str, str)  # question, status
+
+    def __init__(self, root, index=None):
+        QtCore.QThread.__init__(self)
+        self._root = root
+        self._index = index  # DirIndex of root, built if None
+        self.script_files = []  # entry scripts, full paths
+        self.workers = os.cpu_count() or 1  # processes at the same time
+        # limits of exec, no wall time since the user types the input
+        self.limits = RunLimits(wall=None)
+        self.run_limits = RunLimits()  # limits of run_scripts
+        self.python_cmd = sys.executable  # interpreter of the students
+        self.syntax_errors = dict()  # full path -> error of the last compile
+        # Owns the terminals and the runs, the GUI shares its own
+        self.supervisor = ProcessSupervisor()
+        self._window_group = "python terminal"
+        self._cancel = Event()  # set by cancel(), cleared by change_root
+        self._plat = platform.system()  # Linux or Windows
+        if "Windows" in self._plat:
+            self.is_windows = True
+            self.is_linux = False
+        elif "Linux" in self._plat:
+            self.is_windows = False
+            self.is_linux = True
+
+    def change_root(self, root, index=None):
+        """ It is not needed to destroy the object and create another one. By
+        calling this method root is changed while configurations are reused."""
+        self._root = root
+        self._index = index
+        self.script_files.clear()
+        self.syntax_errors.clear()
+        self._cancel.clear()
+        self.kill_windows()  # closes all open windows
+
+    def run(self):
+        """ Runs in the thread after start(): scripts are found and checked """
+        if len(self.search_scripts()) == 0:
+            self.log_trigger.emit("Did not find any script to check.")
+            return
+        self.log_trigger.emit("Checking the syntax, Wait ...")
+        self.compile()
+
+    def cancel(self):
+        """ The files not checked yet are skipped """
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def root(self):
+        return self._root
+
+    def kill_windows(self):
+        """ Closes the terminals opened by exec """
+        self.supervisor.kill_group(self._window_group)
+
+    def search_scripts(self):
+        """ Returns the entry scripts of all the question folders """
+        if self._index is None:
+            self._index = DirIndex.build(self._root)
+        self.script_files = []
+        for node, _ in self._index.walk():
+            if "__pycache__" in node.path.split(os.sep):
+                continue
+            py_files = node.with_ext('.py')
+            self.script_files += [os.path.join(node.path, f)
+                                  for f in self._entry_scripts(node, py_files)]
+        return self.script_files
+
+    def _entry_scripts(self, node, py_files):
+        if len(py_files) <= 1:
+            return py_files
+        for f in py_files:
+            if f.lower() == "main.py":
+                return [f]
+        sources = dict()
+        for f in py_files:
+            with open(os.path.join(node.path, f), 'r',
+                      errors='replace') as src:
+                sources[f] = src.read()
+        guarded = [f for f in py_files if PY_MAIN_RE.search(sources[f])]
+        if len(guarded) > 0:
+            return guarded
+        # modules imported by another file of the folder are not entries
+        imported = set()
+        for f, source in sources.items():
+            for other in py_files:
+                name = re.escape(other[:-3])
+                if other != f and re.search(
+                        r"^\s*(?:import|from)\s+{}\b".format(name), source,
+                        re.MULTILINE):
+                    imported.add(other)
+        return [f for f in py_files if f not in imported] or py_files
+
+    def compile(self):
+        """ Syntax check of all the .py files of the question folders of the
+        scripts, in parallel. Returns the number of files with errors."""
+        files = []
+        for folder in sorted({os.path.dirname(s) for s in self.script_files}):
+            files += [os.path.join(folder, f) for f in sorted(os.listdir(
+                folder)) if f.lower().endswith('.py')]
+        self.syntax_errors.clear()
+        if len(files) == 0:
+            return 0
+        n_left = dict()  # question folder -> files not checked yet
+        for path in files:
+            n_left[os.path.dirname(path)] = \
+                n_left.get(os.path.dirname(path), 0) + 1
+        # spawned, forking a process with Qt and its threads can deadlock
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(files)),
+                                 mp_context=multiprocessing.get_context(
+                                     "spawn")) as pool:
+            futures = {pool.submit(syntax_check, path): path
+                       for path in files}
+            for future in as_completed(futures):
+                if self._cancel.is_set():
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.log_trigger.emit("Syntax check cancelled.")
+                    return len(self.syntax_errors)
+                path, error = futures[future], future.result()
+                if error != "":
+                    self.syntax_errors[path] = error
+                    self.log_trigger.emit("{}: {}".format(
+                        os.path.relpath(path, self._root), error))
+                folder = os.path.dirname(path)
+                n_left[folder] -= 1
+                if n_left[folder] == 0:  # the whole question is checked
+                    self.progress_trigger.emit(
+                        os.path.relpath(folder, self._root),
+                        "Syntax error" if any(os.path.dirname(p) == folder
+                                              for p in self.syntax_errors)
+                        else "OK")
+        self.log_trigger.emit("Syntax check: {} files, {} with errors".format(
+            len(files), len(self.syntax_errors)))
+        return len(self.syntax_errors)
+
+    def run_scripts(self, scripts=None, stdin_path=None):
+        """ Runs scripts (default: script_files), e.g. the scripts of a whole
+        cohort, at most workers at once, each in its own process with
+        run_limits. Returns full path -> result of limits.run_limited."""
+        scripts = self.script_files if scripts is None else scripts
+        results = dict()
+
+        def run(script):
+            stdin = open(stdin_path, 'rb') if stdin_path is not None \
+                else DEVNULL
+            try:
+                return run_limited([self.python_cmd, script],
+                                   self.run_limits,
+                                   cwd=os.path.dirname(script), stdin=stdin,
+                                   supervisor=self.supervisor)
+            finally:
+                if stdin is not DEVNULL:
+                    stdin.close()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(run, s): s for s in scripts}
+            for future in as_completed(futures):
+                script = futures[future]
+                result = future.result()
+                results[script] = result
+                self.log_trigger.emit(self._run_message(script, result))
+        return results
+
+    def _run_message(self, script, result):
+        rel = os.path.relpath(script, self._root)
+        if result["killed"] != "":
+            status = "Killed ({})".format(result["killed"])
+        elif result["returncode"] == 0:
+            status = "OK"
+        else:
+            status = "Failed ({})".format(result["returncode"])
+        text = "{}: {} in {:.1f} s".format(rel, status, result["wall"])
+        output = (result["stdout"] + result["stderr"]).rstrip()
+        if output != "":  # the last lines, e.g. the traceback
+            text += "\n" + "\n".join(output.splitlines()[-10:])
+        return text
+
+    def exec(self):
+        """ Runs each script in a terminal for the user to interact with """
+        for script_file in self.script_files:
+            self.log_trigger.emit("Exec: {}".format(
+                os.path.relpath(script_file, self._root)))
+        if self.is_windows:
+            for script_file in self.script_files:
+                cmd = "cmd /c \"title {} ... & {} {} & pause\"".format(
+                    os.path.relpath(script_file, os.path.dirname(self._root)),
+                    self.python_cmd, os.path.basename(script_file))
+                self.supervisor.spawn(
+                    cmd, self._window_group, cwd=os.path.dirname(script_file),
+                    creationflags=subprocess.CREATE_NEW_CONSOLE |
+                    subprocess.CREATE_NEW_PROCESS_GROUP)
+
+        elif self.is_linux:
+            cmd = ["gnome-terminal", "--disable-factory"]
+            for script_file in self.script_files:
+                run_cmd = self.limits.command(
+                    [self.python_cmd, os.path.basename(script_file)],
+                    script_file[:-3] + RUN_RECORD)
+                cmd += ["--tab", "--working-directory={}".format(
+                    os.path.dirname(script_file)), "-e", "bash -c {}".format(
+                    shlex.quote("pwd;{};exec bash".format(
+                        " ".join(map(shlex.quote, run_cmd)))))]
+            self.supervisor.spawn(cmd, self._window_group)
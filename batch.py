@@ -0,0 +1,433 @@
+""" Headless batch mode, no GUI is needed. All the zip files in a homework
+folder are ingested, then the makefiles are generated and all the students
+are compiled (C++), or their scripts are found (Matlab) or checked (Python)
+and run with captured output. If a tests folder is given the programs are run
+against its test cases (see testrunner) with resource limits (see limits).
+At the end a json summary is written, with the resources used by each
+submission and the list of submissions sorted by CPU time. The results are
+also recorded in the results store of the folder (see results), a second run
+skips the students already built or run and takes their results from there.
+Usage:
+    python batch.py /path/to/hw_folder --summary summary.json --tests tests
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import time as epoch_time
+from ziphandle import ZipHandle, HW_RE
+from autocompiler import CCompiler, MATCompiler, PyCompiler
+from testrunner import TestRunner, run_metrics, flag_outliers, \
+    MAX_SAVED_OUTPUT
+from limits import RunLimits
+from results import ResultsStore, diagnostics
+from similarity import SimilarityIndex
+from prebuilt import Prebuilt, PREBUILT_DIR
+
+
+class BatchRunner:
+    """ Runs ZipHandle, CCompiler and MATCompiler on a whole homework folder.
+    Students are processed by a pool of workers, each compiler gets its share
+    of the jobs so that at most jobs compilers run at once."""
+
+    def __init__(self, root, prog_type="C++", workers=2, jobs=None,
+                 verbose=False, use_cache=True, tests_dir=None, limits=None,
+                 run_scripts=True):
+        self.root = root
+        self.prog_type = prog_type
+        self.workers = max(1, workers)  # students processed at the same time
+        self.jobs = jobs or os.cpu_count() or 1  # total compilers at once
+        self.verbose = verbose
+        self.use_cache = use_cache  # objects are shared between students
+        self.failed_zips = []  # zip files which could not be ingested
+        self.indexes = dict()  # hw folder -> DirIndex
+        self.tests_dir = tests_dir  # test cases, programs are not run if None
+        # resource limits of each test case run
+        self.limits = limits if limits is not None else RunLimits()
+        self.targets = dict()  # hw folder -> executables found after compile
+        self.run_scripts = run_scripts  # matlab/python without tests
+        self.interpreters = 2  # warm matlab interpreters, see matpool
+        self.similarity = None  # threshold of the similar pairs, 0 to 1
+        self.use_store = True  # results are recorded in the ResultsStore
+        self.resume = True  # work recorded as done is skipped
+        self.store = None  # ResultsStore of root while running
+        self.prebuilt = None  # Prebuilt shared by the compilers, opt-in
+        self.clean = False  # make clean before make, else incremental
+        self.summary = dict()
+
+    def log(self, text):
+        if self.verbose and text != "":
+            print(text, file=sys.stderr)
+
+    def run(self):
+        t = epoch_time()
+        if self.use_store:
+            self.store = ResultsStore.open(self.root)
+        try:
+            return self._run(t)
+        finally:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+
+    def _run(self, t):
+        hw_folders = self.ingest()
+        if self.prog_type == "Matlab":  # all the files of the cohort at once
+            MATCompiler.classify([os.path.join(node.path, f)
+                                  for hw_folder in hw_folders
+                                  for node, _ in self.indexes[hw_folder].walk()
+                                  for f in node.with_ext('.m')], self.jobs)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            submissions = list(pool.map(self.process_hw, hw_folders))
+        if self.tests_dir is not None and self.prog_type in ("C++", "Python"):
+            self.run_tests(submissions)
+        elif self.prog_type == "Python" and self.run_scripts:
+            self.run_py_scripts(submissions)
+        elif self.prog_type == "Matlab" and self.run_scripts:
+            self.run_mat_scripts(submissions)
+        self.summary = {"root": self.root, "type": self.prog_type,
+                        "started": t, "duration": epoch_time() - t,
+                        "failed_zips": self.failed_zips,
+                        "submissions": submissions}
+        if self.similarity is not None:
+            self.summary["similar"] = self.similar_pairs(hw_folders)
+        if any("metrics" in s for s in submissions):
+            self.summary["by_cpu"] = [  # slowest first
+                s["folder"] for s in sorted(
+                    submissions, key=lambda s: -s["metrics"]["cpu"])]
+        return self.summary
+
+    def ingest(self):
+        """ Extracts the zip files in the same way as the GUI does """
+        files = sorted(f for f in os.listdir(self.root)
+                       if f.lower().endswith(".zip"))
+        zip_thread = ZipHandle(self.root, files, HW_RE, self.jobs)
+        zip_thread.log_trigger.connect(self.log)
+        zip_thread.hw_add_trigger.connect(self.indexes.__setitem__)
+        zip_thread.run()  # runs in this thread, returns when finished
+        self.failed_zips = [f for f in files if f[:-4] not in self.indexes]
+        if self.store is not None:
+            for f in files:
+                hw_folder = f[:-4]
+                if hw_folder in self.indexes:
+                    self.store.record_ingest(
+                        hw_folder, "ok", zip_thread.manifest.get(
+                            f, dict()).get("hash", ""),
+                        self.indexes[hw_folder])
+                elif HW_RE.match(hw_folder) is not None:
+                    self.store.record_ingest(hw_folder, "failed")
+            self.store.flush()
+        return sorted(self.indexes)
+
+    def similar_pairs(self, hw_folders):
+        """ Pairs of students with similar code in a question, the index
+        is saved in root so only the new or changed students are read the
+        next time."""
+        index = SimilarityIndex.load(self.root)
+        index.prune(hw_folders)  # e.g. their zip files were deleted
+        n = index.add_students({f: self.indexes[f] for f in hw_folders},
+                               self.jobs)
+        index.save()
+        self.log("Similarity: {} students fingerprinted".format(n))
+        return [{"question": q, "students": [a, b],
+                 "similarity": round(similarity, 3)}
+                for q, a, b, similarity in index.pairs(self.similarity)]
+
+    def done(self, hw_folder, stage):
+        """ True if the stage of the student is recorded as done """
+        return self.store is not None and self.resume and \
+            self.store.done(hw_folder, self.prog_type, stage)
+
+    def process_hw(self, hw_folder):
+        """ Runs in the worker threads, returns the summary of a student """
+        hw_path = os.path.join(self.root, hw_folder)
+        course_name, _, hw_num, st_num = HW_RE.match(hw_folder).groups()
+        result = {"folder": hw_folder, "course": course_name, "hw": hw_num,
+                  "student": st_num}
+        messages = []  # printed together, so students are not mixed up
+        try:
+            self._process_hw(hw_folder, hw_path, result, messages)
+        except Exception as e:  # one odd submission does not stop the rest
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+            messages.append("Error: " + result["error"])
+            # the later stages see a student with nothing to run
+            result.setdefault("scripts" if self.prog_type == "Matlab"
+                              else "questions", [])
+            self.targets.pop(hw_folder, None)
+        self.log("\n".join(["{}:".format(hw_folder)] + messages))
+        return result
+
+    def _process_hw(self, hw_folder, hw_path, result, messages):
+        if self.prog_type in ("C++", "Python") and \
+                self.done(hw_folder, "build"):
+            self.load_builds(hw_folder, result)
+            messages.append("Recorded as built, skipped")
+        elif self.prog_type == "C++":
+            comp = CCompiler(hw_path, self.indexes[hw_folder])
+            comp.jobs = max(1, self.jobs // self.workers)
+            if self.use_cache:
+                comp.cache_dir = os.path.join(self.root, ".objcache")
+            comp.prebuilt = self.prebuilt
+            comp.clean_build = self.clean
+            comp.log_trigger.connect(messages.append)
+            comp.generate_makefiles()
+            comp.compile()
+            targets = {path: comp.find_target(path)  # as find_targets
+                       for path in comp.makefiles_path}
+            result["questions"] = []
+            for r in comp.build_results:
+                errors, warnings = diagnostics(r["out"] + r["err"])
+                result["questions"].append(
+                    {"path": os.path.relpath(r["path"], hw_path),
+                     "returncode": r["returncode"],
+                     "duration": round(r["duration"], 3),
+                     "errors": errors, "warnings": warnings})
+            self.targets[hw_folder] = [targets[path] for path in
+                                       comp.makefiles_path
+                                       if targets[path] is not None]
+            if self.store is not None:
+                self.store.forget(hw_folder, self.prog_type, "build")
+                for r in comp.build_results:
+                    target = targets[r["path"]]
+                    self.store.record_build(
+                        hw_folder, self.prog_type,
+                        os.path.relpath(r["path"], hw_path),
+                        comp.build_status(r), r["returncode"], r["duration"],
+                        r["out"] + r["err"], "" if target is None
+                        else os.path.relpath(target, hw_path))
+                self.store.mark_done(hw_folder, self.prog_type, "build")
+        elif self.prog_type == "Matlab":
+            comp = MATCompiler(hw_path, self.indexes[hw_folder])
+            comp.log_trigger.connect(messages.append)
+            result["scripts"] = [os.path.relpath(f, hw_path)
+                                 for f in comp.search_scripts()]
+        elif self.prog_type == "Python":
+            comp = PyCompiler(hw_path, self.indexes[hw_folder])
+            comp.workers = max(1, self.jobs // self.workers)
+            comp.log_trigger.connect(messages.append)
+            scripts = comp.search_scripts()
+            comp.compile()
+            result["questions"] = [
+                {"path": os.path.relpath(os.path.dirname(s), hw_path),
+                 "script": os.path.relpath(s, hw_path),
+                 "syntax_error": comp.syntax_errors.get(s, "")}
+                for s in scripts]
+            self.targets[hw_folder] = scripts
+            if self.store is not None:
+                self.store.forget(hw_folder, self.prog_type, "build")
+                for q in result["questions"]:
+                    n_errors = sum(os.path.dirname(f) == os.path.join(
+                        hw_path, q["path"]) for f in comp.syntax_errors)
+                    self.store.record_build(
+                        hw_folder, self.prog_type, q["path"],
+                        "Syntax error" if n_errors > 0 else "OK",
+                        target=q["script"], message=q["syntax_error"],
+                        counts=(n_errors, 0))
+                self.store.mark_done(hw_folder, self.prog_type, "build")
+
+    def load_builds(self, hw_folder, result):
+        """ Questions and targets of a student from the store, in the same
+        form as they are after building."""
+        hw_path = os.path.join(self.root, hw_folder)
+        builds = self.store.builds(hw_folder, self.prog_type)
+        if self.prog_type == "C++":
+            result["questions"] = [
+                {"path": b["question"], "returncode": b["returncode"],
+                 "duration": b["duration"], "errors": b["errors"],
+                 "warnings": b["warnings"]} for b in builds]
+        else:
+            result["questions"] = [
+                {"path": b["question"], "script": b["target"],
+                 "syntax_error": b["message"]} for b in builds]
+        self.targets[hw_folder] = [os.path.join(hw_path, b["target"])
+                                   for b in builds if b["target"] != ""]
+
+    def run_tests(self, submissions):
+        """ All the test cases of the cohort go to one pool of workers, the
+            results are added to the questions of each submission. The
+            students already tested get their results from the store."""
+        recorded = {hw_folder: self.store.runs(hw_folder, self.prog_type,
+                                               "tests")
+                    for hw_folder in sorted(self.targets)
+                    if self.done(hw_folder, "tests")}
+        runner = TestRunner(self.tests_dir, self.jobs, self.limits, self.log)
+        results = runner.run([(hw_folder, os.path.join(self.root, hw_folder),
+                               self.targets[hw_folder])
+                              for hw_folder in sorted(self.targets)
+                              if hw_folder not in recorded])
+        if self.store is not None:
+            for hw_folder, questions in results.items():
+                self.store.forget(hw_folder, self.prog_type, "tests")
+                for question, cases in questions.items():
+                    for case in cases:
+                        self.store.record_run(hw_folder, self.prog_type,
+                                              "tests", question,
+                                              case["case"], case)
+                self.store.mark_done(hw_folder, self.prog_type, "tests")
+        results.update(recorded)
+        for submission in submissions:
+            tests = results.get(submission["folder"], dict())
+            for question in submission["questions"]:
+                cases = tests.get(question["path"], [])
+                question["tests"] = cases
+                question["passed"] = sum(c["status"] == "pass" for c in cases)
+            submission["metrics"] = run_metrics(
+                [c for q in submission["questions"] for c in q["tests"]])
+        flag_outliers([s["metrics"] for s in submissions])
+
+    def run_py_scripts(self, submissions):
+        """ Without test cases the python scripts of the whole cohort are run
+        once in one pool, with no input. Scripts with syntax errors are not
+        run."""
+        scripts = []
+        recorded = dict()  # hw folder -> script -> [run]
+        for submission in submissions:
+            hw_folder = submission["folder"]
+            if self.done(hw_folder, "run"):
+                recorded[hw_folder] = self.store.runs(
+                    hw_folder, self.prog_type, "run")
+                continue
+            hw_path = os.path.join(self.root, hw_folder)
+            scripts += [os.path.join(hw_path, q["script"])
+                        for q in submission["questions"]
+                        if q["syntax_error"] == ""]
+        comp = PyCompiler(self.root)
+        comp.workers = self.jobs
+        comp.run_limits = self.limits
+        comp.log_trigger.connect(self.log)
+        results = comp.run_scripts(scripts)
+        for submission in submissions:
+            hw_folder = submission["folder"]
+            hw_path = os.path.join(self.root, hw_folder)
+            if hw_folder in recorded:
+                for question in submission["questions"]:
+                    runs = recorded[hw_folder].get(question["script"], [])
+                    if len(runs) > 0:
+                        question["run"] = runs[0]
+                continue
+            if self.store is not None:
+                self.store.forget(hw_folder, self.prog_type, "run")
+            for question in submission["questions"]:
+                run = results.get(os.path.join(hw_path, question["script"]))
+                if run is None:
+                    continue
+                question["run"] = {key: run[key] for key in (
+                    "returncode", "killed", "wall", "cpu", "max_rss")}
+                question["run"]["stdout"] = run["stdout"][:MAX_SAVED_OUTPUT]
+                question["run"]["stderr"] = run["stderr"][:MAX_SAVED_OUTPUT]
+                if self.store is not None:
+                    self.store.record_run(hw_folder, self.prog_type, "run",
+                                          question["script"], "script",
+                                          question["run"])
+            if self.store is not None:
+                self.store.mark_done(hw_folder, self.prog_type, "run")
+
+    def run_mat_scripts(self, submissions):
+        """ The matlab scripts of the whole cohort are sent to a few warm
+        interpreters (octave or matlab), results are added as runs."""
+        recorded = {s["folder"]: self.store.runs(s["folder"], self.prog_type,
+                                                 "run")
+                    for s in submissions if self.done(s["folder"], "run")}
+        comp = MATCompiler(self.root)
+        comp.pool_size = self.interpreters
+        comp.script_timeout = self.limits.wall or comp.script_timeout
+        comp.log_trigger.connect(self.log)
+        results = comp.run_scripts(
+            [os.path.join(self.root, s["folder"], script)
+             for s in submissions if s["folder"] not in recorded
+             for script in s["scripts"]])
+        comp.close_pool()
+        for submission in submissions:
+            hw_folder = submission["folder"]
+            if hw_folder in recorded:  # question is the script here
+                submission["runs"] = {script: runs[0] for script, runs in
+                                      recorded[hw_folder].items()}
+                continue
+            hw_path = os.path.join(self.root, hw_folder)
+            submission["runs"] = {
+                script: results[os.path.join(hw_path, script)]
+                for script in submission["scripts"]
+                if os.path.join(hw_path, script) in results}
+            if self.store is not None:
+                self.store.forget(hw_folder, self.prog_type, "run")
+                for script, run in submission["runs"].items():
+                    self.store.record_run(hw_folder, self.prog_type, "run",
+                                          script, "script", run)
+                if len(submission["runs"]) == len(submission["scripts"]):
+                    self.store.mark_done(hw_folder, self.prog_type, "run")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Ingest and compile all the homeworks in a folder.")
+    parser.add_argument("root", help="folder containing the zip files")
+    parser.add_argument("-t", "--type", default="C++",
+                        choices=["C++", "Matlab", "Python"],
+                        help="program type")
+    parser.add_argument("-w", "--workers", type=int, default=2,
+                        help="students processed at the same time")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="compilers running at once (default: cores)")
+    parser.add_argument("-s", "--summary", default=None,
+                        help="json summary file (default: stdout)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the log to stderr")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not share the object files between students")
+    parser.add_argument("--tests", default=None,
+                        help="folder of test cases, e.g. tests/1/a.in, a.out")
+    parser.add_argument("--timeout", type=float, default=20,
+                        help="wall time in seconds for each test case")
+    parser.add_argument("--cpu", type=float, default=10,
+                        help="CPU time in seconds for each test case")
+    parser.add_argument("--memory", type=int, default=1024,
+                        help="address space in MB for each test case")
+    parser.add_argument("--output", type=int, default=1024,
+                        help="output size in KB for each test case")
+    parser.add_argument("--no-run", action="store_true",
+                        help="only find the matlab/python scripts")
+    parser.add_argument("--interpreters", type=int, default=2,
+                        help="warm matlab/octave interpreters at once")
+    parser.add_argument("--similar", type=float, default=None,
+                        metavar="THRESHOLD",
+                        help="list the pairs with similar code, 0 to 1")
+    parser.add_argument("--fresh", action="store_true",
+                        help="build and run again what is recorded as done")
+    parser.add_argument("--no-store", action="store_true",
+                        help="do not record the results in the folder")
+    parser.add_argument("--clean", action="store_true",
+                        help="c++: make clean before make, with --fresh")
+    parser.add_argument("--pch", action="store_true",
+                        help="c++: precompile the standard headers once")
+    parser.add_argument("--provided", default=None, metavar="DIR",
+                        help="c++: sources given to the students, compiled "
+                        "once and copied (implies --pch)")
+    args = parser.parse_args(argv)
+
+    runner = BatchRunner(os.path.abspath(args.root), args.type, args.workers,
+                         args.jobs, args.verbose, not args.no_cache,
+                         args.tests, RunLimits(args.cpu, args.timeout,
+                                               args.memory << 20,
+                                               args.output << 10),
+                         not args.no_run)
+    runner.interpreters = args.interpreters
+    runner.resume = not args.fresh
+    runner.similarity = args.similar
+    runner.use_store = not args.no_store
+    runner.clean = args.clean
+    if args.pch or args.provided is not None:
+        runner.prebuilt = Prebuilt(
+            os.path.join(runner.root, PREBUILT_DIR),
+            None if args.provided is None else os.path.abspath(args.provided))
+    summary = runner.run()
+    if args.summary is None:
+        json.dump(summary, sys.stdout, indent=1)
+    else:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+""" Benchmark of the pipeline on a synthetic cohort, no GUI is needed. N
+submissions XX-HWn-nnnnnnn.zip are generated with a seeded random structure:
+with or without a root folder (or one with a wrong name), __MACOSX junk, flat,
+src or src/inc layouts, Makefiles written by the students, chains of includes
+of a given depth and a given number of sources. Then each stage is timed on
+its own:
+    ingest: ZipHandle on all the zip files
+    makefiles: CCompiler.generate_makefiles of every student
+    dependencies: IncludeIndex.dependencies of every question
+    compile: CCompiler.compile of the first --compile students
+    scripts: MATCompiler/PyCompiler.search_scripts of every student
+The caches of the includes and of the .m files are cleared before each
+repeat. The results are written as json, an older result can be given with
+--baseline and the stages which got slower are reported. Usage:
+    python bench.py /tmp/cohort -n 200 -o bench.json --baseline old.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import zipfile
+from statistics import median
+from time import perf_counter, time as epoch_time
+from ziphandle import ZipHandle, HW_RE, MANIFEST_NAME
+from autocompiler import CCompiler, MATCompiler, PyCompiler, IncludeIndex
+
+FAKE_PDF = b"%PDF-1.4\n%%EOF\n"
+
+
+def cpp_question(rng, sources, depth, layout, makefile):
+    """ Files of a C++ question: relative path -> text. Each module has a
+    chain of depth headers including each other, main calls the modules."""
+    src = "src/" if layout in ("src", "src_inc") else ""
+    inc = "inc/" if layout == "src_inc" else src
+    files = dict()
+    calls = []
+    for k in range(sources - 1):
+        for j in range(depth):
+            nxt = '#include "m{}_{}.h"\n'.format(k, j + 1) \
+                if j + 1 < depth else ""
+            body = "x + {}".format(rng.randint(1, 9)) if j + 1 == depth \
+                else "m{}_{}(x) * 2".format(k, j + 1)
+            files["{}m{}_{}.h".format(inc, k, j)] = (
+                "#ifndef M{0}_{1}_H\n#define M{0}_{1}_H\n{2}"
+                "inline int m{0}_{1}(int x) {{ return {3}; }}\n"
+                "{4}#endif\n").format(k, j, nxt, body,
+                                      "int module{}(int x);\n".format(k)
+                                      if j == 0 else "")
+        files["{}module{}.cpp".format(src, k)] = (
+            '#include "m{0}_0.h"\n\nint module{0}(int x) {{\n'
+            '    return m{0}_0(x);\n}}\n').format(k)
+        calls.append("module{}(i)".format(k))
+    files["{}main.cpp".format(src)] = (
+        "#include <iostream>\n" +
+        "".join('#include "m{}_0.h"\n'.format(k) for k in range(sources - 1)) +
+        "\nint main() {{\n    long sum = 0;\n"
+        "    for (int i = 0; i < 100; i++)\n"
+        "        sum += {};\n    std::cout << sum << std::endl;\n"
+        "    return 0;\n}}\n".format(" + ".join(calls) or "i"))
+    if makefile:  # simple Makefile of the student, only in a flat layout
+        files["Makefile"] = ("main: *.cpp\n\tg++ -std=c++17 -o main *.cpp\n\n"
+                             "clean:\n\trm -f main\n")
+    return files
+
+
+def mat_question(rng, sources):
+    """ A script using sources - 1 function files """
+    files = dict()
+    for k in range(sources - 1):
+        files["f{}.m".format(k)] = (
+            "% helper {0}\nfunction y = f{0}(x)\n  y = x + {1};\nend\n".format(
+                k, rng.randint(1, 9)))
+    files["main.m"] = ("%{\n  homework\n%}\n% main script\nx = 1;\n" +
+                       "".join("x = f{}(x);\n".format(k)
+                               for k in range(sources - 1)) + "disp(x)\n")
+    return files
+
+
+def py_question(rng, sources):
+    """ main.py importing sources - 1 helper modules """
+    files = dict()
+    for k in range(sources - 1):
+        files["helper{}.py".format(k)] = (
+            "def f{0}(x):\n    return x + {1}\n".format(k, rng.randint(1, 9)))
+    files["main.py"] = (
+        "".join("from helper{0} import f{0}\n".format(k)
+                for k in range(sources - 1)) +
+        "\nif __name__ == '__main__':\n    x = 1\n" +
+        "".join("    x = f{}(x)\n".format(k) for k in range(sources - 1)) +
+        "    print(x)\n")
+    return files
+
+
+def make_cohort(root, n, prog_type="C++", questions=3, sources=3, depth=2,
+                seed=0, course="AP", hw=1):
+    """ Writes n zip files into root, returns their names. The structure of
+    each one is picked at random, the same seed gives the same cohort."""
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    names = []
+    for i in range(n):
+        hw_name = "{}{}HW{}{}{}".format(course, rng.choice("-_"), hw,
+                                        rng.choice("-_"), 9000000 + i)
+        zip_name = hw_name + rng.choice([".zip", ".zip", ".ZIP"])
+        structure = rng.choices(["root", "flat", "wrong_root"],
+                                [0.6, 0.25, 0.15])[0]
+        prefix = {"root": hw_name + "/", "flat": "",
+                  "wrong_root": "hw{}_sol/".format(hw)}[structure]
+        files = dict()
+        for q in range(1, questions + 1):
+            folder = rng.choice(["{}", "Q{}", "q{}"]).format(q)
+            if prog_type == "C++":
+                layout = rng.choice(["flat", "src", "src_inc"])
+                question = cpp_question(rng, sources, depth, layout,
+                                        layout == "flat" and rng.random() < 0.15)
+            elif prog_type == "Matlab":
+                question = mat_question(rng, sources)
+            else:
+                question = py_question(rng, sources)
+            for path, text in question.items():
+                files["{}{}/{}".format(prefix, folder, path)] = text
+        if structure != "root" or rng.random() < 0.8:  # a report
+            files["{}report.pdf".format(prefix)] = FAKE_PDF
+        with zipfile.ZipFile(os.path.join(root, zip_name), 'w',
+                             zipfile.ZIP_DEFLATED) as z:
+            for path, text in sorted(files.items()):
+                z.writestr(path, text)
+                if rng.random() < 0.2:  # junk of macOS
+                    z.writestr("__MACOSX/" + os.path.dirname(path) + "/._" +
+                               os.path.basename(path), b"\0" * 64)
+        names.append(zip_name)
+    return names
+
+
+def timed(func, repeat):
+    """ func() run repeat times, returns (its last result, seconds of each
+    run)."""
+    seconds = []
+    result = None
+    for _ in range(max(1, repeat)):
+        t = perf_counter()
+        result = func()
+        seconds.append(perf_counter() - t)
+    return result, seconds
+
+
+def stage(seconds, count):
+    """ Summary of a stage, the fastest run is the one compared """
+    return {"seconds": round(min(seconds), 4),
+            "median": round(median(seconds), 4),
+            "runs": [round(s, 4) for s in seconds], "count": count,
+            "per_item_ms": round(1000 * min(seconds) / max(1, count), 3)}
+
+
+class Benchmark:
+    """ Generates the cohort in root and times the stages, results holds the
+    json written at the end."""
+
+    def __init__(self, root, n=50, prog_type="C++", questions=3, sources=3,
+                 depth=2, seed=0, workers=None, repeat=3, n_compile=5,
+                 verbose=False):
+        self.root = root
+        self.n = n
+        self.prog_type = prog_type
+        self.questions = questions  # per student
+        self.sources = sources  # files per question, main included
+        self.depth = depth  # length of the include chains
+        self.seed = seed
+        self.workers = workers or os.cpu_count() or 1  # of ZipHandle
+        self.repeat = repeat  # runs of each stage, the fastest is kept
+        self.n_compile = n_compile  # students compiled, compiling is slow
+        self.verbose = verbose
+        self.indexes = dict()  # hw folder -> DirIndex after ingest
+        self.results = dict()
+
+    def log(self, text):
+        if self.verbose and text != "":
+            print(text, file=sys.stderr)
+
+    def run(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        t = perf_counter()
+        files = make_cohort(self.root, self.n, self.prog_type, self.questions,
+                            self.sources, self.depth, self.seed)
+        generated = perf_counter() - t
+        self.results = {
+            "started": epoch_time(),
+            "config": {"n": self.n, "type": self.prog_type,
+                       "questions": self.questions, "sources": self.sources,
+                       "depth": self.depth, "seed": self.seed,
+                       "workers": self.workers, "repeat": self.repeat,
+                       "compile": self.n_compile},
+            "machine": {"python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+            "cohort": {"zips": len(files), "generate_seconds":
+                       round(generated, 3), "bytes": sum(
+                           os.path.getsize(os.path.join(self.root, f))
+                           for f in files)},
+            "stages": dict()}
+        stages = self.results["stages"]
+        stages["ingest"] = self.time_ingest(files)
+        if self.prog_type == "C++":
+            stages["makefiles"] = self.time_makefiles()
+            stages["dependencies"] = self.time_dependencies()
+            if self.n_compile > 0:
+                stages["compile"] = self.time_compile()
+        else:
+            stages["scripts"] = self.time_scripts()
+        return self.results
+
+    def time_ingest(self, files):
+        def ingest():
+            self.indexes = dict()
+            for f in os.listdir(self.root):  # as if it was never run
+                if os.path.isdir(os.path.join(self.root, f)) or \
+                        f == MANIFEST_NAME:
+                    shutil.rmtree(os.path.join(self.root, f),
+                                  ignore_errors=True)
+            zip_thread = ZipHandle(self.root, files, HW_RE, self.workers,
+                                   incremental=False)
+            zip_thread.log_trigger.connect(self.log)
+            zip_thread.hw_add_trigger.connect(self.indexes.__setitem__)
+            zip_thread.run()
+        _, seconds = timed(ingest, self.repeat)
+        result = stage(seconds, len(files))
+        result["failed"] = len(files) - len(self.indexes)
+        self.results["cohort"]["files"] = sum(
+            len(index.file_paths()) for index in self.indexes.values())
+        return result
+
+    def compiler(self, hw_folder):
+        comp = CCompiler(os.path.join(self.root, hw_folder),
+                         self.indexes[hw_folder])
+        comp.clean_build = True  # always a full build, as in a new cohort
+        comp.log_trigger.connect(self.log)
+        return comp
+
+    def time_makefiles(self):
+        def makefiles():
+            IncludeIndex._cache.clear()
+            n = 0
+            for hw_folder in sorted(self.indexes):
+                comp = self.compiler(hw_folder)
+                comp.generate_makefiles()
+                n += len(comp.makefiles_path)
+            return n
+        n, seconds = timed(makefiles, self.repeat)
+        result = stage(seconds, len(self.indexes))
+        result["makefiles"] = n
+        return result
+
+    def time_dependencies(self):
+        """ Only the include graph, as _write_makefile builds it """
+        inc_pat = CCompiler(None).inc_pat
+        jobs = []
+        for index in self.indexes.values():
+            for node, _ in index.walk():
+                src_node = node.src if node.src is not None else node
+                sources = [os.path.join(src_node.path, f)
+                           for f in src_node.with_ext(".cpp")]
+                if len(sources) > 0 and node.name.lower() != "src":
+                    jobs.append((node, src_node, sources))
+
+        def dependencies():
+            IncludeIndex._cache.clear()
+            n = 0
+            for node, src_node, sources in jobs:
+                inc = node.inc.path if node.inc is not None else None
+                inc_index = IncludeIndex(node.path, src_node.path, inc,
+                                         inc_pat, node.file_paths())
+                n += sum(map(len, inc_index.dependencies(sources)))
+            return n
+        n, seconds = timed(dependencies, self.repeat)
+        result = stage(seconds, len(jobs))
+        result["dependencies"] = n
+        return result
+
+    def time_compile(self):
+        """ Only once, the first students in order """
+        hw_folders = sorted(self.indexes)[:self.n_compile]
+        comps = []
+        for hw_folder in hw_folders:
+            comp = self.compiler(hw_folder)
+            comp.generate_makefiles()
+            comps.append(comp)
+        t = perf_counter()
+        for comp in comps:
+            comp.compile()
+        seconds = perf_counter() - t
+        results = [r for comp in comps for r in comp.build_results]
+        result = stage([seconds], len(hw_folders))
+        result["questions"] = len(results)
+        result["failed"] = sum(r["returncode"] != 0 for r in results)
+        return result
+
+    def time_scripts(self):
+        def scripts():
+            MATCompiler._kinds.clear()
+            n = 0
+            for hw_folder in sorted(self.indexes):
+                cls = MATCompiler if self.prog_type == "Matlab" \
+                    else PyCompiler
+                comp = cls(os.path.join(self.root, hw_folder),
+                           self.indexes[hw_folder])
+                n += len(comp.search_scripts())
+            return n
+        n, seconds = timed(scripts, self.repeat)
+        result = stage(seconds, len(self.indexes))
+        result["scripts"] = n
+        return result
+
+
+def compare(results, baseline, tolerance):
+    """ Lines about the stages slower than baseline by more than tolerance
+    (a fraction), empty if there is none. Only meaningful if the config and
+    the machine are the same."""
+    lines = []
+    for name, new in results["stages"].items():
+        old = baseline.get("stages", dict()).get(name)
+        if old is None or old["seconds"] <= 0:
+            continue
+        ratio = new["seconds"] / old["seconds"]
+        if ratio > 1 + tolerance:
+            lines.append("{}: {:.3f} s, was {:.3f} s ({:+.0f}%)".format(
+                name, new["seconds"], old["seconds"], 100 * (ratio - 1)))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the stages of the pipeline on a generated cohort.")
+    parser.add_argument("root", help="folder for the cohort, it is deleted")
+    parser.add_argument("-n", "--students", type=int, default=50)
+    parser.add_argument("-t", "--type", default="C++",
+                        choices=["C++", "Matlab", "Python"],
+                        help="program type")
+    parser.add_argument("-q", "--questions", type=int, default=3,
+                        help="questions per student")
+    parser.add_argument("--sources", type=int, default=3,
+                        help="source files per question, main included")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="length of the include chains")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="processes extracting the zips (default: cores)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs of each stage, the fastest is compared")
+    parser.add_argument("--compile", type=int, default=5,
+                        help="students compiled, 0 to skip compiling")
+    parser.add_argument("-o", "--output", default=None,
+                        help="json file of the results (default: stdout)")
+    parser.add_argument("--baseline", default=None,
+                        help="json of an older run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slower than the baseline by this fraction is "
+                             "reported")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the log to stderr")
+    args = parser.parse_args(argv)
+
+    bench = Benchmark(os.path.abspath(args.root), args.students, args.type,
+                      args.questions, max(1, args.sources), max(1, args.depth),
+                      args.seed, args.workers, args.repeat, args.compile,
+                      args.verbose)
+    results = bench.run()
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    for name, s in results["stages"].items():
+        print("{}: {:.3f} s, {} items, {:.2f} ms each".format(
+            name, s["seconds"], s["count"], s["per_item_ms"]), file=sys.stderr)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("The baseline has another config: {}".format(
+                baseline.get("config")), file=sys.stderr)
+        lines = compare(results, baseline, args.tolerance)
+        for line in lines:
+            print("Slower: " + line, file=sys.stderr)
+        if len(lines) > 0:
+            return 1
+    return 0
+
+
+# The guard is needed, worker processes of ZipHandle import this module
+if __name__ == "__main__":
+    sys.exit(main())
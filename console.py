@@ -0,0 +1,79 @@
+from PyQt5 import QtCore, QtGui
+from collections import deque
+import tracing
+
+
+class Console(QtCore.QObject):
+    """ Appends the messages to a QTextEdit (the blue terminal) without
+    setting the whole text again. The messages arriving within frame_ms are
+    collected and added in one go by a timer, so nothing is drawn from inside
+    the logging call and processEvents is not needed. Only the last max_lines
+    lines are kept, older lines are written to spill_path if it is given.
+    """
+
+    def __init__(self, text_edit, max_lines=10000, frame_ms=50,
+                 spill_path=None):
+        QtCore.QObject.__init__(self, text_edit)
+        self._edit = text_edit
+        self._format = text_edit.currentCharFormat()  # color of the text
+        self._pending = []  # messages waiting for the timer
+        self._lines = deque()  # ring buffer of the lines in the document
+        self.max_lines = max_lines
+        self._spill = None  # file for the lines removed from the document
+        self.set_spill(spill_path)
+        text_edit.document().setMaximumBlockCount(max_lines)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(frame_ms)
+        self._timer.timeout.connect(self.flush)
+
+    def write(self, text):
+        self._pending.append(text)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        with tracing.span("Console.flush", "gui", messages=len(self._pending)):
+            self._flush()
+
+    def _flush(self):
+        text = "\n".join(self._pending)
+        self._pending.clear()
+        new_lines = text.split("\n")
+        self._lines.extend(new_lines)
+        while len(self._lines) > self.max_lines:  # removed from document too
+            line = self._lines.popleft()
+            if self._spill is not None:
+                self._spill.write(line + "\n")
+        if self._spill is not None:
+            self._spill.flush()
+
+        scroll_bar = self._edit.verticalScrollBar()
+        at_end = scroll_bar.value() == scroll_bar.maximum()
+        cursor = QtGui.QTextCursor(self._edit.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        if not self._edit.document().isEmpty():
+            text = "\n" + text  # every message starts in a new line
+        cursor.insertText(text, self._format)
+        if at_end:  # follow the output unless the user scrolled up
+            scroll_bar.setValue(scroll_bar.maximum())
+
+    def clear(self):
+        self._pending.clear()
+        self._lines.clear()
+        self._timer.stop()
+        self._edit.clear()
+
+    def set_spill(self, spill_path):
+        """ Older lines are appended to spill_path, None to disable """
+        if self._spill is not None:
+            self._spill.close()
+        self._spill = None
+        if spill_path is not None:
+            self._spill = open(spill_path, 'a')
+
+    def text(self):
+        """ All the lines kept in the buffer, including the pending ones """
+        return "\n".join(list(self._lines) + self._pending)
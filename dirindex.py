@@ -0,0 +1,68 @@
+import os
+
+
+class DirIndex:
+    """ Tree of a hw folder, built with one os.scandir pass when the hw is
+    ingested. It is passed to the table, CCompiler and MATCompiler so that
+    they do not list the folders again. Only names are stored, the files are
+    not opened or stat'ed. It is a plain object, so it can be sent back from
+    the worker processes of ZipHandle.
+    """
+    __slots__ = ("path", "name", "dirs", "files", "lower_files")
+
+    def __init__(self, path):
+        self.path = path  # full path of the folder
+        self.name = os.path.basename(path)
+        self.dirs = []  # DirIndex of the sub folders, sorted by name
+        self.files = []  # names of the files, sorted
+        self.lower_files = []  # the same in lower case, for the extensions
+
+    @classmethod
+    def build(cls, path):
+        node = cls(path)
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError:  # deleted or no permission, empty folder
+            return node
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                node.dirs.append(cls.build(entry.path))
+            elif entry.is_file():
+                node.files.append(entry.name)
+        node.lower_files = [f.lower() for f in node.files]
+        return node
+
+    def walk(self, parent=None):
+        """ Yields (node, parent) top down, like os.walk """
+        yield self, parent
+        for d in self.dirs:
+            yield from d.walk(self)
+
+    def child(self, name):
+        """ Sub folder with exactly this name or None """
+        for d in self.dirs:
+            if d.name == name:
+                return d
+        return None
+
+    def with_ext(self, ext):
+        """ Names of the files ending with ext, case is ignored """
+        return [f for f, lf in zip(self.files, self.lower_files)
+                if lf.endswith(ext)]
+
+    @property
+    def src(self):
+        return self.child("src")
+
+    @property
+    def inc(self):
+        return self.child("inc")
+
+    @property
+    def has_makefile(self):
+        return "makefile" in self.lower_files
+
+    def file_paths(self):
+        """ Full paths of all the files in the tree """
+        return {os.path.join(node.path, f)
+                for node, _ in self.walk() for f in node.files}
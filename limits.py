@@ -0,0 +1,205 @@
+""" Resource limits and accounting for the programs of the students. A program
+is run with CPU time, wall time, address space and output size limits and
+its wall time, CPU time, peak RSS and the reason it was killed are recorded.
+It can also be used as a wrapper in a terminal, the record is then written
+to a json file when the program exits:
+    python limits.py --cpu 10 --memory 1024 --record run.json -- ./main
+"""
+import argparse
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+from threading import Thread, Timer
+from time import time as epoch_time
+
+
+class RunLimits:
+    """ cpu and wall are in seconds, memory (address space) and output are in
+    bytes, None means no limit. Only wall and output are enforced in
+    windows."""
+
+    def __init__(self, cpu=10, wall=20, memory=1 << 30, output=1 << 20):
+        self.cpu = cpu
+        self.wall = wall
+        self.memory = memory
+        self.output = output  # stdout + stderr, also the size of files
+
+    def wrap(self, cmd):
+        """ cmd started by sh after setting the limits with ulimit, since
+        preexec_fn is not safe with the threads of TestRunner."""
+        if os.name != "posix":
+            return cmd
+        script = "ulimit -c 0"  # no core dumps
+        if self.cpu is not None:  # SIGXCPU at cpu, SIGKILL a second later
+            cpu = int(math.ceil(self.cpu))
+            script += "; ulimit -S -t {}; ulimit -H -t {}".format(cpu, cpu + 1)
+        if self.memory is not None:
+            script += "; ulimit -v {}".format(self.memory >> 10)  # KB
+        if self.output is not None:  # blocks of 512 bytes
+            script += "; ulimit -f {}".format(max(1, self.output >> 9))
+        return ["/bin/sh", "-c", script + '; exec "$@"', "sh"] + list(cmd)
+
+    def to_args(self):
+        """ Command line arguments of this script for the same limits """
+        args = []
+        if self.cpu is not None:
+            args += ["--cpu", str(self.cpu)]
+        if self.wall is not None:
+            args += ["--wall", str(self.wall)]
+        if self.memory is not None:
+            args += ["--memory", str(self.memory >> 20)]
+        if self.output is not None:
+            args += ["--output", str(self.output >> 10)]
+        return args
+
+    def command(self, cmd, record=None):
+        """ cmd (a list) wrapped with this script, e.g. for a terminal """
+        wrapper = [sys.executable, os.path.abspath(__file__)] + self.to_args()
+        if record is not None:
+            wrapper += ["--record", record]
+        return wrapper + ["--"] + cmd
+
+
+def run_limited(cmd, limits, cwd=None, stdin=None, capture=True,
+                supervisor=None):
+    """ Runs cmd with limits and waits for it. If capture is False stdout and
+    stderr are not redirected (output limit only applies to files). Returns
+    a dict with returncode, stdout, stderr, wall, cpu, max_rss (bytes) and
+    killed: "" if it exited by itself, else wall, cpu, memory, output or the
+    name of the signal. linux counts the memory of this process before the
+    exec, so max_rss is at least about the RSS of python. The process is
+    tracked by supervisor (a ProcessSupervisor) if it is given."""
+    killed = []  # reason, set by the timer or the readers
+    t = epoch_time()
+    # own process group, unless it runs in a terminal and needs ctrl+c
+    group = os.name == "posix" and capture
+    p = subprocess.Popen(limits.wrap(cmd), cwd=cwd, stdin=stdin,
+                         stdout=subprocess.PIPE if capture else None,
+                         stderr=subprocess.PIPE if capture else None,
+                         start_new_session=group)
+    if supervisor is not None:  # waited here, it must not reap it
+        supervisor.track(p, "test", cmd, reap=False)
+
+    def kill(reason):
+        if len(killed) == 0:
+            killed.append(reason)
+        try:
+            if group:
+                os.killpg(p.pid, signal.SIGKILL)  # also its children
+            else:
+                p.kill()
+        except (ProcessLookupError, PermissionError):  # exited already
+            pass
+
+    outputs = {"stdout": [], "stderr": []}
+    total = [0]  # bytes read from both pipes
+
+    def read(pipe, store):
+        for chunk in iter(lambda: pipe.read(1 << 16), b''):
+            total[0] += len(chunk)
+            if limits.output is not None and total[0] > limits.output:
+                kill("output")
+                break
+            store.append(chunk)
+        pipe.close()
+
+    readers = []
+    if capture:
+        readers = [Thread(target=read, args=(p.stdout, outputs["stdout"])),
+                   Thread(target=read, args=(p.stderr, outputs["stderr"]))]
+    for reader in readers:
+        reader.start()
+    timer = None
+    if limits.wall is not None:
+        timer = Timer(limits.wall, kill, args=("wall",))
+        timer.start()
+
+    cpu = max_rss = None
+    if hasattr(os, "wait4"):  # rusage of this child only, thread safe
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        cpu = usage.ru_utime + usage.ru_stime
+        max_rss = usage.ru_maxrss * 1024  # KB in linux
+    else:
+        p.wait()
+    wall = epoch_time() - t
+    if supervisor is not None:
+        supervisor.untrack(p)
+    if timer is not None:
+        timer.cancel()
+    if group:  # children left behind would keep the pipes open
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    for reader in readers:
+        reader.join()
+
+    result = {"returncode": p.returncode,
+              "stdout": b"".join(outputs["stdout"]).decode(errors='replace'),
+              "stderr": b"".join(outputs["stderr"]).decode(errors='replace'),
+              "wall": round(wall, 3),
+              "cpu": None if cpu is None else round(cpu, 3),
+              "max_rss": max_rss, "killed": ""}
+    result["killed"] = kill_reason(result, limits, killed)
+    return result
+
+
+def kill_reason(result, limits, killed):
+    """ Why the program of result was stopped, "" if it was not """
+    if len(killed) > 0:
+        return killed[0]
+    returncode = result["returncode"]
+    near_memory = limits.memory is not None and \
+        result["max_rss"] is not None and \
+        result["max_rss"] >= 0.9 * limits.memory
+    if returncode is None or returncode == 0:
+        return ""
+    elif returncode > 0:  # failed allocations, e.g. MemoryError of python
+        return "memory" if near_memory or \
+            "MemoryError" in result["stderr"] else ""
+    sig = -returncode
+    if sig == signal.SIGXCPU or (sig == signal.SIGKILL and
+                                 limits.cpu is not None and
+                                 (result["cpu"] or 0) >= limits.cpu):
+        return "cpu"
+    elif sig == signal.SIGXFSZ:
+        return "output"
+    elif near_memory or "bad_alloc" in result["stderr"]:
+        return "memory"
+    try:
+        return signal.Signals(sig).name
+    except ValueError:
+        return "signal {}".format(sig)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a program with limits and record its resources.")
+    parser.add_argument("--cpu", type=float, default=None, help="seconds")
+    parser.add_argument("--wall", type=float, default=None, help="seconds")
+    parser.add_argument("--memory", type=int, default=None, help="MB")
+    parser.add_argument("--output", type=int, default=None,
+                        help="KB, size of the written files")
+    parser.add_argument("--record", default=None, help="json file to write")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    limits = RunLimits(args.cpu, args.wall,
+                       None if args.memory is None else args.memory << 20,
+                       None if args.output is None else args.output << 10)
+    result = run_limited(cmd, limits, capture=False)
+    if result["killed"] != "":
+        print("Killed: {}".format(result["killed"]), file=sys.stderr)
+    if args.record is not None:
+        result["cmd"] = cmd
+        with open(args.record, 'w') as f:
+            json.dump(result, f, indent=1)
+    return result["returncode"] if result["returncode"] >= 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
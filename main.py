@@ -1,29 +1,41 @@
 # coding=<UTF-16>
+from time import perf_counter
+STARTED = perf_counter()  # startup is measured from here, see profile
 import PyQt5
 import sys
 import os
 import platform
-import re
 import shlex
-import signal
-from PyQt5 import uic
+import argparse
+import hashlib
+import importlib.util
 from PyQt5 import QtCore
 from PyQt5.QtCore import QModelIndex, pyqtSignal, pyqtSlot
-from PyQt5.QtGui import QColor, QFont
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QTableWidgetItem,
-                             QTableWidget, QVBoxLayout, QFileSystemModel)
-from ziphandle import ZipHandle
-from autocompiler import CCompiler, MATCompiler
-from subprocess import Popen
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QTableView,
+                             QVBoxLayout, QHBoxLayout, QFileSystemModel,
+                             QListWidget, QAction, QComboBox, QSpinBox)
+from ziphandle import ZipHandle, HW_RE
+from studenttable import SubmissionModel, SubmissionFilter, COLUMNS, \
+    STATUS_FILTERS
+from dirindex import DirIndex
+from console import Console
+from supervisor import ProcessSupervisor
+from results import ResultsStore
+import tracing
 from operator import methodcaller
-from IPython import embed
+# autocompiler, similarity and prebuilt are imported when they are needed
 
+ROOT = os.path.dirname(os.path.abspath(__file__))  # not the working dir
+UI_FILE = os.path.join(ROOT, "gui.ui")
+UI_MODULE = os.path.join(ROOT, "gui_ui.py")  # generated from UI_FILE
 
-class MyTable(QTableWidget):
+
+class MyTable(QTableView):
     dropped_trigger = QtCore.pyqtSignal(str)
 
     def __init__(self, parent):
-        QTableWidget.__init__(self, parent)
+        QTableView.__init__(self, parent)
         self.setAcceptDrops(True)
 
     def dragMoveEvent(self, event):
@@ -36,7 +48,40 @@ class MyTable(QTableWidget):
         self.dropped_trigger(event.mimeData().text())
         event.accept()
 
-Form = uic.loadUiType('gui.ui')[0]  # Load ui
+
+def load_form():
+    """ Class of the form in gui.ui. uic generates its code in gui_ui.py,
+    which is imported on the next starts, and only generated again when
+    gui.ui changes (the sha1 is in the first line)."""
+    with open(UI_FILE, 'rb') as f:
+        header = "# generated from gui.ui {}\n".format(
+            hashlib.sha1(f.read()).hexdigest())
+    try:
+        with open(UI_MODULE, encoding="utf-8") as f:
+            fresh = f.readline() == header
+    except OSError:  # not generated yet
+        fresh = False
+    try:
+        if not fresh:
+            from PyQt5 import uic  # parses the xml, not needed otherwise
+            tmp = "{}.{}".format(UI_MODULE, os.getpid())
+            with open(tmp, 'w', encoding="utf-8") as f:
+                f.write(header)
+                uic.compileUi(UI_FILE, f)
+            os.replace(tmp, UI_MODULE)
+        spec = importlib.util.spec_from_file_location("gui_ui", UI_MODULE)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except OSError:  # e.g. the folder is read only
+        from PyQt5 import uic
+        return uic.loadUiType(UI_FILE)[0]
+    return module.Ui_MainWindow
+
+
+IMPORTED = perf_counter()
+with tracing.span("load_form", "gui"):
+    Form = load_form()  # Load ui
+FORM_LOADED = perf_counter()
 
 
 class MyWindow(QMainWindow, Form):
@@ -49,10 +94,9 @@ class MyWindow(QMainWindow, Form):
 
         # Initializations for the student table on the left
         self.st_table = MyTable(self)
-        self.st_tab_ind = None  # stores the table col. index/text
-        self.persian_font = QFont()  # Holds the persian font for the table
+        self.st_model = SubmissionModel(self)  # rows of the table
+        self.st_filter = SubmissionFilter(self)  # sorted and filtered rows
         self.setup_st_table()
-        QVBoxLayout(self.table_frame).addWidget(self.st_table)
 
         # Initializations for the Terminal in Terminal tab
         self.setup_terminal()
@@ -62,6 +106,9 @@ class MyWindow(QMainWindow, Form):
         self.open_report_push_button.clicked.connect(self.open_report)
         self.compile_push_button.clicked.connect(self.compile_hw)
         self.run_push_button.clicked.connect(self.run_hw)
+        self.cancel_push_button.clicked.connect(self.cancel_build)
+        self.questions_list = QListWidget(self.questions_frame)  # progress
+        QVBoxLayout(self.questions_frame).addWidget(self.questions_list)
         self.prog_type_combo.activated.connect(self.prog_type_changed)
         self.sel_prog_type = self.prog_type_combo.currentText()
 
@@ -70,29 +117,36 @@ class MyWindow(QMainWindow, Form):
         self.setup_folder_tree_view()
 
         # Miscellaneous initializations
-        self.command = ""  # holds the text in console textbox
         self.hw_path = ""  # holds the dropped hw folder path
         self.sel_hw_path = ""  # path of selected hw in the student table
         self.sel_cn = ""  # Selected course name in the cell
         self.sel_hw_num = 0  # hw num of selected cell
         self.sel_st_num = 0  # student number of selected cell
-        self.hw_folders = []  # proper and valid homework folders
-        self.prev_row = -1  # holds the previous selected row of table
+        self.hw_indexes = dict()  # hw folder -> DirIndex built in ZipHandle
+        self.prev_folder = None  # hw folder of the selected row of table
         self.sep = "----------------------------------------------------"
-        self.hw_re = re.compile(r"\A(\w{2})[-_](HW(\d+)[-_](\d{7}))\Z",
-                                re.IGNORECASE)
+        self.hw_re = HW_RE  # format of the zip files and hw folders
         self.sel_folder_index = None  # index of the folder model for treeView
 
         self.zip_thread = None  # will hold the ZipHandle Thread
-
-        # Compiler initializations
-        self.c_comp = CCompiler(None)   # will hold the C Compiler handle
-        self.c_comp.log_trigger.connect(self.compile_box_update)
-        self.mat_compiler = MATCompiler(None)
-        self.mat_compiler.log_trigger.connect(self.compile_box_update)
+        self.zip_workers = os.cpu_count() or 1  # processes extracting zips
+        self.store = None  # ResultsStore of hw_path
+        self.similarity = None  # SimilarityIndex of hw_path
+        self.similarity_thread = None  # FingerprintThread of show_similar
+        self.similar_folder = None  # hw folder to show once it is finished
+
+        # Owns all the child processes, the running ones are shown in the
+        # status bar every second
+        self.supervisor = ProcessSupervisor()
+        self.supervisor.start_reaper()
+        self.process_timer = QtCore.QTimer(self)
+        self.process_timer.timeout.connect(self.show_processes)
+        self.process_timer.start(1000)
+
+        # Compilers are created when they are first needed, see compiler
+        self._compilers = dict()  # class name in autocompiler -> compiler
 
         # OS Specific Initializations
-        self._processes = []  # holds all active processes for Popen
         self._plat = platform.system()  # Linux or Windows
         self.system_arch = platform.machine()  # x86_64 or i386
 
@@ -110,49 +164,112 @@ class MyWindow(QMainWindow, Form):
             self.editor = "/usr/bin/subl --wait"
             self.pdf_viewer = "/usr/bin/evince"
             self.terminal_cmd = None
+            # C++: precompiled standard headers, and the sources given to
+            # the students (a folder, or None) compiled once, see prebuilt
+            self.use_prebuilt = False
+            self.provided_dir = None
         else:
             print("Not a standard OS: use Windows or Linux.")
 
+    def compiler(self, name):
+        """ The compiler of a class of autocompiler, created the first time
+        it is needed: autocompiler is not imported to start the GUI."""
+        if name not in self._compilers:
+            import autocompiler
+            comp = getattr(autocompiler, name)(None)
+            comp.log_trigger.connect(self.compile_box_update)
+            # They work in their threads after start(), see build_finished
+            comp.finished.connect(self.build_finished)
+            comp.supervisor = self.supervisor  # all children in one place
+            if name != "MATCompiler":
+                comp.progress_trigger.connect(self.question_progress)
+            self._compilers[name] = comp
+        return self._compilers[name]
+
+    @property
+    def c_comp(self):  # will hold the C Compiler handle
+        return self.compiler("CCompiler")
+
+    @property
+    def mat_compiler(self):
+        return self.compiler("MATCompiler")
+
+    @property
+    def py_comp(self):
+        return self.compiler("PyCompiler")
+
     def setup_st_table(self):
         """ This function is for setting up the table on the left
-            of the dialogue. All initializations are made here."""
+            of the dialogue. All initializations are made here. The rows
+            are in st_model, the table shows them through st_filter."""
         self.st_table.dropped_trigger = self.process_hw  # file/folder dropped
-        self.st_table.cellClicked.connect(self.hw_clicked)  # a cell is clicked
+        self.st_filter.setSourceModel(self.st_model)
+        self.st_table.setModel(self.st_filter)
+        self.st_table.clicked.connect(self.hw_clicked)  # a cell is clicked
+        self.st_table.setSortingEnabled(True)
+        self.st_table.sortByColumn(-1, QtCore.Qt.AscendingOrder)  # as added
+        self.st_table.verticalHeader().setDefaultSectionSize(24)
 
         self.st_table.setSelectionMode(PyQt5.QtWidgets.QAbstractItemView.
                                        SingleSelection)
         self.st_table.setSelectionBehavior(PyQt5.QtWidgets.QAbstractItemView.
                                            SelectRows)
-        # start out with 5 columns
-        self.st_tab_ind = {"CN": 0, "HW_Num": 1, "St_Num": 2, "St_Name": 3,
-                           "Folders": 4, "Report": 5}
-        self.st_table.setColumnCount(len(self.st_tab_ind))
-        # Now put text for the columns and set width if required
-        self.st_table.setHorizontalHeaderItem(self.st_tab_ind["CN"],
-                                              QTableWidgetItem("CN"))
-        self.st_table.setColumnWidth(self.st_tab_ind["CN"], 30)
-        self.st_table.setHorizontalHeaderItem(self.st_tab_ind["HW_Num"],
-                                              QTableWidgetItem("HW"))
-        self.st_table.setColumnWidth(self.st_tab_ind["HW_Num"], 31)
-        self.st_table.setHorizontalHeaderItem(self.st_tab_ind["St_Num"],
-                                              QTableWidgetItem("St. Num"))
-        self.st_table.setColumnWidth(self.st_tab_ind["St_Num"], 70)
-        self.st_table.setHorizontalHeaderItem(self.st_tab_ind["St_Name"],
-                                              QTableWidgetItem("St. Name"))
-        self.st_table.setColumnWidth(self.st_tab_ind["St_Name"], 105)
-        self.st_table.setHorizontalHeaderItem(self.st_tab_ind["Folders"],
-                                              QTableWidgetItem("Folders"))
-        self.st_table.setColumnWidth(self.st_tab_ind["Folders"], 100)
-        self.st_table.setHorizontalHeaderItem(self.st_tab_ind["Report"],
-                                              QTableWidgetItem("Report"))
-        self.st_table.setColumnWidth(self.st_tab_ind["Report"], 100)
-
-        self.persian_font.setFamily("XW Zar")  # Persian font setup for the table
-        self.persian_font.setPointSize(11)
+        # right click on a row
+        similar_action = QAction("Similar submissions", self.st_table)
+        similar_action.triggered.connect(self.show_similar)
+        self.st_table.addAction(similar_action)
+        self.st_table.setContextMenuPolicy(QtCore.Qt.ActionsContextMenu)
+        for column, (_, width) in enumerate(COLUMNS):
+            self.st_table.setColumnWidth(column, width)
+
+        # Filters above the table: course, hw, build status, min. questions
+        self.course_filter = QComboBox(self.table_frame)
+        self.course_filter.addItem("All CN")
+        self.course_filter.activated.connect(self.filter_changed)
+        self.hw_filter = QComboBox(self.table_frame)
+        self.hw_filter.addItem("All HW")
+        self.hw_filter.activated.connect(self.filter_changed)
+        self.status_filter = QComboBox(self.table_frame)
+        self.status_filter.addItems(STATUS_FILTERS)
+        self.status_filter.activated.connect(self.filter_changed)
+        self.questions_filter = QSpinBox(self.table_frame)
+        self.questions_filter.setPrefix("Questions >= ")
+        self.questions_filter.valueChanged.connect(self.filter_changed)
+        self.st_model.rowsInserted.connect(self.update_filters)
+        filters = QHBoxLayout()
+        for widget in (self.course_filter, self.hw_filter, self.status_filter,
+                       self.questions_filter):
+            filters.addWidget(widget)
+        layout = QVBoxLayout(self.table_frame)
+        layout.addLayout(filters)
+        layout.addWidget(self.st_table)
+
+    @pyqtSlot()
+    def update_filters(self):
+        """ New courses and hw numbers of the table are added to the filters """
+        for combo, values in ((self.course_filter, self.st_model.courses),
+                              (self.hw_filter, self.st_model.hws)):
+            for value in values[combo.count() - 1:]:
+                combo.addItem(value)
+
+    def filter_changed(self, _):
+        self.st_filter.set_filter(
+            "" if self.course_filter.currentIndex() == 0
+            else self.course_filter.currentText(),
+            "" if self.hw_filter.currentIndex() == 0
+            else self.hw_filter.currentText(),
+            self.status_filter.currentText(), self.questions_filter.value())
+
+    def update_statuses(self):
+        """ Build and run columns of the table, from the results store """
+        if self.store is not None:
+            self.st_model.set_statuses(self.store.statuses(
+                self.sel_prog_type))
 
     def setup_terminal(self):
         self.compile_box.setTextColor(QColor(237, 238, 240))
-        self.compile_box.setText("Drag your folder to the table ...")
+        self.console = Console(self.compile_box)  # holds the console text
+        self.console.write("Drag your folder to the table ...")
 
     def setup_folder_tree_view(self):
         self.folder_tree_view.setModel(self.folder_model)
@@ -176,6 +293,7 @@ class MyWindow(QMainWindow, Form):
 
     @pyqtSlot(str)
     def process_hw(self, path):  # path is DROPPED into the table
+        self.cancel_build()  # a build of the previous folder may be running
         self.hw_path = path.strip()  # removes \n etc
         # a little clean up is necessary for the path
         self.hw_path = os.path.normpath(self.hw_path).lstrip("file:")
@@ -183,14 +301,7 @@ class MyWindow(QMainWindow, Form):
             self.hw_path = os.path.join('/', self.hw_path)  # put a / at start
         elif self.is_windows:  # / should be \
             self.hw_path = self.hw_path.replace('/', os.sep).lstrip(os.sep)
-
-        # Update the folder tree table
-        self.folder_model.setRootPath(self.hw_path)
-        self.folder_tree_view.setRootIndex(self.folder_model.index(self.hw_path))
-
-        self.hw_folders.clear()  # clear previous homework folders(if any)
-        self.st_table.clearContents()  # table contents(if any) not col. headers
-        self.command = ""  # reset the console output
+        self.open_hw_path()
 
         if os.path.isfile(path): # TODO: single file HW
             print("Single File is not yet implemented")
@@ -202,33 +313,103 @@ class MyWindow(QMainWindow, Form):
         files.sort()
 
         # Setting up the zip thread
-        self.zip_thread = ZipHandle(self.hw_path, files, self.hw_re)
+        self.zip_thread = ZipHandle(self.hw_path, files, self.hw_re,
+                                    self.zip_workers)
         self.zip_thread.log_trigger.connect(self.compile_box_update)
+        self.zip_thread.fingerprint = (self.similarity.k,
+                                       self.similarity.window)
+        self.zip_thread.known_signatures = self.similarity.signatures()
         self.zip_thread.hw_add_trigger.connect(self.table_hw_add)
+        self.zip_thread.fingerprints_trigger.connect(self.similarity_add)
+        self.zip_thread.finished.connect(self.ingest_finished)
         self.zip_thread.start()
 
-    @pyqtSlot(int, int)
-    def hw_clicked(self, row, _):
-        """ A Cell is clicked, row, col is also passed in here """
-        if row == self.prev_row:  # if double selecting a row, deselect
+    def open_hw_path(self):
+        """ The table, console and folder tree are reset for hw_path and
+        its results store is opened."""
+        # Objects are shared between the students of this hw folder
+        self.c_comp.cache_dir = os.path.join(self.hw_path, ".objcache")
+        if self.is_linux and self.use_prebuilt:
+            from prebuilt import Prebuilt, PREBUILT_DIR
+            self.c_comp.prebuilt = Prebuilt(
+                os.path.join(self.hw_path, PREBUILT_DIR), self.provided_dir)
+
+        # Update the folder tree table
+        self.folder_model.setRootPath(self.hw_path)
+        self.folder_tree_view.setRootIndex(self.folder_model.index(self.hw_path))
+
+        self.hw_indexes.clear()
+        self.st_model.clear()  # rows of the previous homework folder (if any)
+        self.prev_folder = None
+        for combo in (self.course_filter, self.hw_filter):
+            while combo.count() > 1:
+                combo.removeItem(1)
+        self.console.clear()  # reset the console output
+        if self.store is not None:
+            self.store.close()
+        self.store = ResultsStore.open(self.hw_path)
+        from similarity import SimilarityIndex
+        self.similarity = SimilarityIndex.load(self.hw_path)
+
+    @pyqtSlot()
+    def ingest_finished(self):
+        """ The results and fingerprints of the new zip files are saved """
+        self.st_model.flush()
+        self.store.flush()
+        # the students of the zip files deleted since the last time
+        self.similarity.prune(self.st_model.folders())
+        self.similarity.save()
+        self.update_statuses()  # kept if the zip files did not change
+
+    def load_store(self, path):
+        """ Fills the table from the results store of a hw folder, e.g. when
+        the program starts, the zip files are not extracted again. Dropping
+        the folder updates it."""
+        if not ResultsStore.exists(path):
+            self.compile_box_update("No results recorded in {}".format(path))
+            return
+        self.hw_path = os.path.normpath(path)
+        self.open_hw_path()
+        self.compile_box_update(self.hw_path)
+        for submission in self.store.submissions():
+            if os.path.isdir(os.path.join(self.hw_path, submission["folder"])):
+                self.table_row_add(submission["folder"], submission["dirs"],
+                                   submission["pdfs"])
+        self.st_model.flush()  # all rows at once
+        self.update_statuses()
+        self.compile_box_update("{} homeworks loaded from {}".format(
+            len(self.st_model), os.path.basename(self.store.path)))
+
+    def selected_row(self):
+        """ Row of the selected hw in st_model, None if none is selected """
+        index = self.st_table.currentIndex()
+        if not index.isValid() or self.prev_folder is None:
+            return None
+        return self.st_filter.mapToSource(index).row()
+
+    @pyqtSlot(QModelIndex)
+    def hw_clicked(self, index):
+        """ A Cell is clicked, index is in st_filter """
+        row = self.st_filter.mapToSource(index).row()
+        hw_folder = self.st_model.folder(row)
+        if hw_folder == self.prev_folder:  # if double selecting, deselect
             self.st_table.clearSelection()
-            self.prev_row = -1
+            self.prev_folder = None
             self.enable_config(False)
             return
         else:
-            self.prev_row = row
+            self.prev_folder = hw_folder
 
         # We use this event handler since it does similar thing
         self.closeEvent(None)
 
-        # Retrieve other information of the hw from different columns
-        self.sel_cn = self.st_table.item(row, self.st_tab_ind["CN"]).text()
-        self.sel_hw_num = self.st_table.item(row, self.st_tab_ind["HW_Num"]).text()
-        self.sel_st_num = self.st_table.item(row, self.st_tab_ind["St_Num"]).text()
+        # Retrieve other information of the hw from the model
+        self.sel_cn = self.st_model.course(row)
+        self.sel_hw_num = self.st_model.hw(row)
+        self.sel_st_num = self.st_model.student(row)
 
         # This part updates the folder tree
-        self.sel_hw_path = os.path.join(self.hw_path, "{}-HW{}-{}".format(
-            self.sel_cn, self.sel_hw_num, self.sel_st_num))
+        self.sel_hw_path = os.path.join(self.hw_path, hw_folder)
         folder_index = self.folder_model.index(self.sel_hw_path)
         self.folder_tree_view.collapseAll()
         self.folder_tree_view.expand(folder_index)  # triggers expanded
@@ -240,61 +421,135 @@ class MyWindow(QMainWindow, Form):
     def open_code(self):
         """ This event handler is run whenever user clicks open code button"""
         # TODO: Add support for the editor if in other directories
-        p = Popen(shlex.split(self.editor + ' "' + self.sel_hw_path + '"'),
-                  shell=False, start_new_session=True)  # open code editor
-        self._processes.append(p)
+        self.supervisor.spawn(shlex.split(
+            self.editor + ' "' + self.sel_hw_path + '"'), "editor")
 
     @pyqtSlot()
     def open_report(self):
-        row = self.st_table.currentRow()
-        sel_rep_name = self.st_table.item(row, self.st_tab_ind["Report"]).text()
+        row = self.selected_row()
+        if row is None:
+            return
+        sel_rep_name = self.st_model.report(row)
         if sel_rep_name == "N/A":
             self.compile_box_update("Can not find report file.")
             return
         sel_report_path = os.path.join(self.sel_hw_path, sel_rep_name)
         pdf_cmd = shlex.split(self.pdf_viewer)
         pdf_cmd.extend([sel_report_path])
-        p = Popen(pdf_cmd, shell=False, start_new_session=True)  # open pdf
-        self._processes.append(p)
+        self.supervisor.spawn(pdf_cmd, "pdf")  # open pdf
 
     @pyqtSlot(int)
     def prog_type_changed(self, index):
         self.sel_prog_type = self.prog_type_combo.currentText()
-        if self.sel_prog_type != "C++":  # No compilation step except C++
+        self.update_statuses()  # statuses are per programming language
+        # No compilation step except C++, python only has a syntax check
+        if self.sel_prog_type not in ("C++", "Python"):
             self.compile_push_button.setVisible(False)
         else:
             self.compile_push_button.setVisible(True)
 
     @pyqtSlot()
     def compile_hw(self):  # Compile push button is clicked
-        """ In this function the selected hw path is compiled. """
+        """ In this function the selected hw path is compiled. The compiler
+        works in its own thread, the buttons are enabled when it finishes.
+        Only what has changed is built again, unless shift is held down."""
         if self.sel_prog_type == "C++":
-            self.c_comp.change_root(self.sel_hw_path)
-            self.compile_box_update("{}: C++".format(os.path.basename(
-                self.sel_hw_path)))
-            self.compile_box_update("Generating Makefile if needed ...")
-            self.c_comp.generate_makefiles()
-            self.compile_box_update("\nCompiling the Questions, Wait ...")
-            self.c_comp.compile()  # compiles all the folders with proper C++
-        elif self.sel_prog_type == "Matlab":
-            pass
-        elif self.sel_prog_type == "Python":
-            pass
+            comp = self.c_comp
+        elif self.sel_prog_type == "Python":  # only a syntax check
+            comp = self.py_comp
+        else:
+            return
+        comp.change_root(self.sel_hw_path, self.sel_hw_index())
+        if comp is self.c_comp:  # shift + click: make clean first
+            comp.clean_build = bool(QApplication.keyboardModifiers() &
+                                    QtCore.Qt.ShiftModifier)
+        self.compile_box_update("{}: {}".format(os.path.basename(
+            self.sel_hw_path), self.sel_prog_type))
+        self.questions_list.clear()
+        self.set_running(True)
+        comp.start()  # generates the makefiles and compiles in comp.run
+
+    def set_running(self, yes):
+        """ Only cancel is enabled while a compiler thread is running """
+        self.enable_config(not yes and self.prev_folder is not None)
+        self.cancel_push_button.setEnabled(yes)
+
+    @pyqtSlot()
+    def cancel_build(self):
+        """ Stops the running compiler thread, kills its make processes and
+        waits for it. Also used when another row is selected."""
+        for comp in self._compilers.values():  # the ones created
+            if comp.isRunning():
+                comp.cancel()
+                comp.wait()  # does not take long, the processes are killed
+                self.compile_box_update("Cancelled.")
+
+    @pyqtSlot()
+    def build_finished(self):
+        self.set_running(False)
+        self.record_builds(self.sender())
+        self.update_statuses()
+        self.compile_box_update("{0}\n{0}".format(self.sep))
+
+    def record_builds(self, comp):
+        """ Status of each question of a finished build in the store """
+        hw_folder = os.path.basename(comp.root or "")
+        if self.store is None or comp.cancelled or \
+                os.path.dirname(comp.root) != self.hw_path or \
+                comp not in (self.c_comp, self.py_comp):
+            return
+        prog_type = "C++" if comp is self.c_comp else "Python"
+        self.store.forget(hw_folder, prog_type, "build")
+        if comp is self.c_comp:
+            for r in comp.build_results:
+                target = comp.find_target(r["path"])
+                self.store.record_build(
+                    hw_folder, prog_type, os.path.relpath(r["path"], comp.root),
+                    comp.build_status(r), r["returncode"], r["duration"],
+                    r["out"] + r["err"], "" if target is None
+                    else os.path.relpath(target, comp.root))
+        else:
+            for script in comp.script_files:
+                errors = [e for f, e in comp.syntax_errors.items()
+                          if os.path.dirname(f) == os.path.dirname(script)]
+                self.store.record_build(
+                    hw_folder, prog_type, os.path.relpath(
+                        os.path.dirname(script), comp.root),
+                    "Syntax error" if len(errors) > 0 else "OK",
+                    target=os.path.relpath(script, comp.root),
+                    message=comp.syntax_errors.get(script, ""),
+                    counts=(len(errors), 0))
+        self.store.mark_done(hw_folder, prog_type, "build")
+        self.store.flush()
+
+    @pyqtSlot(str, str)
+    def question_progress(self, question, status):
+        """ Shows the status of each question of the running build """
+        text = "{}: {}".format(question, status)
+        items = self.questions_list.findItems(question + ":",
+                                              QtCore.Qt.MatchStartsWith)
+        if len(items) > 0:
+            items[0].setText(text)
+        else:
+            self.questions_list.addItem(text)
 
     @pyqtSlot()
     def run_hw(self):
         """ This function is run when user clicks on Run button """
         if self.sel_prog_type == "C++":
             comp = self.c_comp
-        elif self.sel_prog_type == "Python": # comp = self.py_comp
-            pass
-        elif self.sel_prog_type == "Matlab":
-            comp = self.mat_compiler
-            comp.change_root(self.sel_hw_path)
-            script_files = self.mat_compiler.search_scripts()
-            if len(script_files) == 0:
+        elif self.sel_prog_type == "Python":
+            comp = self.py_comp
+            comp.change_root(self.sel_hw_path, self.sel_hw_index())
+            if len(comp.search_scripts()) == 0:
                 self.compile_box_update("Did not find any script to run.")
                 return
+        elif self.sel_prog_type == "Matlab":  # scripts are found in thread
+            self.mat_compiler.change_root(self.sel_hw_path,
+                                          self.sel_hw_index())
+            self.set_running(True)
+            self.mat_compiler.start()
+            return
 
         self.compile_box_update("{}: Execute".format(self.sel_prog_type))
         comp.exec()  # execute proper compiler
@@ -317,91 +572,158 @@ class MyWindow(QMainWindow, Form):
             return
         if self.is_linux:
             if path.lower().endswith(".pdf"):
-                p = Popen(shlex.split(self.pdf_viewer + "\"" + path + "\""),
-                          shell=False, start_new_session=True)
-                self._processes.append(p)
-
-    def table_hw_add(self, hw_folder):
-        self.hw_folders.append(hw_folder)
-        hw_ls = os.listdir(os.path.join(self.hw_path, hw_folder))
-        hw_dirs = [item for item in hw_ls if
-                   os.path.isdir(os.path.join(self.hw_path, hw_folder, item))]
-        hw_files = [item for item in hw_ls if
-                   os.path.isfile(os.path.join(self.hw_path, hw_folder, item))]
-        course_name, file_name, hw_num, st_num = self.hw_re.match(
-            hw_folder).groups()
-
-        cur_row = len(self.hw_folders) - 1
-        self.st_table.insertRow(cur_row)
-        self.st_table.setItem(cur_row, self.st_tab_ind["CN"],
-                              QTableWidgetItem(course_name))  # hw_num
-        self.st_table.item(cur_row, self.st_tab_ind["CN"]).\
-            setTextAlignment(QtCore.Qt.AlignCenter)
-        self.st_table.setItem(cur_row, self.st_tab_ind["HW_Num"],
-                              QTableWidgetItem(hw_num))  # hw_num
-        self.st_table.item(cur_row, self.st_tab_ind["HW_Num"]).\
-            setTextAlignment(QtCore.Qt.AlignCenter)
-        self.st_table.setItem(cur_row, self.st_tab_ind["St_Num"],
-                              QTableWidgetItem(st_num))  # st_num
-        self.st_table.item(cur_row, self.st_tab_ind["St_Num"]). \
-            setTextAlignment(QtCore.Qt.AlignCenter)
-        st_name_item = QTableWidgetItem("وارد نشده است")
-        st_name_item.setFont(self.persian_font)
-        self.st_table.setItem(cur_row, self.st_tab_ind["St_Name"], st_name_item)
-        self.st_table.item(cur_row, self.st_tab_ind["St_Name"]). \
-            setTextAlignment(QtCore.Qt.AlignHCenter)
-
-        # ignore chars from the homework folder names in the table,
-        # e.g.: Q1, Q2 -> 1, 2
-        if len(hw_dirs) > 0:
-            hw_dirs_str = ' '.join(hw_dirs)
-            hw_dirs_str = [c for c in hw_dirs_str if not c.isalpha()]
-            hw_dirs_str.sort()
-            hw_dirs_str = ' '.join(hw_dirs_str)  # convert back to str
-        else:
-            hw_dirs_str = "N/A"
-        self.st_table.setItem(cur_row, self.st_tab_ind["Folders"],
-                              QTableWidgetItem(hw_dirs_str)) # hw folders
-
-        # Finding the report file name and store in report_file variable
-        if len(hw_files) > 0:
-            # filter out non pdf files
-            hw_files = [f for f in hw_files if f.lower().endswith(".pdf")]
-            if len(hw_files) > 1:
-                self.compile_box_update("{}: multiple PDFs".format(hw_folder))
-            if len(hw_files) > 0:  # can be greater than 1, only output one
-                report_file = hw_files[0]
-            else:
-                report_file = "N/A"
-        else:   # No report file available
-            report_file = "N/A"
-        self.st_table.setItem(cur_row, self.st_tab_ind["Report"],
-                              QTableWidgetItem(report_file))
-        #QApplication.instance().processEvents()
+                self.supervisor.spawn(shlex.split(
+                    self.pdf_viewer + "\"" + path + "\""), "pdf")
+
+    def sel_hw_index(self):
+        """ DirIndex of the selected hw, scanned again before every compile
+        or run: files may have been added or renamed after the ingest, e.g.
+        with Open code. It is cheap, only the ingest uses the old one."""
+        index = DirIndex.build(self.sel_hw_path)
+        self.hw_indexes[os.path.basename(self.sel_hw_path)] = index
+        return index
+
+    def table_hw_add(self, hw_folder, index, zip_hash):
+        """ index is the DirIndex of the hw folder, no need to list it """
+        self.hw_indexes[hw_folder] = index
+        if self.store is not None:  # flushed when the zip thread finishes
+            self.store.record_ingest(hw_folder, "ok", zip_hash, index)
+        self.table_row_add(hw_folder, [d.name for d in index.dirs],
+                           index.with_ext(".pdf"))
+
+    def table_row_add(self, hw_folder, hw_dirs, hw_files):
+        """ hw_dirs are the names of the sub folders, hw_files of the pdfs.
+        The row is shown with the next batch of st_model."""
+        if len(hw_files) > 1:
+            self.compile_box_update("{}: multiple PDFs".format(hw_folder))
+        self.st_model.append(hw_folder, hw_dirs, hw_files)
+
+    def similarity_add(self, hw_folder, entry):
+        """ entry is the student_entry computed by ZipHandle """
+        self.similarity.add_entry(hw_folder, entry)  # only if changed
+
+    @pyqtSlot()
+    def show_similar(self):
+        """ Students with the most similar code in each question of the
+        selected row, from the SimilarityIndex. The students missing in it
+        (e.g. the table was loaded from the store) are fingerprinted in a
+        FingerprintThread first."""
+        index = self.st_table.currentIndex()
+        if not index.isValid():
+            return
+        self.similar_folder = self.st_model.folder(
+            self.st_filter.mapToSource(index).row())
+        if self.similarity_thread is not None and \
+                self.similarity_thread.isRunning():
+            return  # shown once it is finished
+        missing = [f for f in self.st_model.folders()
+                   if f not in self.similarity]
+        if len(missing) == 0:
+            self.similar_report(self.similar_folder)
+            return
+        from similarity import FingerprintThread
+        self.compile_box_update("Similarity: reading {} students".format(
+            len(missing)))
+        self.similarity_thread = FingerprintThread(
+            self.hw_path, missing, self.similarity.k, self.similarity.window,
+            self.similarity.signatures(), self.zip_workers)
+        self.similarity_thread.log_trigger.connect(self.compile_box_update)
+        self.similarity_thread.entries_trigger.connect(self.similarity_done)
+        self.similarity_thread.start()
+
+    def similarity_done(self, entries):
+        """ entries of the FingerprintThread, hw folder -> student_entry """
+        if self.similarity_thread.root != self.hw_path:
+            return  # another hw folder was opened meanwhile
+        for hw_folder, entry in entries.items():
+            self.similarity.add_entry(hw_folder, entry)
+        self.similarity.save()
+        self.similar_report(self.similar_folder)
+
+    def similar_report(self, hw_folder):
+        matches = self.similarity.query(hw_folder)
+        if len(matches) == 0:
+            self.compile_box_update("{}: No similar submission found.".format(
+                hw_folder))
+            return
+        lines = ["{}: Similar submissions".format(hw_folder)]
+        for question, other, similarity, shared in matches:
+            lines.append("  Q{}: {} {:.0f}% ({} fingerprints)".format(
+                question, other, 100 * similarity, shared))
+        self.compile_box_update("\n".join(lines))
 
     def compile_box_update(self, text):
         if text == "":  # Ignore input
             return
-        self.command += text + "\n"
-        self.compile_box.setText(self.command)
-        self.compile_box.moveCursor(PyQt5.QtGui.QTextCursor.End)
-        QApplication.instance().processEvents()
+        with tracing.span("MyWindow.compile_box_update", "gui",
+                          chars=len(text)):
+            self.console.write(text)  # shown in the next frame of the console
+
+    def show_processes(self):
+        """ Number of the running children by group and the oldest one """
+        counts = self.supervisor.counts()
+        if len(counts) == 0:
+            self.statusbar.clearMessage()
+            return
+        group, _, _, seconds = self.supervisor.durations()[0]
+        self.statusbar.showMessage("Running: {} (oldest: {} {:.0f} s)".format(
+            ", ".join("{} {}".format(n, g) for g, n in sorted(counts.items())),
+            group, seconds))
 
     # This is called wihen the dialog is closed by pressing x
     def closeEvent(self, event):
-        self.c_comp.kill_windows()
-        self.mat_compiler.kill_windows()
-        if self.is_linux:
-            for p in self._processes:
-                os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-            self._processes.clear()
-        elif self.is_windows: # TODO: Add support for windows
-            pass
+        self.cancel_build()  # running compilers are stopped first
+        for comp in self._compilers.values():
+            comp.kill_windows()
+        if "MATCompiler" in self._compilers:
+            self.mat_compiler.close_pool()
+        if event is None:  # another row is selected
+            self.supervisor.kill_group("editor")
+            self.supervisor.kill_group("pdf")
+        else:  # the window is closed, nothing is left behind
+            self.supervisor.kill_all()
+            if self.store is not None:
+                self.store.close()
+                self.store = None
         # TODO: delete folders created in the program, only keep zip files
 
 
-
-app = QApplication(sys.argv)
-window = MyWindow()
-window.show()
-sys.exit(app.exec_())
+def print_startup(steps):
+    """ steps is a list of (name, perf_counter at its end), the first one
+    is STARTED. The time of python itself before main.py is not included."""
+    lines = ["Startup:"]
+    for (_, t0), (name, t1) in zip(steps, steps[1:]):
+        lines.append("  {:<12} {:7.1f} ms".format(name, 1000 * (t1 - t0)))
+    lines.append("  {:<12} {:7.1f} ms".format("total", 1000 * (
+        steps[-1][1] - steps[0][1])))
+    lines.append("  not imported: {}".format(", ".join(
+        m for m in ("autocompiler", "similarity", "prebuilt", "PyQt5.uic")
+        if m not in sys.modules) or "-"))
+    print("\n".join(lines), file=sys.stderr)
+
+
+# The guard is needed, worker processes of ZipHandle may import this module
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Automated Homework Correction")
+    parser.add_argument("folder", nargs="?", default=None,
+                        help="homework folder, loaded from its results store")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print the time of each startup step and exit")
+    args, qt_args = parser.parse_known_args()  # the rest is for Qt
+    steps = [("", STARTED), ("imports", IMPORTED), ("ui form", FORM_LOADED)]
+    app = QApplication(sys.argv[:1] + qt_args)
+    steps.append(("application", perf_counter()))
+    window = MyWindow()
+    steps.append(("window", perf_counter()))
+    if args.folder is not None:  # e.g. python main.py hw_folder
+        window.load_store(os.path.abspath(args.folder))
+        steps.append(("load store", perf_counter()))
+    window.show()
+    if args.profile_startup:  # when the event loop starts, after show
+        def report():
+            steps.append(("first frame", perf_counter()))
+            print_startup(steps)
+            app.quit()
+        QtCore.QTimer.singleShot(0, report)
+    sys.exit(app.exec_())
@@ -0,0 +1,247 @@
+""" Warm MATLAB-like interpreters for running the scripts of many students.
+Starting matlab takes seconds, so a few interpreters are started once and the
+scripts are sent to their stdin one after another. Before each script the
+workspace is cleared and the folder of the script is made current, then the
+script is run inside try/catch and a marker is printed to stdout and stderr,
+so that its output and errors can be told apart from those of the next one.
+GNU Octave (--no-gui) is used if it is installed, otherwise matlab.
+An interpreter is restarted after max_scripts scripts, when it crashes (e.g.
+the script calls exit) or when a script takes longer than timeout (e.g. it
+waits for input).
+"""
+import os
+import queue
+import shutil
+import signal
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+from threading import Thread, Lock
+from time import time as epoch_time
+
+OCTAVE_CMD = ["octave", "--no-gui", "--quiet", "--norc", "--no-history"]
+MATLAB_CMD = ["matlab", "-nodesktop", "-nosplash", "-nodisplay"]
+MAX_SAVED_OUTPUT = 4096  # chars of stdout/stderr kept in the results
+
+
+def default_command():
+    """ Command of the interpreter found in PATH, None if there is none """
+    for cmd in (OCTAVE_CMD, MATLAB_CMD):
+        if shutil.which(cmd[0]) is not None:
+            return cmd
+    return None
+
+
+def quote(text):
+    """ MATLAB string literal """
+    return "'" + text.replace("'", "''") + "'"
+
+
+class Interpreter:
+    """ One running interpreter. run() sends a script and waits for its
+    markers, the interpreter is dead after a timeout or a crash."""
+
+    def __init__(self, cmd, startup_timeout=120):
+        self.cmd = cmd
+        self.scripts_run = 0
+        self.alive = True
+        self._eof = False  # the interpreter closed its output, it crashed
+        self._token = uuid.uuid4().hex  # the scripts can not print it
+        self._lines = queue.Queue()  # (stream name, line or None at EOF)
+        t = epoch_time()
+        self._p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                        start_new_session=os.name == "posix")
+        for name, pipe in (("stdout", self._p.stdout),
+                           ("stderr", self._p.stderr)):
+            Thread(target=self._read, args=(name, pipe), daemon=True).start()
+        self._send(self._marker_code(quote("ready")))
+        if self._wait(epoch_time() + startup_timeout) is None:
+            self.close()
+            raise RuntimeError("{} did not start".format(cmd[0]))
+        self.startup_time = epoch_time() - t
+
+    def _read(self, name, pipe):
+        for line in iter(pipe.readline, b''):
+            self._lines.put((name, line.decode(errors='replace')))
+        self._lines.put((name, None))
+
+    def _send(self, code):
+        try:
+            self._p.stdin.write(code.encode())
+            self._p.stdin.flush()
+        except (BrokenPipeError, OSError):  # it is dead, _wait sees the EOF
+            pass
+
+    def _marker_code(self, status):
+        """ Prints the token and status (a MATLAB expression) to both. The
+        last output may not end with a newline, e.g. fprintf('x=%d', x), so
+        _wait finds the token anywhere in a line."""
+        marker = "[{} {}]".format(quote(self._token + ":"), status)
+        return ("if exist('OCTAVE_VERSION', 'builtin'), fflush(stdout); "
+                "fflush(stderr); end\n"
+                "disp({0}); fprintf(2, '%s\\n', {0});\n".format(marker))
+
+    def _wait(self, deadline):
+        """ Lines until the markers of both streams, None on timeout or EOF.
+        Returns (status, stdout lines, stderr lines)."""
+        outputs = {"stdout": [], "stderr": []}
+        status = None
+        done = set()
+        while len(done) < 2:
+            try:
+                name, line = self._lines.get(
+                    timeout=max(0.0, deadline - epoch_time()))
+            except queue.Empty:
+                return None
+            if line is None:  # crashed or exited
+                self._eof = True
+                return None
+            text = line.rstrip("\r\n")
+            while text.startswith(">> "):  # prompts of matlab
+                text = text[3:]
+            pos = text.find(self._token + ":")
+            if pos >= 0:
+                status = text[pos + len(self._token) + 1:]
+                done.add(name)
+                if pos > 0:  # output without a newline at its end
+                    outputs[name].append(text[:pos])
+            else:
+                outputs[name].append(text)
+        return status, outputs["stdout"], outputs["stderr"]
+
+    def run(self, script, timeout):
+        """ Returns a dict with status (ok, error, timeout or crash),
+        duration, stdout and stderr."""
+        code = ("clear all; close all;\n"
+                "cd({});\n"
+                "try\n"
+                "  run({});\n"
+                "  autocompiler_status = 'ok';\n"
+                "catch autocompiler_err\n"
+                "  fprintf(2, '%s\\n', autocompiler_err.message);\n"
+                "  autocompiler_status = 'error';\n"
+                "end\n").format(quote(os.path.dirname(script)),
+                                quote(os.path.basename(script)))
+        code += self._marker_code("autocompiler_status")
+        t = epoch_time()
+        self.scripts_run += 1
+        self._send(code)
+        received = self._wait(t + timeout)
+        result = {"status": "", "duration": round(epoch_time() - t, 3),
+                  "stdout": "", "stderr": ""}
+        if received is None:
+            result["status"] = "crash" if self._eof else "timeout"
+            self.close()
+            return result
+        status, out, err = received
+        result["status"] = status
+        result["stdout"] = "\n".join(out)[-MAX_SAVED_OUTPUT:]
+        result["stderr"] = "\n".join(err)[-MAX_SAVED_OUTPUT:]
+        return result
+
+    def close(self, timeout=5):
+        """ Asks the interpreter to exit, kills its group after timeout s """
+        self.alive = False
+        if self._p.poll() is None:
+            self._send("exit\n")
+            try:
+                self._p.wait(timeout)
+            except Exception:  # TimeoutExpired
+                try:
+                    if os.name == "posix":
+                        os.killpg(self._p.pid, signal.SIGKILL)
+                    else:
+                        self._p.kill()
+                except ProcessLookupError:
+                    pass
+                self._p.wait()
+        for pipe in (self._p.stdin, self._p.stdout, self._p.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+
+class InterpreterPool:
+    """ size interpreters running the scripts in parallel. They are kept
+    between the calls of run, close() stops them."""
+
+    def __init__(self, cmd=None, size=2, max_scripts=50, timeout=60,
+                 log=None):
+        self.cmd = cmd if cmd is not None else default_command()
+        self.size = max(1, size)
+        self.max_scripts = max_scripts  # restarted after that many scripts
+        self.timeout = timeout  # s, for each script
+        self.log = log if log is not None else lambda text: None
+        self._idle = []  # warm interpreters waiting for the next run
+        self._lock = Lock()
+
+    def run(self, scripts, root=None):
+        """ Runs the scripts (full paths), returns path -> result of
+        Interpreter.run. The log shows the paths relative to root."""
+        if self.cmd is None:
+            self.log("No octave or matlab found, the scripts are not run.")
+            return dict()
+        jobs = queue.Queue()
+        for script in scripts:
+            jobs.put(script)
+        results = dict()
+        messages = queue.Queue()  # logged by this thread, e.g. for signals
+        n_workers = min(self.size, len(scripts))
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+            futures = [pool.submit(self._work, jobs, results, messages, root)
+                       for _ in range(n_workers)]
+            while not all(f.done() for f in futures) or \
+                    not messages.empty():
+                try:
+                    self.log(messages.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+            for future in futures:
+                future.result()  # errors of the workers are raised here
+        return {s: results[s] for s in scripts if s in results}
+
+    def _work(self, jobs, results, messages, root):
+        interp = None
+        with self._lock:
+            if len(self._idle) > 0:
+                interp = self._idle.pop()
+        while True:
+            try:
+                script = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if interp is None or not interp.alive:
+                try:
+                    interp = Interpreter(self.cmd)
+                except (OSError, RuntimeError) as e:
+                    results[script] = {"status": "crash", "duration": 0.0,
+                                       "stdout": "", "stderr": str(e)}
+                    messages.put("{}: {}".format(script, e))
+                    interp = None
+                    continue
+                messages.put("{} started in {:.1f} s".format(
+                    self.cmd[0], interp.startup_time))
+            result = interp.run(script, self.timeout)
+            results[script] = result
+            messages.put(self._message(script, result, root))
+            if interp.alive and interp.scripts_run >= self.max_scripts:
+                interp.close()
+        if interp is not None and interp.alive:
+            with self._lock:
+                self._idle.append(interp)
+
+    def _message(self, script, result, root):
+        rel = script if root is None else os.path.relpath(script, root)
+        text = "{}: {} in {:.1f} s".format(
+            rel, result["status"].capitalize(), result["duration"])
+        output = (result["stdout"] + "\n" + result["stderr"]).strip()
+        if output != "":  # the last lines, e.g. the error
+            text += "\n" + "\n".join(output.splitlines()[-10:])
+        return text
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for interp in idle:
+            interp.close()
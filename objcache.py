@@ -0,0 +1,164 @@
+""" Content addressed object cache shared by all the students of a homework.
+The Makefiles generated by CCompiler call this script instead of g++:
+    python objcache.py CACHE_DIR MAX_SIZE g++ -std=c++17 -c src/a.cpp -o obj/a.o
+The source is preprocessed first and the key is the sha1 of the compiler,
+the flags and the preprocessed source. If the key is in CACHE_DIR the object
+(and the warnings of the first compilation) are copied from there, otherwise
+the source is compiled and stored. When CACHE_DIR gets larger than MAX_SIZE
+bytes the least recently used objects are deleted. The cache is only scanned
+for that once a tenth of MAX_SIZE was stored since the last time (counted in
+CACHE_DIR/.added), so it can be up to 10% larger. Every compilation prints
+"objcache: hit <source>" or "objcache: miss <source>" for the compile log.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HIT_MSG = "objcache: hit"
+MISS_MSG = "objcache: miss"
+ADDED_NAME = ".added"  # bytes stored since the last evict, one line per miss
+EVICT_FRACTION = 0.1  # of max_size stored before the cache is scanned
+
+
+def parse_args(args):
+    """ Returns (source, output, flags) of a gcc compile command or None if
+        this is not compiling exactly one source to an object file."""
+    if "-c" not in args or "-o" not in args:
+        return None
+    flags = []
+    sources = []
+    output = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-o" and i + 1 < len(args):
+            output = args[i + 1]
+            i += 2
+            continue
+        elif arg == "-c":
+            pass
+        elif arg.lower().endswith((".cpp", ".cc", ".cxx", ".c")):
+            sources.append(arg)
+        else:
+            flags.append(arg)
+        i += 1
+    if len(sources) != 1 or output is None:
+        return None
+    return sources[0], output, flags
+
+
+def cache_key(compiler, source, flags):
+    """ sha1 of the preprocessed source, line markers are removed, so that
+        the same code in different folders has the same key. Returns None if
+        the preprocessor fails, the compiler then reports the error."""
+    p = subprocess.run([compiler] + flags + ["-E", source],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode != 0:
+        return None
+    sha = hashlib.sha1()
+    compiler_path = shutil.which(compiler) or compiler
+    try:  # a new compiler version invalidates the cache
+        sha.update("{} {}\n".format(
+            compiler_path, os.stat(compiler_path).st_mtime_ns).encode())
+    except OSError:
+        sha.update(compiler_path.encode())
+    sha.update(" ".join(flags).encode() + b"\n")
+    for line in p.stdout.splitlines():
+        if not line.startswith(b"# "):  # line markers contain the paths
+            sha.update(line + b"\n")
+    return sha.hexdigest()
+
+
+def store(path, data_path):
+    """ Copies data_path into the cache without half written files """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    shutil.copyfile(data_path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def added(cache_dir, size):
+    """ Counts size bytes stored, returns the bytes stored since the last
+        evict. Small appends are atomic, so many makes can share it."""
+    with open(os.path.join(cache_dir, ADDED_NAME), 'a+') as f:
+        f.write("{}\n".format(size))
+        f.seek(0)
+        return sum(int(line) for line in f if line.strip().isdigit())
+
+
+def evict(cache_dir, max_size):
+    """ Deletes the least recently used objects until the cache is smaller
+        than 90% of max_size. mtime is updated on every hit."""
+    try:  # counted again from now on
+        os.remove(os.path.join(cache_dir, ADDED_NAME))
+    except FileNotFoundError:  # another make is evicting too
+        pass
+    entries = []
+    total = 0
+    for sub_dir in os.scandir(cache_dir):
+        if not sub_dir.is_dir():
+            continue
+        for entry in os.scandir(sub_dir.path):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+    if total <= max_size:
+        return
+    entries.sort()  # oldest first
+    for _, size, path in entries:
+        if total <= 0.9 * max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # removed by another make
+            pass
+        total -= size
+
+
+def main(argv):
+    cache_dir, max_size, compiler = argv[0], int(argv[1]), argv[2]
+    args = argv[3:]
+    parsed = parse_args(args)
+    if parsed is None:  # e.g. linking, nothing to cache
+        return subprocess.call([compiler] + args)
+    source, output, flags = parsed
+    key = cache_key(compiler, source, flags)
+    if key is None:
+        return subprocess.call([compiler] + args)
+
+    obj_path = os.path.join(cache_dir, key[:2], key + ".o")
+    err_path = os.path.join(cache_dir, key[:2], key + ".stderr")
+    if os.path.isfile(obj_path) and os.path.isfile(err_path):
+        try:
+            shutil.copyfile(obj_path, output)
+            os.utime(obj_path)  # recently used
+            with open(err_path, 'r') as f:
+                sys.stderr.write(f.read())  # warnings of the first compile
+            print("{} {}".format(HIT_MSG, source))
+            return 0
+        except FileNotFoundError:  # evicted meanwhile, compile it
+            pass
+
+    p = subprocess.run([compiler] + args, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    sys.stderr.write(p.stderr)
+    print("{} {}".format(MISS_MSG, source))
+    if p.returncode != 0:
+        return p.returncode
+    os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', delete=False) as f:
+        f.write(p.stderr)
+    store(err_path, f.name)
+    os.remove(f.name)
+    store(obj_path, output)  # .o after .stderr, a hit needs both
+    size = os.path.getsize(output) + len(p.stderr.encode())
+    if added(cache_dir, size) > EVICT_FRACTION * max_size:
+        evict(cache_dir, max_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,174 @@
+""" Precompiled header and instructor objects shared by all the students of a
+homework, used by the Makefiles of CCompiler if its prebuilt is set (opt-in,
+linux and g++ only). Both are built once in cache_dir by prepare():
+    pch/<key>/pch.h.gch: the standard headers of HEADERS, key is the sha1 of
+        the toolchain, the flags and the headers. The Makefiles compile with
+        -include pch.h, so g++ loads the .gch instead of parsing them again.
+    obj/<key>.o: each .cpp of the instructor folder (the provided sources),
+        key is the sha1 of the toolchain, the flags, the source and the
+        headers it includes. A student source with the same key is copied
+        from there instead of compiled.
+The .gch is only used by g++ if the flags are the same, CXX_FLAGS must match
+the code generation flags in the CXXFLAGS line of the generated Makefiles.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+from subprocess import PIPE, DEVNULL
+from threading import Lock
+import tracing
+from autocompiler import IncludeIndex
+
+HEADERS = ["iostream", "string", "vector"]  # in nearly every submission
+CXX_FLAGS = ["-std=c++17", "-g"]  # as CXXFLAGS of CCompiler._write_makefile
+PCH_NAME = "pch.h"
+PREBUILT_DIR = ".prebuilt"  # cache_dir, in the root of the zip files
+
+
+def _sha1_file(h, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+
+
+class Prebuilt:
+    """ One per homework folder, shared by the compilers of all the students
+    (also from many threads). Nothing is built before prepare()."""
+
+    def __init__(self, cache_dir, instructor_dir=None, compiler="g++",
+                 headers=None):
+        self.cache_dir = cache_dir
+        self.instructor_dir = instructor_dir  # provided sources, None if not
+        self.compiler = compiler
+        self.flags = list(CXX_FLAGS)
+        self.headers = list(HEADERS if headers is None else headers)
+        self.pch = None  # full path of pch.h once its .gch is built
+        self.objects = dict()  # key -> full path of a prebuilt object
+        self._names = set()  # file names of the provided sources
+        self._key = None  # toolchain, flags and pch, part of every key
+        self._lock = Lock()
+        self._prepared = False
+
+    def toolchain(self):
+        """ Path and version of the compiler, e.g. after an update the old
+        .gch and objects are not used anymore."""
+        path = shutil.which(self.compiler)
+        if path is None:
+            raise OSError("{} not found".format(self.compiler))
+        version = subprocess.run([path, "--version"], stdout=PIPE,
+                                 stderr=DEVNULL, universal_newlines=True,
+                                 check=True).stdout
+        return path + "\n" + version
+
+    def prepare(self, inc_pat):
+        """ Builds (or finds in cache_dir) the .gch and the objects of the
+        provided sources, only the first call does something. inc_pat is the
+        #include "" pattern of CCompiler. Returns the lines to log, what can
+        not be built is not used."""
+        with self._lock:
+            if self._prepared:
+                return []
+            self._prepared = True
+            messages = []
+            try:
+                toolchain = self.toolchain()
+            except (OSError, subprocess.CalledProcessError) as e:
+                return ["Prebuilt: {}, not used".format(e)]
+            if len(self.headers) > 0:
+                with tracing.span("pch", "c++", headers=len(self.headers)):
+                    messages.append(self._build_pch(toolchain))
+            h = hashlib.sha1(toolchain.encode())
+            h.update(" ".join(self.flags + [self.pch or ""]).encode())
+            self._key = h.hexdigest()
+            if self.instructor_dir is not None:
+                with tracing.span("provided objects", "c++"):
+                    messages += self._build_objects(inc_pat)
+            return messages
+
+    def _build_pch(self, toolchain):
+        h = hashlib.sha1(toolchain.encode())
+        h.update(" ".join(self.flags + self.headers).encode())
+        pch_dir = os.path.join(self.cache_dir, "pch", h.hexdigest())
+        header = os.path.join(pch_dir, PCH_NAME)
+        if os.path.isfile(header + ".gch"):
+            self.pch = header
+            return "Prebuilt: precompiled header found in {}".format(pch_dir)
+        os.makedirs(pch_dir, exist_ok=True)
+        # another process may build the same one, the last replace wins
+        tmp = "{}.{}".format(header, os.getpid())
+        with open(tmp, 'w') as f:
+            f.writelines("#include <{}>\n".format(name)
+                         for name in self.headers)
+        os.replace(tmp, header)
+        tmp = "{}.gch.{}".format(header, os.getpid())
+        proc = subprocess.run([self.compiler] + self.flags +
+                              ["-x", "c++-header", header, "-o", tmp],
+                              stdout=PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+        if proc.returncode != 0:
+            return "Prebuilt: precompiled header failed, not used\n" + \
+                proc.stdout
+        os.replace(tmp, header + ".gch")
+        self.pch = header
+        return "Prebuilt: precompiled header of {} built".format(
+            ", ".join(self.headers))
+
+    def _build_objects(self, inc_pat):
+        messages = []
+        root = self.instructor_dir
+        inc_dir = os.path.join(root, "inc")
+        if not os.path.isdir(inc_dir):
+            inc_dir = None
+        obj_dir = os.path.join(self.cache_dir, "obj")
+        os.makedirs(obj_dir, exist_ok=True)
+        for dir_path, _, files in os.walk(root):
+            for name in sorted(f for f in files if f.endswith(".cpp")):
+                src = os.path.join(dir_path, name)
+                index = IncludeIndex(root, dir_path, inc_dir, inc_pat)
+                key = self.object_key(src, index.dependencies([src])[0])
+                obj = os.path.join(obj_dir, key + ".o")
+                self._names.add(name)
+                if os.path.isfile(obj):
+                    self.objects[key] = obj
+                    continue
+                cmd = [self.compiler] + self.flags + ["-c", src, "-o",
+                                                      obj + ".tmp"]
+                if self.pch is not None:
+                    cmd[1:1] = ["-include", self.pch]
+                if inc_dir is not None:  # looked up as by IncludeIndex
+                    cmd[1:1] = ["-I", inc_dir, "-I", root]
+                else:
+                    cmd[1:1] = ["-I", root]
+                proc = subprocess.run(cmd, stdout=PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      universal_newlines=True)
+                rel = os.path.relpath(src, root)
+                if proc.returncode != 0:
+                    messages.append("Prebuilt: {} failed, not used\n{}".format(
+                        rel, proc.stdout))
+                    continue
+                os.replace(obj + ".tmp", obj)
+                self.objects[key] = obj
+                messages.append("Prebuilt: {} built".format(rel))
+        return messages
+
+    def object_key(self, src, deps):
+        """ sha1 of the toolchain, the flags, the source and the headers it
+        depends on (full paths). The headers are found by name, so only
+        their names and contents are used, not where they are."""
+        h = hashlib.sha1(self._key.encode())
+        _sha1_file(h, src)
+        for dep in sorted(deps, key=os.path.basename):
+            h.update(b"\0" + os.path.basename(dep).encode() + b"\0")
+            _sha1_file(h, dep)
+        return h.hexdigest()
+
+    def object_for(self, src, deps):
+        """ Full path of the prebuilt object of a student source or None """
+        if os.path.basename(src) not in self._names:  # avoids reading it
+            return None
+        try:
+            return self.objects.get(self.object_key(src, deps))
+        except OSError:
+            return None
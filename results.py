@@ -0,0 +1,227 @@
+""" Results of a homework folder in a sqlite database next to the zip files, so
+that they are not lost when the program is closed or crashes. Everything is
+keyed by course, hw number and student number (the groups of HW_RE):
+    submissions: ingest status, zip hash, sub folders and pdf files
+    builds: status, duration and diagnostics of each question
+    runs: result of each test case or script run of each question
+    stages: (prog type, stage) of a student which are finished, e.g. build
+Writes are queued and committed together in one transaction every
+batch_size writes or on flush(), the queue can be filled from many threads.
+When a zip file is extracted again with a different hash the old results of
+the student are deleted.
+"""
+import json
+import os
+import re
+import sqlite3
+from threading import Lock
+from time import time as epoch_time
+from ziphandle import HW_RE
+
+STORE_NAME = ".results.sqlite"  # stored in root of the zip files
+ERROR_RE = re.compile(r":\d+(?::\d+)?: (?:fatal )?error\b|: error [A-Z]+\d+")
+WARNING_RE = re.compile(r":\d+(?::\d+)?: warning\b|: warning [A-Z]+\d+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    course TEXT, hw TEXT, student TEXT, folder TEXT, status TEXT,
+    zip_hash TEXT, dirs TEXT, pdfs TEXT, updated REAL,
+    PRIMARY KEY (course, hw, student));
+CREATE TABLE IF NOT EXISTS builds (
+    course TEXT, hw TEXT, student TEXT, prog_type TEXT, question TEXT,
+    status TEXT, returncode INTEGER, duration REAL, errors INTEGER,
+    warnings INTEGER, target TEXT, message TEXT, updated REAL,
+    PRIMARY KEY (course, hw, student, prog_type, question));
+CREATE TABLE IF NOT EXISTS runs (
+    course TEXT, hw TEXT, student TEXT, prog_type TEXT, stage TEXT,
+    question TEXT, name TEXT, status TEXT, returncode INTEGER, killed TEXT,
+    wall REAL, cpu REAL, max_rss INTEGER, data TEXT, updated REAL,
+    PRIMARY KEY (course, hw, student, prog_type, stage, question, name));
+CREATE TABLE IF NOT EXISTS stages (
+    course TEXT, hw TEXT, student TEXT, prog_type TEXT, stage TEXT,
+    updated REAL, PRIMARY KEY (course, hw, student, prog_type, stage));
+"""
+STUDENT_TABLES = ("builds", "runs", "stages")  # deleted with a new zip
+
+
+def diagnostics(text):
+    """ Number of errors and warnings in the output of gcc or cl """
+    return len(ERROR_RE.findall(text)), len(WARNING_RE.findall(text))
+
+
+class ResultsStore:
+    """ One sqlite file of a homework folder. The record_ methods only queue
+    the writes, they are committed by flush(). The reads flush first."""
+
+    def __init__(self, path, batch_size=200):
+        self.path = path
+        self.batch_size = batch_size  # writes committed together
+        self._pending = []  # (sql, parameters) not committed yet
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")  # readers do not block
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, root):
+        """ Store of the homework folder root """
+        return cls(os.path.join(root, STORE_NAME))
+
+    @staticmethod
+    def exists(root):
+        return os.path.isfile(os.path.join(root, STORE_NAME))
+
+    @staticmethod
+    def key(hw_folder):
+        """ (course, hw number, student number) of a hw folder name """
+        course_name, _, hw_num, st_num = HW_RE.match(hw_folder).groups()
+        return course_name.upper(), hw_num, st_num
+
+    def _queue(self, sql, params):
+        with self._lock:
+            self._pending.append((sql, params))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ Commits the queued writes in one transaction """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if len(pending) == 0:
+                return
+            with self._db:  # commits, or rolls back on an error
+                for sql, params in pending:
+                    self._db.execute(sql, params)
+
+    def _query(self, sql, params=()):
+        self.flush()
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def record_ingest(self, hw_folder, status, zip_hash="", index=None):
+        """ status is ok or failed, index is the DirIndex of the hw folder.
+        The builds and runs of the student are deleted if zip_hash is not
+        the one recorded before."""
+        key = self.key(hw_folder)
+        for table in STUDENT_TABLES:
+            self._queue(
+                "DELETE FROM {} WHERE course=? AND hw=? AND student=? AND "
+                "EXISTS (SELECT 1 FROM submissions WHERE course=? AND hw=? "
+                "AND student=? AND zip_hash!=?)".format(table),
+                key + key + (zip_hash,))
+        dirs = [] if index is None else [d.name for d in index.dirs]
+        pdfs = [] if index is None else index.with_ext(".pdf")
+        self._queue("INSERT OR REPLACE INTO submissions VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    key + (hw_folder, status, zip_hash, json.dumps(dirs),
+                           json.dumps(pdfs), epoch_time()))
+
+    def record_build(self, hw_folder, prog_type, question, status,
+                     returncode=None, duration=0.0, output="", target="",
+                     message="", counts=None):
+        """ question is the path relative to the hw folder, output is the
+        compiler output (for the number of errors and warnings, unless
+        counts gives them) and target the executable or script, also
+        relative."""
+        errors, warnings = counts if counts is not None else \
+            diagnostics(output)
+        self._queue("INSERT OR REPLACE INTO builds VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self.key(hw_folder) + (
+                        prog_type, question, status, returncode,
+                        round(duration, 3), errors, warnings, target,
+                        message, epoch_time()))
+
+    def record_run(self, hw_folder, prog_type, stage, question, name,
+                   result):
+        """ stage is e.g. tests or run, name is the test case or the script,
+        result a dict of TestRunner.run_case, limits.run_limited or matpool,
+        kept as json."""
+        self._queue("INSERT OR REPLACE INTO runs VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self.key(hw_folder) + (
+                        prog_type, stage, question, name, result.get("status", ""),
+                        result.get("returncode"), result.get("killed", ""),
+                        result.get("wall", result.get("duration")),
+                        result.get("cpu"), result.get("max_rss"),
+                        json.dumps(result), epoch_time()))
+
+    def mark_done(self, hw_folder, prog_type, stage):
+        """ Queued after the results of the stage, so it is committed with
+        or after them."""
+        self._queue("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                    self.key(hw_folder) + (prog_type, stage, epoch_time()))
+
+    def forget(self, hw_folder, prog_type, stage):
+        """ Deletes a stage and its results, e.g. before building again """
+        key = self.key(hw_folder) + (prog_type,)
+        if stage == "build":
+            self._queue("DELETE FROM builds WHERE course=? AND hw=? AND "
+                        "student=? AND prog_type=?", key)
+        else:
+            self._queue("DELETE FROM runs WHERE course=? AND hw=? AND "
+                        "student=? AND prog_type=? AND stage=?",
+                        key + (stage,))
+        self._queue("DELETE FROM stages WHERE course=? AND hw=? AND "
+                    "student=? AND prog_type=? AND stage=?", key + (stage,))
+
+    def done(self, hw_folder, prog_type, stage):
+        return len(self._query(
+            "SELECT 1 FROM stages WHERE course=? AND hw=? AND student=? AND "
+            "prog_type=? AND stage=?",
+            self.key(hw_folder) + (prog_type, stage))) > 0
+
+    def submissions(self, status="ok"):
+        """ Dicts of the ingested submissions, sorted by folder name """
+        rows = self._query(
+            "SELECT folder, course, hw, student, status, zip_hash, dirs, pdfs "
+            "FROM submissions WHERE status=? ORDER BY folder", (status,))
+        return [{"folder": r[0], "course": r[1], "hw": r[2], "student": r[3],
+                 "status": r[4], "zip_hash": r[5], "dirs": json.loads(r[6]),
+                 "pdfs": json.loads(r[7])} for r in rows]
+
+    def builds(self, hw_folder, prog_type):
+        """ Dicts of the questions of a student, in the recorded order """
+        rows = self._query(
+            "SELECT question, status, returncode, duration, errors, warnings, "
+            "target, message FROM builds WHERE course=? AND hw=? AND "
+            "student=? AND prog_type=? ORDER BY rowid",
+            self.key(hw_folder) + (prog_type,))
+        return [dict(zip(("question", "status", "returncode", "duration",
+                          "errors", "warnings", "target", "message"), r))
+                for r in rows]
+
+    def runs(self, hw_folder, prog_type, stage):
+        """ question -> list of the results given to record_run """
+        runs = dict()
+        for question, data in self._query(
+                "SELECT question, data FROM runs WHERE course=? AND hw=? AND "
+                "student=? AND prog_type=? AND stage=? ORDER BY rowid",
+                self.key(hw_folder) + (prog_type, stage)):
+            runs.setdefault(question, []).append(json.loads(data))
+        return runs
+
+    def statuses(self, prog_type):
+        """ hw folder -> (build, run) status of each student, for the table.
+        build is OK or Failed with the number of failed questions, e.g.
+        Failed 1/3, run is the number of passed runs, e.g. 3/4."""
+        statuses = dict()
+        for folder, n, n_ok in self._query(
+                "SELECT s.folder, COUNT(*), SUM(b.status='OK') FROM builds b "
+                "JOIN submissions s USING (course, hw, student) "
+                "WHERE b.prog_type=? GROUP BY s.folder", (prog_type,)):
+            statuses[folder] = ["OK" if n_ok == n else
+                                "Failed {}/{}".format(n - n_ok, n), ""]
+        for folder, n, n_ok in self._query(
+                "SELECT s.folder, COUNT(*), SUM(r.status IN ('pass', 'ok') "
+                "OR (r.status='' AND r.returncode=0 AND r.killed='')) "
+                "FROM runs r JOIN submissions s USING (course, hw, student) "
+                "WHERE r.prog_type=? GROUP BY s.folder", (prog_type,)):
+            statuses.setdefault(folder, ["", ""])[1] = "{}/{}".format(n_ok, n)
+        return {folder: tuple(s) for folder, s in statuses.items()}
@@ -0,0 +1,429 @@
+""" Similarity of the submissions of a cohort, to find copied code. The C++,
+python and matlab sources of each question of a student are tokenized with
+the comments dropped and the identifiers, strings and numbers normalized, so
+renaming variables does not hide a copy. Hashes of the k-grams of the tokens
+are winnowed (the smallest hash in every window of w hashes is kept) into the
+fingerprints of the question. An inverted index maps each fingerprint of a
+question (of one course and hw) to the students having it, so only the
+students sharing enough fingerprints are compared, never all the pairs.
+Fingerprints found in many submissions (e.g. the code given with the
+homework) are ignored. Students can be added or removed at any time, e.g. as
+the zip files are extracted, and the fingerprints are saved in the hw folder
+so unchanged students are not read again:
+    index = SimilarityIndex.load(root)
+    index.add_student(hw_folder, dir_index)
+    index.query(hw_folder)  # most similar students of each question
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from PyQt5 import QtCore
+from dirindex import DirIndex
+from testrunner import question_key
+from ziphandle import HW_RE
+
+INDEX_NAME = ".similarity.json"  # stored in root of the zip files
+INDEX_VERSION = 2  # of the questions (question_key), older ones are made again
+MAX_FILE_SIZE = 1 << 20  # larger sources are not read
+LANGUAGES = {".cpp": "c++", ".cc": "c++", ".cxx": "c++", ".c": "c++",
+             ".h": "c++", ".hpp": "c++", ".py": "python", ".m": "matlab"}
+KEYWORDS = {
+    "c++": set("""auto bool break case catch char class const continue default
+        delete do double else enum explicit false float for friend if inline
+        int long namespace new nullptr operator private protected public
+        return short signed sizeof static struct switch template this throw
+        true try typedef typename union unsigned using virtual void while
+        string vector cin cout endl std""".split()),
+    "python": set("""and as assert break class continue def del elif else
+        except False finally for from global if import in is lambda None
+        nonlocal not or pass raise return True try while with yield print
+        input range len int float str list dict set""".split()),
+    "matlab": set("""break case catch classdef continue else elseif end for
+        function global if otherwise parfor persistent return switch try
+        while disp fprintf input zeros ones size length numel""".split())}
+COMMENT_RE = {
+    "c++": r"//[^\n]*|/\*[\s\S]*?\*/|^[ \t]*\#[^\n]*",
+    "python": r"\#[^\n]*",
+    "matlab": r"^[ \t]*[%#]\{[\s\S]*?^[ \t]*[%#]\}|[%#][^\n]*"}
+TOKEN_RE = {lang: re.compile(r"""
+    (?P<str>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+   |(?P<comment>{})
+   |(?P<num>\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+)
+   |(?P<id>[A-Za-z_]\w*)
+   |(?P<op>==|!=|<=|>=|&&|\|\||<<|>>|\+\+|--|->|::|[-+*/]=|[^\s\w])
+""".format(pattern), re.VERBOSE | re.MULTILINE)
+            for lang, pattern in COMMENT_RE.items()}
+
+
+def tokenize(text, lang):
+    """ Tokens of a source: keywords and operators as they are, the other
+    identifiers are V, strings S and numbers N. Comments are dropped."""
+    keywords = KEYWORDS[lang]
+    tokens = []
+    for m in TOKEN_RE[lang].finditer(text):
+        kind = m.lastgroup
+        if kind == "id":
+            tokens.append(m.group() if m.group() in keywords else "V")
+        elif kind == "str":
+            tokens.append("S")
+        elif kind == "num":
+            tokens.append("N")
+        elif kind == "op":
+            tokens.append(m.group())
+    return tokens
+
+
+def fingerprints(tokens, k=6, window=4):
+    """ Winnowed hashes of the k-grams of tokens, a set of ints. The same
+    code gives the same hashes in every process (crc32, not hash())."""
+    if len(tokens) < k:
+        return set()
+    hashes = [zlib.crc32(" ".join(tokens[i:i + k]).encode())
+              for i in range(len(tokens) - k + 1)]
+    if len(hashes) <= window:
+        return {min(hashes)}
+    selected = set()
+    for i in range(len(hashes) - window + 1):
+        selected.add(min(hashes[i:i + window]))
+    return selected
+
+
+def question_of(rel_dir):
+    """ Question of the folder of a source, relative to the content of the
+    hw folder: src and inc are dropped and the numbers are kept, so that
+    Q3-1, 3_1 and 3/1 are the same question. "" for the top folder."""
+    return question_key(rel_dir)
+
+
+def source_files(index):
+    """ (relative path, language, question) of the sources in a DirIndex. A
+    folder wrapping everything (e.g. HW3-9123068 in the hw folder) is not
+    a part of the questions."""
+    top = index
+    while len(top.dirs) == 1 and not any(
+            os.path.splitext(f)[1].lower() in LANGUAGES for f in top.files):
+        top = top.dirs[0]
+    files = []
+    for node, _ in top.walk():
+        question = question_of(os.path.relpath(node.path, top.path))
+        for f in node.files:
+            lang = LANGUAGES.get(os.path.splitext(f)[1].lower())
+            if lang is not None:
+                files.append((os.path.relpath(os.path.join(node.path, f),
+                                              index.path), lang, question))
+    return files
+
+
+def student_fingerprints(hw_path, files, k, window):
+    """ question -> list of fingerprints of the files (relative paths,
+    languages and questions) of a student. Runs in the workers of
+    add_students."""
+    tokens = dict()  # question -> tokens of its files one after another
+    for rel, lang, question in sorted(files):
+        path = os.path.join(hw_path, rel)
+        try:
+            if os.path.getsize(path) > MAX_FILE_SIZE:
+                continue
+            with open(path, 'r', errors='replace') as f:
+                text = f.read()
+        except OSError:
+            continue
+        tokens.setdefault(question, []).extend(tokenize(text, lang))
+    return {q: sorted(fingerprints(t, k, window)) for q, t in tokens.items()}
+
+
+def signature(hw_path, files):
+    """ Changes when a source is added, removed or modified """
+    sha = hashlib.sha1()
+    for rel, _, _ in sorted(files):
+        try:
+            st = os.stat(os.path.join(hw_path, rel))
+        except OSError:
+            continue
+        sha.update("{} {} {}\n".format(rel, st.st_mtime_ns,
+                                       st.st_size).encode())
+    return sha.hexdigest()
+
+
+def student_entry(index, k, window, known=None):
+    """ (signature, question -> list of fingerprints) of the student of a
+    DirIndex, the fingerprints are None if the signature is known. Can run
+    anywhere, e.g. in the workers of ZipHandle, the index is not needed."""
+    files = source_files(index)
+    sig = signature(index.path, files)
+    if sig == known:
+        return sig, None
+    return sig, student_fingerprints(index.path, files, k, window)
+
+
+def student_entries(indexes, k, window, known, workers=1):
+    """ student_entry of many, hw folder -> DirIndex. known is hw folder ->
+    signature, the unchanged students are left out. The sources are read by
+    workers processes, spawned: it also runs in the GUI (FingerprintThread),
+    forking a process with Qt and its threads can deadlock them."""
+    jobs = dict()
+    for hw_folder, index in indexes.items():
+        files = source_files(index)
+        sig = signature(index.path, files)
+        if known.get(hw_folder) != sig:
+            jobs[hw_folder] = (index.path, files, sig)
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context(
+                                     "spawn")) as pool:
+            results = dict(zip(jobs, pool.map(
+                student_fingerprints, [j[0] for j in jobs.values()],
+                [j[1] for j in jobs.values()], [k] * len(jobs),
+                [window] * len(jobs))))
+    else:
+        results = {hw_folder: student_fingerprints(job[0], job[1], k, window)
+                   for hw_folder, job in jobs.items()}
+    return {hw_folder: (jobs[hw_folder][2], questions)
+            for hw_folder, questions in results.items()}
+
+
+class SimilarityIndex:
+    """ Fingerprints of every question of every student and the inverted
+    index: (course, hw, question) -> fingerprint -> students, e.g. Q1 of HW2
+    is never compared with Q1 of HW3. A fingerprint of more than
+    common_fraction of the students of a question (at least min_common) is
+    common code, it is not counted. Two students are candidates if they
+    share min_shared fingerprints, their similarity is the Jaccard index of
+    the fingerprints which are not common."""
+
+    def __init__(self, k=6, window=4, min_shared=3, common_fraction=0.3,
+                 min_common=4):
+        self.k = k  # tokens in a k-gram
+        self.window = window  # one fingerprint is kept in every window
+        self.min_shared = min_shared
+        self.common_fraction = common_fraction
+        self.min_common = min_common
+        self.path = None  # json file of save(), set by load
+        self._students = dict()  # hw folder -> {signature, questions}
+        self._postings = dict()  # key -> fingerprint -> hw folders
+        self._counts = dict()  # key -> number of students with it
+
+    @classmethod
+    def load(cls, root, **kwargs):
+        """ Index saved in root, an empty one if there is none """
+        index = cls(**kwargs)
+        index.path = os.path.join(root, INDEX_NAME)
+        try:
+            with open(index.path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):  # not saved yet or broken
+            return index
+        if (saved.get("version"), saved.get("k"), saved.get("window")) != \
+                (INDEX_VERSION, index.k, index.window):
+            return index  # other fingerprints, made again
+        for hw_folder, student in saved["students"].items():
+            if not os.path.isdir(os.path.join(root, hw_folder)):
+                continue  # deleted since then
+            index._add(hw_folder, student["signature"],
+                       {q: set(fps) for q, fps in
+                        student["questions"].items()})
+        return index
+
+    def save(self, path=None):
+        path = path or self.path
+        students = {hw_folder: {"signature": s["signature"], "questions": {
+            q: sorted(fps) for q, fps in s["questions"].items()}}
+                    for hw_folder, s in self._students.items()}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": INDEX_VERSION, "k": self.k,
+                       "window": self.window, "students": students}, f)
+        os.replace(tmp_path, path)  # never half written
+
+    def __contains__(self, hw_folder):
+        return hw_folder in self._students
+
+    def __len__(self):
+        return len(self._students)
+
+    @staticmethod
+    def _key(hw_folder, question):
+        """ (course, hw, question) of a question of a student, the postings
+        and counts are kept by it."""
+        match = HW_RE.match(hw_folder)
+        if match is None:  # not a hw folder, only its question is known
+            return "", "", question
+        return match.group(1).upper(), match.group(3), question
+
+    def signatures(self):
+        """ hw folder -> signature, e.g. for student_entry in another thread """
+        return {hw_folder: student["signature"]
+                for hw_folder, student in self._students.items()}
+
+    def add_entry(self, hw_folder, entry):
+        """ Adds or updates a student from its student_entry. Returns False
+        if it was not changed since it was added."""
+        sig, questions = entry
+        if questions is None or \
+                self._students.get(hw_folder, dict()).get("signature") == sig:
+            return False
+        self.remove_student(hw_folder)
+        self._add(hw_folder, sig, {q: set(fps)
+                                   for q, fps in questions.items()})
+        return True
+
+    def add_student(self, hw_folder, index):
+        """ Adds or updates a student, index is the DirIndex of its folder.
+        Returns False if it was not changed since it was added."""
+        known = self._students.get(hw_folder, dict()).get("signature")
+        return self.add_entry(hw_folder, student_entry(index, self.k,
+                                                       self.window, known))
+
+    def add_students(self, indexes, workers=1):
+        """ add_student for many, hw folder -> DirIndex, the sources are read
+        by workers processes. Returns the number of students updated."""
+        entries = student_entries(indexes, self.k, self.window,
+                                  self.signatures(), workers)
+        for hw_folder, entry in entries.items():
+            self.add_entry(hw_folder, entry)
+        return len(entries)
+
+    def _add(self, hw_folder, sig, questions):
+        self._students[hw_folder] = {"signature": sig,
+                                     "questions": questions}
+        for q, fps in questions.items():
+            key = self._key(hw_folder, q)
+            postings = self._postings.setdefault(key, dict())
+            for fp in fps:
+                postings.setdefault(fp, set()).add(hw_folder)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def remove_student(self, hw_folder):
+        student = self._students.pop(hw_folder, None)
+        if student is None:
+            return
+        for q, fps in student["questions"].items():
+            key = self._key(hw_folder, q)
+            postings = self._postings[key]
+            for fp in fps:
+                postings[fp].discard(hw_folder)
+                if len(postings[fp]) == 0:
+                    del postings[fp]
+            self._counts[key] -= 1
+            if self._counts[key] == 0:
+                del self._counts[key], self._postings[key]
+
+    def prune(self, hw_folders):
+        """ Removes the students which are not in hw_folders, e.g. their zip
+        file was deleted. Returns the number removed."""
+        hw_folders = set(hw_folders)
+        removed = [f for f in self._students if f not in hw_folders]
+        for hw_folder in removed:
+            self.remove_student(hw_folder)
+        return len(removed)
+
+    def common_limit(self, key):
+        """ Fingerprints of more students than this are common code, key is
+        (course, hw, question)."""
+        return max(self.min_common,
+                   int(self.common_fraction * self._counts.get(key, 0)))
+
+    def _rare(self, key, fps):
+        postings = self._postings.get(key, dict())
+        limit = self.common_limit(key)
+        return {fp for fp in fps if len(postings.get(fp, ())) <= limit}
+
+    def score(self, a, b, question):
+        """ Jaccard index of the rare fingerprints of two students, 0 to 1.
+        Students of another course or hw have nothing in common."""
+        key = self._key(a, question)
+        if self._key(b, question) != key:
+            return 0.0
+        fps_a = self._rare(key, self._students[a]["questions"].get(
+            question, set()))
+        fps_b = self._rare(key, self._students[b]["questions"].get(
+            question, set()))
+        union = len(fps_a | fps_b)
+        return len(fps_a & fps_b) / union if union > 0 else 0.0
+
+    def candidates(self, hw_folder, question):
+        """ other student of the same course and hw -> number of rare
+        fingerprints shared with hw_folder in question, at least
+        min_shared."""
+        key = self._key(hw_folder, question)
+        postings = self._postings.get(key, dict())
+        limit = self.common_limit(key)
+        shared = dict()
+        for fp in self._students[hw_folder]["questions"].get(question, ()):
+            students = postings.get(fp, ())
+            if len(students) <= limit:
+                for other in students:
+                    if other != hw_folder:
+                        shared[other] = shared.get(other, 0) + 1
+        return {other: n for other, n in shared.items()
+                if n >= self.min_shared}
+
+    def query(self, hw_folder, top=5):
+        """ Most similar students of each question of hw_folder, as a list
+        of (question, other student, similarity, shared fingerprints) sorted
+        by similarity."""
+        if hw_folder not in self._students:
+            return []
+        matches = []
+        for q in self._students[hw_folder]["questions"]:
+            found = [(q, other, self.score(hw_folder, other, q), n)
+                     for other, n in self.candidates(hw_folder, q).items()]
+            found.sort(key=lambda m: -m[2])
+            matches += found[:top]
+        matches.sort(key=lambda m: -m[2])
+        return matches
+
+    def pairs(self, threshold=0.5):
+        """ (question, student, student, similarity) of the whole cohort with
+        a similarity of at least threshold, the most similar first. Only the
+        pairs sharing a rare fingerprint are counted and scored."""
+        found = []
+        for key, postings in self._postings.items():
+            q = key[2]
+            limit = self.common_limit(key)
+            shared = dict()  # (a, b) -> fingerprints shared
+            for students in postings.values():
+                if 2 <= len(students) <= limit:
+                    ordered = sorted(students)
+                    for i, a in enumerate(ordered):
+                        for b in ordered[i + 1:]:
+                            shared[a, b] = shared.get((a, b), 0) + 1
+            for (a, b), n in shared.items():
+                if n >= self.min_shared:
+                    similarity = self.score(a, b, q)
+                    if similarity >= threshold:
+                        found.append((q, a, b, similarity))
+        found.sort(key=lambda p: (-p[3], p[0], p[1], p[2]))
+        return found
+
+
+class FingerprintThread(QtCore.QThread):
+    """ student_entries of the hw folders of root, out of the GUI thread.
+    The entries are sent back with entries_trigger, the SimilarityIndex is
+    only changed by the GUI."""
+    log_trigger = QtCore.pyqtSignal(str)
+    entries_trigger = QtCore.pyqtSignal(object)
+
+    def __init__(self, root, hw_folders, k, window, known, workers=1):
+        QtCore.QThread.__init__(self)
+        self.root = root
+        self.hw_folders = hw_folders
+        self.k = k
+        self.window = window
+        self.known = known  # hw folder -> signature
+        self.workers = workers
+
+    def run(self):
+        try:
+            indexes = {f: DirIndex.build(os.path.join(self.root, f))
+                       for f in self.hw_folders}
+            entries = student_entries(indexes, self.k, self.window,
+                                      self.known, self.workers)
+        except Exception as e:  # e.g. a worker crashed
+            self.log_trigger.emit("Similarity: Failed: {}".format(e))
+            entries = dict()
+        self.entries_trigger.emit(entries)
@@ -0,0 +1,239 @@
+""" Model of the student table of the GUI. The submissions are kept column by
+column in SubmissionModel, one list per column and no item per cell, the
+view only asks for the cells it shows. Rows are queued by append() and
+inserted in batches, e.g. thousands of zip files do not insert thousands of
+rows one by one. SubmissionFilter sorts and filters the rows for the view by
+course, hw, build status and number of questions.
+"""
+from array import array
+from PyQt5 import QtCore
+from PyQt5.QtCore import Qt, QModelIndex
+from PyQt5.QtGui import QColor, QFont
+from ziphandle import HW_RE
+
+# Columns of the table: header and width
+COLUMNS = [("CN", 30), ("HW", 31), ("St. Num", 70), ("St. Name", 105),
+           ("Folders", 100), ("Report", 100), ("Build", 70), ("Run", 50)]
+CN, HW_NUM, ST_NUM, ST_NAME, FOLDERS, REPORT, BUILD, RUN = range(len(COLUMNS))
+NO_NAME = "وارد نشده است"  # names are not known yet
+SORT_ROLE = Qt.UserRole  # numbers are sorted as numbers
+STATUS_FILTERS = ["All", "OK", "Failed", "Not built"]  # of the build column
+
+
+class SubmissionModel(QtCore.QAbstractTableModel):
+    """ One row per hw folder, in the order they were appended """
+
+    def __init__(self, parent=None, batch_interval=50):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self._folder = []  # hw folder names
+        self._course = []
+        self._hw = []
+        self._student = []
+        self._folders = []  # question folders as shown, e.g. 1 2 3
+        self._n_questions = array('H')  # number of question folders
+        self._report = []  # first pdf or N/A
+        self._build = []  # build status, "" if not built
+        self._run = []  # passed runs, e.g. 3/4, "" if not run
+        self._rows = dict()  # hw folder -> row
+        self._pending = []  # rows not inserted yet
+        self.courses = []  # course names in the order they were seen
+        self.hws = []  # hw numbers, the same
+        self.name_font = QFont()  # Persian font of the names
+        self.name_font.setFamily("XW Zar")
+        self.name_font.setPointSize(11)
+        self._timer = QtCore.QTimer(self)  # inserts the pending rows
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(batch_interval)  # ms
+        self._timer.timeout.connect(self.flush)
+
+    def append(self, hw_folder, hw_dirs, hw_files):
+        """ hw_dirs are the names of the sub folders, hw_files of the pdfs.
+        The row is inserted with the others of the next batch, flush()
+        inserts it now."""
+        course_name, _, hw_num, st_num = HW_RE.match(hw_folder).groups()
+        # ignore chars from the homework folder names in the table,
+        # e.g.: Q1, Q2 -> 1, 2
+        if len(hw_dirs) > 0:
+            hw_dirs_str = ' '.join(hw_dirs)
+            hw_dirs_str = [c for c in hw_dirs_str if not c.isalpha()]
+            hw_dirs_str.sort()
+            hw_dirs_str = ' '.join(hw_dirs_str)  # convert back to str
+        else:
+            hw_dirs_str = "N/A"
+        # can be greater than 1, only output one
+        report_file = hw_files[0] if len(hw_files) > 0 else "N/A"
+        self._pending.append((hw_folder, course_name, hw_num, st_num,
+                              hw_dirs_str, len(hw_dirs), report_file))
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """ Inserts the pending rows at the end, all at once """
+        self._timer.stop()
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, []
+        first = len(self._folder)
+        self.beginInsertRows(QModelIndex(), first, first + len(pending) - 1)
+        for row, (hw_folder, course, hw, student, folders, n_questions,
+                  report) in enumerate(pending, first):
+            self._folder.append(hw_folder)
+            self._course.append(course)
+            self._hw.append(hw)
+            self._student.append(student)
+            self._folders.append(folders)
+            self._n_questions.append(min(n_questions, 0xffff))
+            self._report.append(report)
+            self._build.append("")
+            self._run.append("")
+            self._rows[hw_folder] = row
+            if course not in self.courses:
+                self.courses.append(course)
+            if hw not in self.hws:
+                self.hws.append(hw)
+        self.endInsertRows()
+
+    def clear(self):
+        self._timer.stop()
+        self.beginResetModel()
+        for column in (self._folder, self._course, self._hw, self._student,
+                       self._folders, self._report, self._build, self._run,
+                       self._pending, self.courses, self.hws):
+            column.clear()
+        self._n_questions = array('H')
+        self._rows.clear()
+        self.endResetModel()
+
+    def __len__(self):
+        return len(self._folder) + len(self._pending)
+
+    def folders(self):
+        """ hw folders of the table, pending ones too """
+        return self._folder + [row[0] for row in self._pending]
+
+    def folder(self, row):
+        return self._folder[row]
+
+    def row_of(self, hw_folder):
+        """ Row of a hw folder or None """
+        return self._rows.get(hw_folder)
+
+    def report(self, row):
+        return self._report[row]
+
+    def course(self, row):
+        return self._course[row]
+
+    def hw(self, row):
+        return self._hw[row]
+
+    def student(self, row):
+        return self._student[row]
+
+    def n_questions(self, row):
+        return self._n_questions[row]
+
+    def build_status(self, row):
+        return self._build[row]
+
+    def set_statuses(self, statuses):
+        """ statuses is hw folder -> (build, run) status, the other rows are
+        cleared. Only the two columns are updated in the view."""
+        self.flush()
+        for row, hw_folder in enumerate(self._folder):
+            self._build[row], self._run[row] = statuses.get(hw_folder,
+                                                            ("", ""))
+        if len(self._folder) > 0:
+            self.dataChanged.emit(self.index(0, BUILD),
+                                  self.index(len(self._folder) - 1, RUN))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._folder)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMNS[section][0]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        row, column = index.row(), index.column()
+        if role in (Qt.DisplayRole, SORT_ROLE):
+            if column == CN:
+                return self._course[row]
+            elif column == HW_NUM:
+                hw = self._hw[row]
+                return int(hw) if role == SORT_ROLE else hw
+            elif column == ST_NUM:
+                student = self._student[row]
+                return int(student) if role == SORT_ROLE else student
+            elif column == ST_NAME:
+                return NO_NAME
+            elif column == FOLDERS:
+                return self._n_questions[row] if role == SORT_ROLE \
+                    else self._folders[row]
+            elif column == REPORT:
+                return self._report[row]
+            elif column == BUILD:
+                return self._build[row]
+            elif column == RUN:
+                return self._run[row]
+        elif role == Qt.TextAlignmentRole:
+            if column == ST_NAME:
+                return Qt.AlignHCenter
+            elif column in (CN, HW_NUM, ST_NUM, BUILD, RUN):
+                return Qt.AlignCenter
+        elif role == Qt.FontRole and column == ST_NAME:
+            return self.name_font
+        elif role == Qt.ForegroundRole and column == BUILD:
+            if self._build[row] == "OK":
+                return QColor(0, 128, 0)
+            elif self._build[row] != "":
+                return QColor(192, 0, 0)
+        return None
+
+
+class SubmissionFilter(QtCore.QSortFilterProxyModel):
+    """ Sorts the SubmissionModel (numbers as numbers) and shows only the
+    rows of the course, hw and build status chosen, with at least
+    min_questions question folders. "" or All is any."""
+
+    def __init__(self, parent=None):
+        QtCore.QSortFilterProxyModel.__init__(self, parent)
+        self.setSortRole(SORT_ROLE)
+        self.course = ""
+        self.hw = ""
+        self.status = "All"  # one of STATUS_FILTERS
+        self.min_questions = 0
+
+    def set_filter(self, course=None, hw=None, status=None,
+                   min_questions=None):
+        """ Only the given ones are changed """
+        if course is not None:
+            self.course = course
+        if hw is not None:
+            self.hw = hw
+        if status is not None:
+            self.status = status
+        if min_questions is not None:
+            self.min_questions = min_questions
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, row, parent):
+        model = self.sourceModel()
+        if self.course != "" and model.course(row) != self.course:
+            return False
+        if self.hw != "" and model.hw(row) != self.hw:
+            return False
+        if model.n_questions(row) < self.min_questions:
+            return False
+        status = model.build_status(row)
+        if self.status == "OK":
+            return status == "OK"
+        elif self.status == "Failed":
+            return status not in ("", "OK")
+        elif self.status == "Not built":
+            return status == ""
+        return True
@@ -0,0 +1,144 @@
+""" One owner for all the child processes: editor, pdf viewer, terminals,
+makes and test runs. Every child is started in its own process group (a new
+session in linux), so a group kill takes its whole tree with it, e.g. make
+and the compilers or gnome-terminal and the program of the student. Nothing
+else on the machine is looked at, only the processes started here.
+"""
+import os
+import signal
+import subprocess
+from threading import Lock, Thread, Event
+from time import time as epoch_time, sleep
+
+
+class Child:
+    __slots__ = ("process", "group", "label", "started", "reap")
+
+    def __init__(self, process, group, label, reap):
+        self.process = process  # Popen
+        self.group = group  # e.g. "editor", "build", kill_group uses it
+        self.label = label  # shown in the stats, e.g. the command
+        self.started = epoch_time()
+        self.reap = reap  # False if the owner waits for it itself
+
+
+class ProcessSupervisor:
+    """ Starts and tracks the children by group. Finished children are
+    reaped by reap(), called by a background thread after start_reaper(),
+    so no zombies are left. kill_group and kill_all return within their
+    timeout: SIGTERM first, SIGKILL to the groups still alive after it."""
+
+    def __init__(self):
+        self._children = dict()  # pid -> Child
+        self._lock = Lock()
+        self._stop = Event()
+        self._reaper = None
+        self.is_linux = os.name == "posix"
+
+    def spawn(self, cmd, group, label=None, **kwargs):
+        """ Popen(cmd, **kwargs) in its own process group, tracked in group """
+        if self.is_linux:
+            kwargs.setdefault("start_new_session", True)
+        else:
+            kwargs.setdefault("creationflags",
+                              subprocess.CREATE_NEW_PROCESS_GROUP)
+        p = subprocess.Popen(cmd, **kwargs)
+        self.track(p, group, label if label is not None else cmd)
+        return p
+
+    def track(self, p, group, label=None, reap=True):
+        """ Adds a Popen started elsewhere, it should have its own group.
+        If reap is False the owner waits for it and calls untrack."""
+        with self._lock:
+            self._children[p.pid] = Child(p, group, label, reap)
+
+    def untrack(self, p):
+        with self._lock:
+            self._children.pop(p.pid, None)
+
+    def reap(self):
+        """ Forgets the finished children, returns them """
+        with self._lock:
+            children = list(self._children.values())
+        finished = [c for c in children
+                    if c.reap and c.process.poll() is not None]
+        with self._lock:
+            for c in finished:
+                self._children.pop(c.process.pid, None)
+        return finished
+
+    def start_reaper(self, interval=1.0):
+        """ Calls reap every interval seconds in a daemon thread """
+        if self._reaper is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(interval):
+                self.reap()
+        self._reaper = Thread(target=loop, daemon=True)
+        self._reaper.start()
+
+    def stop_reaper(self):
+        self._stop.set()
+
+    def children(self, group=None):
+        """ Children alive, of group or all. The ones with reap False are
+        not polled, they are alive until untrack."""
+        with self._lock:
+            children = list(self._children.values())
+        return [c for c in children if (group is None or c.group == group)
+                and (not c.reap or c.process.poll() is None)]
+
+    def counts(self):
+        """ group -> number of children alive """
+        counts = dict()
+        for c in self.children():
+            counts[c.group] = counts.get(c.group, 0) + 1
+        return counts
+
+    def durations(self):
+        """ (group, label, pid, seconds running) of the children alive, the
+        oldest first."""
+        now = epoch_time()
+        return [(c.group, c.label, c.process.pid, now - c.started)
+                for c in sorted(self.children(), key=lambda c: c.started)]
+
+    def _signal(self, child, force):
+        p = child.process
+        try:
+            if self.is_linux:
+                os.killpg(p.pid, signal.SIGKILL if force else signal.SIGTERM)
+            elif force:  # the whole tree
+                subprocess.call(["taskkill", "/F", "/T", "/PID", str(p.pid)],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+            else:
+                p.terminate()
+        except (ProcessLookupError, PermissionError, OSError):
+            pass  # exited already
+
+    def kill_group(self, group, timeout=2.0):
+        """ Stops all the children of group and their trees. timeout 0
+        kills them at once with SIGKILL."""
+        self._kill(self.children(group), timeout)
+
+    def kill_all(self, timeout=2.0):
+        self._kill(self.children(), timeout)
+
+    def _kill(self, children, timeout):
+        for c in children:
+            self._signal(c, timeout <= 0)
+        deadline = epoch_time() + timeout
+        while epoch_time() < deadline and \
+                any(c.process.poll() is None for c in children if c.reap):
+            sleep(0.02)
+        for c in children:
+            if c.reap and c.process.poll() is None:
+                self._signal(c, True)
+                try:
+                    c.process.wait(1)
+                except subprocess.TimeoutExpired:
+                    pass
+            elif not c.reap:  # the owner waits, e.g. run_limited
+                self._signal(c, True)
+        self.reap()
@@ -0,0 +1,34 @@
+""" python -m unittest test_testrunner """
+import os
+import tempfile
+import unittest
+import testrunner
+from testrunner import question_key
+
+
+class QuestionKeyTest(unittest.TestCase):
+
+    def test_same_question(self):
+        for path in ("3-1", "Q3-1", "Q3_1", "q3/1", "3/1", "Q3/src/1",
+                     "HW3-9123068/3-1"):
+            self.assertEqual(question_key(path), "3/1", path)
+
+    def test_different_questions(self):
+        keys = [question_key(path) for path in ("Q1/2", "Q12", "Q1/data2")]
+        self.assertEqual(len(set(keys)), 3, keys)
+
+    def test_cases_of_the_right_question(self):
+        with tempfile.TemporaryDirectory() as tests_dir:
+            for rel in ("1/2", "12"):
+                os.makedirs(os.path.join(tests_dir, rel))
+                open(os.path.join(tests_dir, rel, "a.in"), 'w').close()
+            runner = testrunner.TestRunner(tests_dir)
+            self.assertEqual(runner.cases("Q12")[0][1],
+                             os.path.join(tests_dir, "12", "a.in"))
+            self.assertEqual(runner.cases("Q1-2")[0][1],
+                             os.path.join(tests_dir, "1", "2", "a.in"))
+            self.assertEqual(runner.cases("Q1/data2"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
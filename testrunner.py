@@ -0,0 +1,178 @@
+""" Runs the compiled programs of all the students against test cases, without
+any terminal or GUI. The test cases are in a folder with the same structure as
+the questions, each case is an input file and optionally the expected output:
+    tests/1/a.in  tests/1/a.out  tests/3/1/a.in ...
+A question folder of a student (e.g. Q1 or 3-1) is matched with the test
+folder of the same path, or the same numbers if there is no such folder.
+"""
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+from limits import RunLimits, run_limited
+
+MAX_SAVED_OUTPUT = 4096  # chars of stdout/stderr kept in the results
+OUTLIER_FACTOR = 3  # flagged if this many times the median of the cohort
+MIN_OUTLIER_CPU = 0.1  # s, less is never slow
+MIN_OUTLIER_RSS = 16 << 20  # bytes, less is never too much memory
+# folder of a question, e.g. 1, Q3-1, q3_1, Ex2, Problem 4
+QUESTION_RE = re.compile(r"(q|question|ex|exercise|p|problem|part)?[-_ .]*"
+                         r"\d+([-_ .]+\d+)*\Z", re.IGNORECASE)
+# folder of the whole hw in the hw folder, e.g. HW3-9123068 or HW3
+WRAPPER_RE = re.compile(r"hw[-_ ]?\d+([-_ ]\d{7})?\Z", re.IGNORECASE)
+
+
+def question_key(rel_path):
+    """ Q1 -> 1, 3-1, Q3_1 and q3/1 -> 3/1, used if the paths do not match.
+    The numbers of a question folder are kept and the other folders as they
+    are (lower case), so Q12, Q1/2 and Q1/data2 stay apart. src, inc and a
+    folder wrapping the questions (e.g. HW3-9123068) are ignored."""
+    parts = [part for part in rel_path.replace(os.sep, "/").split("/")
+             if part not in ("", ".") and part.lower() not in ("src", "inc")]
+    if len(parts) > 1 and WRAPPER_RE.match(parts[0]):
+        parts = parts[1:]
+    return "/".join("/".join(re.findall(r"\d+", part))
+                    if QUESTION_RE.match(part) else part.lower()
+                    for part in parts)
+
+
+def same_output(out, expected):
+    """ Trailing white space in the lines and at the end is ignored """
+    def clean(text):
+        return [line.rstrip() for line in text.rstrip().splitlines()]
+    return clean(out) == clean(expected)
+
+
+class TestRunner:
+    """ Runs the test cases of tests_dir for many targets in a pool of
+    workers, by default one per core. Each run gets the limits (RunLimits).
+    """
+
+    def __init__(self, tests_dir, workers=None, limits=None, log=None):
+        self.tests_dir = tests_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.limits = limits if limits is not None else RunLimits()
+        self.supervisor = None  # ProcessSupervisor tracking the runs
+        self.log = log if log is not None else lambda text: None
+        self._cases = dict()  # question rel path -> list of cases
+        self._keys = dict()  # question_key -> test folder rel path
+        for dir_path, dir_names, file_names in os.walk(tests_dir):
+            dir_names.sort()
+            rel = os.path.relpath(dir_path, tests_dir)
+            cases = []
+            for f in sorted(file_names):
+                if f.endswith(".in"):
+                    out_path = os.path.join(dir_path, f[:-3] + ".out")
+                    cases.append((f[:-3], os.path.join(dir_path, f),
+                                  out_path if os.path.isfile(out_path)
+                                  else None))
+            if len(cases) > 0:
+                self._cases[rel] = cases
+                self._keys.setdefault(question_key(rel), rel)
+
+    def cases(self, question):
+        """ (name, input path, expected output path or None) of a question """
+        if question in self._cases:
+            return self._cases[question]
+        return self._cases.get(self._keys.get(question_key(question)), [])
+
+    def run(self, submissions):
+        """ submissions is a list of (student, hw_path, targets), targets are
+        the full paths of the executables (CCompiler.find_targets) or of the
+        python scripts (PyCompiler.search_scripts). Returns
+        student -> question -> list of the results of the cases."""
+        jobs = []
+        results = dict()
+        for student, hw_path, targets in submissions:
+            results[student] = dict()
+            for target in targets:
+                question = os.path.relpath(os.path.dirname(target), hw_path)
+                results[student][question] = []
+                cases = self.cases(question)
+                if len(cases) == 0:  # not silently, the folders may differ
+                    self.log("{}: {}: no test folder matched".format(
+                        student, question))
+                for case in cases:
+                    jobs.append((student, question, target, case))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for (student, question, _, _), result in zip(
+                    jobs, pool.map(lambda job: self.run_case(*job[2:]), jobs)):
+                results[student][question].append(result)
+        for student, questions in results.items():
+            for question, cases in questions.items():
+                n_pass = sum(case["status"] == "pass" for case in cases)
+                self.log("{}: {}: {}/{} passed".format(student, question,
+                                                      n_pass, len(cases)))
+        return results
+
+    def run_case(self, target, case):
+        name, in_path, out_path = case
+        result = {"case": name, "status": "error", "returncode": None,
+                  "duration": 0.0, "cpu": None, "max_rss": None,
+                  "killed": "", "stdout": "", "stderr": ""}
+        if not os.path.isfile(target):
+            result["status"] = "missing"  # not compiled
+            return result
+        try:
+            with open(in_path, 'rb') as stdin:
+                cmd = [sys.executable, target] if target.endswith(".py") \
+                    else [target]
+                run = run_limited(cmd, self.limits,
+                                  cwd=os.path.dirname(target), stdin=stdin,
+                                  supervisor=self.supervisor)
+        except OSError as e:  # e.g. not executable
+            result["stderr"] = str(e)
+        else:
+            for key in ("returncode", "cpu", "max_rss", "killed", "stdout",
+                        "stderr"):
+                result[key] = run[key]
+            result["duration"] = run["wall"]
+            passed = run["returncode"] == 0 and run["killed"] == ""
+            if passed and out_path is not None:
+                with open(out_path, 'r', errors='replace') as f:
+                    passed = same_output(result["stdout"], f.read())
+            if run["killed"] in ("wall", "cpu"):
+                result["status"] = "timeout"
+            else:
+                result["status"] = "pass" if passed else "fail"
+        result["stdout"] = result["stdout"][:MAX_SAVED_OUTPUT]
+        result["stderr"] = result["stderr"][:MAX_SAVED_OUTPUT]
+        return result
+
+
+def run_metrics(cases):
+    """ Resources used by all the test cases of a submission """
+    metrics = {"wall": 0.0, "cpu": 0.0, "max_rss": 0, "killed": dict()}
+    for case in cases:
+        metrics["wall"] += case["duration"]
+        metrics["cpu"] += case["cpu"] or 0.0
+        metrics["max_rss"] = max(metrics["max_rss"], case["max_rss"] or 0)
+        if case["killed"] != "":
+            metrics["killed"][case["killed"]] = \
+                metrics["killed"].get(case["killed"], 0) + 1
+    metrics["wall"] = round(metrics["wall"], 3)
+    metrics["cpu"] = round(metrics["cpu"], 3)
+    return metrics
+
+
+def flag_outliers(records):
+    """ records are run_metrics dicts of the cohort. Adds the flags slow and
+    memory: far above the median of the cohort or killed by the limits.
+    The medians are of the records which ran, e.g. the ones which did not
+    build are not counted as 0."""
+    ran = [r for r in records if r["cpu"] > 0 or r["max_rss"] > 0]
+    cpu_median = median([r["cpu"] for r in ran] or [0])
+    rss_median = median([r["max_rss"] for r in ran] or [0])
+    for r in records:
+        flags = []
+        if (r["cpu"] > OUTLIER_FACTOR * cpu_median and
+                r["cpu"] > MIN_OUTLIER_CPU) or \
+                "cpu" in r["killed"] or "wall" in r["killed"]:
+            flags.append("slow")
+        if (r["max_rss"] > OUTLIER_FACTOR * rss_median and
+                r["max_rss"] > MIN_OUTLIER_RSS) or \
+                "memory" in r["killed"]:
+            flags.append("memory")
+        r["flags"] = flags
+    return records
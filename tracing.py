@@ -0,0 +1,172 @@
+""" Timing spans of the main operations, saved as a Chrome trace that can be
+opened in chrome://tracing or ui.perfetto.dev. Tracing is on when the
+environment variable AUTOCOMPILER_TRACE is the path of the file to write, e.g.
+    AUTOCOMPILER_TRACE=trace.json python main.py
+and the file is written when the program exits. Spans nest by time in each
+thread and carry attributes, e.g. the student and the question:
+    with tracing.span("build", student=hw_folder, question="1"):
+        ...
+When tracing is off span() returns one shared object which does nothing, so
+the cost is a function call, traced() does the same for whole methods.
+Worker processes send their spans back with
+collect() and the parent adds them with merge().
+"""
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import threading
+from time import perf_counter_ns
+
+ENV_VAR = "AUTOCOMPILER_TRACE"
+
+
+class _NullSpan:
+    """ span() when tracing is off """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args  # shown in the details of the span
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        end = perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add({"name": self.name, "cat": self.cat, "ph": "X",
+                         "ts": self.start // 1000,
+                         "dur": (end - self.start) // 1000,
+                         "pid": os.getpid(), "tid": threading.get_ident(),
+                         "args": self.args})
+        return False
+
+    def set(self, **args):
+        """ Attributes known only at the end, e.g. the return code """
+        self.args.update(args)
+
+
+class Tracer:
+    """ Collects the finished spans of all the threads. The times are
+    microseconds of perf_counter, which is the same in all the processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._events = []
+        self._threads = dict()  # (pid, tid) -> thread name
+        self._lock = threading.Lock()
+
+    def span(self, name, cat, args):
+        return Span(self, name, cat, args)
+
+    def add(self, event):
+        key = (event["pid"], event["tid"])
+        with self._lock:
+            self._events.append(event)
+            if key not in self._threads:
+                self._threads[key] = threading.current_thread().name
+
+    def collect(self):
+        """ Spans of this process, removed from the tracer """
+        pid = os.getpid()
+        with self._lock:
+            mine = [e for e in self._events if e["pid"] == pid]
+            self._events = [e for e in self._events if e["pid"] != pid]
+            names = {k: v for k, v in self._threads.items() if k[0] == pid}
+        return mine, names
+
+    def merge(self, collected):
+        events, names = collected
+        with self._lock:
+            self._events.extend(events)
+            self._threads.update(names)
+
+    def save(self, path=None):
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        meta = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                 "args": {"name": name}}
+                for (pid, tid), name in threads.items()]
+        with open(path or self.path, 'w') as f:
+            json.dump({"traceEvents": meta + events,
+                       "displayTimeUnit": "ms"}, f)
+
+
+_tracer = Tracer(os.environ[ENV_VAR]) if os.environ.get(ENV_VAR) else None
+
+
+def _save_at_exit():
+    if multiprocessing.parent_process() is None:  # not in a worker process
+        _tracer.save()
+
+
+if _tracer is not None:
+    atexit.register(_save_at_exit)
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, cat="autocompiler", **args):
+    """ Context manager timing its block, args are the attributes """
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, cat, args)
+
+
+def traced(name, attrs=None, cat="autocompiler"):
+    """ Decorator making each call of a method a span, attrs(self) gives
+    its attributes."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if _tracer is None:
+                return func(self, *args, **kwargs)
+            with _tracer.span(name, cat, attrs(self) if attrs else dict()):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collect():
+    """ Spans of this process to send to the parent, None if off """
+    if _tracer is None:
+        return None
+    return _tracer.collect()
+
+
+def merge(collected):
+    """ Adds the spans of collect() in a worker process """
+    if _tracer is not None and collected is not None:
+        _tracer.merge(collected)
+
+
+def save(path=None):
+    """ Writes the trace now, it is also written at exit """
+    if _tracer is not None:
+        _tracer.save(path)
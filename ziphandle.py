@@ -1,39 +1,265 @@
 from PyQt5 import QtCore
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import multiprocessing
 import os
+import re
 import shutil
 import zipfile
+import tracing
+from dirindex import DirIndex
+
+# e.g. BP-HW1-9523000: course name, HW1-9523000, hw number, student number
+HW_RE = re.compile(r"\A(\w{2})[-_](HW(\d+)[-_](\d{7}))\Z", re.IGNORECASE)
+MANIFEST_NAME = ".zip_manifest.json"  # stored in root of the zip files
+MAX_MEMBER_SIZE = 64 << 20  # larger files in the zip are not extracted
+MAX_ARCHIVE_SIZE = 256 << 20  # zip is rejected if its contents are larger
+MAX_RATIO = 200  # uncompressed/compressed size, larger is a zip bomb
 
 
 class ZipHandle(QtCore.QThread):
     """ This class should verify if the zip files are:
     1- Valid
     2- Properly structured, if not correct if possible
-    3- clean the output
+    3- clean the output, junk files are dropped while extracting
     All the outputs are sent to the console in the main program
+    If workers > 1 the zip files are processed in a process pool, each one in
+    its own tmp folder, and the results are sent back as they finish.
+    A manifest of the processed zip files (size, mtime and hash) is kept in
+    root, the zip files which are not changed since then are skipped and their
+    folders are reused.
+    hw_add_trigger sends the hw folder name, its DirIndex and the hash of its
+    zip file.
+    If fingerprint is set, the sources are also fingerprinted here (in the
+    workers if any) and fingerprints_trigger sends the hw folder name and its
+    similarity.student_entry, the GUI only adds it to its SimilarityIndex.
     """
     log_trigger = QtCore.pyqtSignal(str)
-    hw_add_trigger = QtCore.pyqtSignal(str)
+    hw_add_trigger = QtCore.pyqtSignal(str, object, str)
+    fingerprints_trigger = QtCore.pyqtSignal(str, object)
 
     # root is the directory where zip_files are
-    def __init__(self, root, zip_files, hw_re):
+    def __init__(self, root, zip_files, hw_re, workers=1, incremental=True,
+                 max_member_size=MAX_MEMBER_SIZE,
+                 max_archive_size=MAX_ARCHIVE_SIZE, max_ratio=MAX_RATIO):
         QtCore.QThread.__init__(self)
         self.root = root
         self.files = zip_files
         self.hw_re = hw_re
+        self.workers = workers  # number of processes working on zip files
+        self.incremental = incremental  # skip the zip files already processed
+        self.max_member_size = max_member_size  # bytes, per file in the zip
+        self.max_archive_size = max_archive_size  # bytes, all files together
+        self.max_ratio = max_ratio  # uncompressed/compressed, per file
         self.tmp_path = os.path.join(root, "zip_tmp")  # working on zip files
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.manifest = {}  # zip file name -> size, mtime, hash
+        self.fingerprint = None  # (k, window) of a SimilarityIndex
+        self.known_signatures = dict()  # hw folder -> signature, not read
 
     def run(self):
-        for zip_file in self.files:
-            # Check if we have a valid zip file
-            if self.zip_is_valid(zip_file) is False:  # zip is not valid
-                continue  # ignore this file, error is reported in zip_is_valid
-            self.zip_extract(zip_file)  # extract the zip contents to tmp_path
-
-            # update folder structure of zip_file extracted in self.tmp_path
-            if self.update_structure(zip_file):  # zip_file is in self.tmp_path
-                self.make_clean(zip_file)  # delete .o and .exe files
-                self.move_hw(zip_file)  # bring from self.tmp_path to self.root
-                self.hw_add_trigger.emit(zip_file[:-4])  # signal the added hw
+        with tracing.span("ingest", zips=len(self.files),
+                          workers=self.workers) as span:
+            self.load_manifest()
+            with tracing.span("reuse"):
+                files = [f for f in self.files if not self.reuse_hw(f)]
+            span.set(extracted=len(files))
+            if self.workers > 1 and len(files) > 1:
+                self.run_parallel(files)
+            else:
+                for zip_file in files:
+                    ingest = ZipIngest(self.root, zip_file, self.hw_re,
+                                       self.tmp_path, self.log_trigger.emit,
+                                       self.max_member_size,
+                                       self.max_archive_size, self.max_ratio)
+                    if ingest.run():
+                        self.manifest[zip_file] = ingest.signature
+                        self.hw_added(zip_file, ingest.index)
+            self.save_manifest()
+
+    def run_parallel(self, files):
+        """ Every zip file gets its own folder inside tmp_path, so that they
+            do not step on each other. The log of each zip file is sent in
+            one go once it is finished. The workers are spawned, forking this
+            process (Qt and its threads) can deadlock them."""
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context(
+                                     "spawn")) as pool:
+            futures = {pool.submit(ingest_zip, self.root, zip_file, self.hw_re,
+                                   os.path.join(self.tmp_path, zip_file[:-4]),
+                                   self.max_member_size, self.max_archive_size,
+                                   self.max_ratio, self.fingerprint,
+                                   self.known_signatures.get(zip_file[:-4])):
+                       zip_file for zip_file in files}
+            for future in as_completed(futures):
+                zip_file = futures[future]
+                try:
+                    signature, index, entry, messages, spans = \
+                        future.result()
+                except Exception as e:  # worker crashed, report and go on
+                    self.log_trigger.emit("{}: Failed: {}".format(zip_file, e))
+                    continue
+                tracing.merge(spans)
+                for msg in messages:
+                    self.log_trigger.emit(msg)
+                if signature is not None:
+                    self.manifest[zip_file] = signature
+                    self.hw_added(zip_file, index, entry)
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def reuse_hw(self, zip_file):
+        """ Returns True if zip_file is the same as the last time it was
+            processed and its folder is still there. The hash is only
+            computed if size matches but mtime does not."""
+        entry = self.manifest.get(zip_file)
+        if not self.incremental or entry is None:
+            return False
+        if not os.path.isdir(os.path.join(self.root, zip_file[:-4])):
+            return False  # folder deleted by user, extract again
+        zip_path = os.path.join(self.root, zip_file)
+        try:
+            st = os.stat(zip_path)
+        except OSError:
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns != entry["mtime"]:  # touched, maybe not changed
+            if file_hash(zip_path) != entry["hash"]:
+                return False
+            entry["mtime"] = st.st_mtime_ns
+        self.log_trigger.emit("{}: Not changed, skipped".format(zip_file))
+        self.hw_added(zip_file, DirIndex.build(
+            os.path.join(self.root, zip_file[:-4])))
+        return True
+
+    def hw_added(self, zip_file, index, entry=None):
+        """ Sends the DirIndex and the fingerprints, computed here if they
+            did not come from a worker. The manifest is only used in this
+            thread, the hash is sent with the index."""
+        hw_folder = zip_file[:-4]
+        self.hw_add_trigger.emit(hw_folder, index,
+                                 self.manifest[zip_file]["hash"])
+        if self.fingerprint is None:
+            return
+        if entry is None:
+            from similarity import student_entry
+            entry = student_entry(index, *self.fingerprint,
+                                  known=self.known_signatures.get(hw_folder))
+        self.fingerprints_trigger.emit(hw_folder, entry)
+
+    def load_manifest(self):
+        self.manifest = {}
+        if not self.incremental or not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):  # broken manifest, start over
+            self.log_trigger.emit("Manifest can not be read, ignored.")
+
+    def save_manifest(self):
+        if not self.incremental:
+            return
+        tmp_manifest = self.manifest_path + ".tmp"
+        with open(tmp_manifest, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_manifest, self.manifest_path)  # never half written
+
+
+def ingest_zip(root, zip_file, hw_re, tmp_path, max_member_size,
+               max_archive_size, max_ratio=MAX_RATIO, fingerprint=None,
+               known_signature=None):
+    """ Runs in the worker processes of ZipHandle. Qt signals can not be
+        emitted here, so the messages are returned together with the
+        signature of the zip file (None if it failed), the DirIndex, the
+        similarity.student_entry if fingerprint is (k, window) and the spans
+        if tracing is on."""
+    messages = []
+    ingest = ZipIngest(root, zip_file, hw_re, tmp_path, messages.append,
+                       max_member_size, max_archive_size, max_ratio)
+    if ingest.run():
+        entry = None
+        if fingerprint is not None:
+            from similarity import student_entry
+            entry = student_entry(ingest.index, *fingerprint,
+                                  known=known_signature)
+        return ingest.signature, ingest.index, entry, messages, \
+            tracing.collect()
+    return None, None, None, messages, tracing.collect()
+
+
+def file_hash(path):
+    """ sha1 of the file contents, read in chunks """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def is_junk(parts):
+    """ parts is the path of a member of the zip split by /. The junk files
+        are not extracted at all: .o, .exe, ~ and #...# files and everything
+        in the __MACOSX folder."""
+    if "__MACOSX" in parts:
+        return True
+    f = parts[-1].lower()
+    return (f.endswith(".o") or f.endswith(".exe") or f.endswith("~") or
+            (f.startswith("#") and f.endswith("#")))
+
+
+class ZipIngest:
+    """ Does all the work on a single zip file: validation, extraction to
+    tmp_path, correction of the folder structure and finally moving it to
+    root. tmp_path is only used by this zip file. log is called with every
+    message that should be shown in the console. The DirIndex of the hw
+    folder is built at the end."""
+
+    def __init__(self, root, zip_file, hw_re, tmp_path, log,
+                 max_member_size=MAX_MEMBER_SIZE,
+                 max_archive_size=MAX_ARCHIVE_SIZE, max_ratio=MAX_RATIO):
+        self.root = root
+        self.zip_file = zip_file
+        self.hw_re = hw_re
+        self.tmp_path = tmp_path
+        self._log = log
+        self.max_member_size = max_member_size
+        self.max_archive_size = max_archive_size
+        self.max_ratio = max_ratio
+        self.signature = None  # size, mtime and hash, filled if successful
+        self.index = None  # DirIndex of the hw folder, filled if successful
+
+    def run(self):
+        zip_file = self.zip_file
+        student = zip_file[:-4]
+        with tracing.span("zip", student=student) as span:
+            ok = self._run(zip_file, student)
+            span.set(ok=ok)
+        return ok
+
+    def _run(self, zip_file, student):
+        # Check if we have a valid zip file
+        if self.zip_is_valid(zip_file) is False:  # zip is not valid
+            return False  # ignore this file, error is reported in zip_is_valid
+        zip_path = os.path.join(self.root, zip_file)
+        st = os.stat(zip_path)  # taken before extracting, changes are caught
+        with tracing.span("hash", student=student, size=st.st_size):
+            self.signature = {"size": st.st_size, "mtime": st.st_mtime_ns,
+                              "hash": file_hash(zip_path)}
+        # extract the zip contents to tmp_path, junk files are dropped
+        with tracing.span("extract", student=student):
+            extracted = self.zip_extract(zip_file)
+        if extracted and self.update_structure(zip_file):
+            # update_structure fixed the folder of zip_file in self.tmp_path
+            with tracing.span("move", student=student):
+                self.move_hw(zip_file)  # bring from tmp_path to self.root
+            with tracing.span("index", student=student):
+                self.index = DirIndex.build(os.path.join(self.root, student))
+            return True
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.signature = None
+        return False
 
     def update_structure(self, zip_file):
         """ discover contents and retrieve files and folders, also
@@ -51,14 +277,6 @@ class ZipHandle(QtCore.QThread):
                 zip filename is already checked and is correct. """
             self.rename_if_wrong(zip_file, hw_dirs[0])
 
-        elif len(hw_dirs) == 2 and "__MACOSX" in hw_dirs and len(hw_files) == 0:
-            # 2 root folders, the extra one is coming from MAC somehow
-            shutil.rmtree(os.path.join(self.tmp_path, "__MACOSX"),
-                          ignore_errors=True)
-            hw_dirs.remove("__MACOSX")
-            self.log(zip_file, "__MACOSX folder deleted.")
-            self.rename_if_wrong(zip_file, hw_ls[0])  # might be badly named
-
         # The hw files and folders have no root folder, create one and move stuff
         else:
             path = os.path.join(self.tmp_path, zip_file[:-4])
@@ -84,24 +302,6 @@ class ZipHandle(QtCore.QThread):
         assert len(os.listdir(self.tmp_path)) == 1
         return True
 
-    def make_clean(self, zip_file):
-        """ This function cleans the .o and .exe files, also removes spaces """
-        path = os.path.join(self.tmp_path, os.listdir(self.tmp_path)[0])
-        for root, _, file_names in os.walk(path):
-            for file_name in file_names:
-                f = file_name.lower()
-                if f.endswith(".o"):
-                    os.remove(os.path.join(root, file_name))
-                elif f.endswith(".exe"):
-                    os.remove(os.path.join(root, file_name))
-                elif f.endswith("~"):
-                    os.remove(os.path.join(root, file_name))
-                elif f.endswith("#") and file_name.startswith("#"):
-                    os.remove(os.path.join(root, file_name))
-                elif ' ' in f:  # replace space with underline
-                    os.rename(os.path.join(root, file_name),
-                              os.path.join(root, file_name.replace(' ', '_')))
-
     def move_hw(self, zip_file):
         """ Move HW from tmp_path to root folder """
         hw_folder = os.listdir(self.tmp_path)[0]  # There is 1 folder only
@@ -125,14 +325,74 @@ class ZipHandle(QtCore.QThread):
             pass
 
     def zip_extract(self, zip_file):
+        """ Extracts the members one by one. Junk files are skipped, spaces in
+            file names are replaced with underline and the size limits are
+            checked. Returns False if the zip should be ignored."""
         # create a temp folder to store the zip contents
         if os.path.exists(self.tmp_path):  # from previous zip file
             shutil.rmtree(self.tmp_path, ignore_errors=True)
-        os.mkdir(self.tmp_path)
+        os.makedirs(self.tmp_path)
         zip_path = os.path.join(self.root, zip_file)
+        total_size = 0  # bytes written to the disk for this zip
+        n_junk = 0
         with zipfile.ZipFile(zip_path, 'r') as f:
-            f.extractall(self.tmp_path)
-            self.log_trigger.emit("{}: Extracting...".format(zip_file))
+            self.log(zip_file, "Extracting...")
+            for info in f.infolist():
+                parts = [p for p in info.filename.replace('\\', '/').split('/')
+                         if p not in ('', '.')]
+                if len(parts) == 0:
+                    continue
+                elif ".." in parts or info.filename.startswith('/'):
+                    self.log(zip_file, "{}: outside the folder, ignored".
+                             format(info.filename))
+                    continue
+                elif is_junk(parts):
+                    n_junk += 1
+                    continue
+                elif info.is_dir():
+                    os.makedirs(os.path.join(self.tmp_path, *parts),
+                                exist_ok=True)
+                    continue
+                parts[-1] = parts[-1].replace(' ', '_')  # no spaces in files
+                if info.file_size > self.max_member_size:
+                    self.log(zip_file, "{}: too large ({} MB), ignored".format(
+                        info.filename, info.file_size >> 20))
+                    continue
+                elif info.file_size > \
+                        self.max_ratio * max(info.compress_size, 1):
+                    self.log(zip_file, "{}: zip bomb, ignored".format(
+                        info.filename))
+                    continue
+                elif total_size + info.file_size > self.max_archive_size:
+                    self.log(zip_file, "Contents larger than {} MB, ignored".
+                             format(self.max_archive_size >> 20))
+                    return False
+                size = self.extract_member(f, info, parts)
+                if size is None:  # header lies about the size
+                    self.log(zip_file, "{}: larger than reported, ignored".
+                             format(info.filename))
+                    continue
+                total_size += size
+        if n_junk > 0:
+            self.log(zip_file, "{} junk files skipped.".format(n_junk))
+        return True
+
+    def extract_member(self, zip_f, info, parts):
+        """ Copies a member of the zip to tmp_path/parts. At most file_size
+            bytes are written, returns None if there is more."""
+        path = os.path.join(self.tmp_path, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = 0
+        with zip_f.open(info) as src, open(path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1 << 16), b''):
+                size += len(chunk)
+                if size > info.file_size:
+                    break
+                dst.write(chunk)
+        if size > info.file_size:
+            os.remove(path)
+            return None
+        return size
 
     def zip_is_valid(self, zip_file):
         zip_path = os.path.join(self.root, zip_file)
@@ -145,4 +405,4 @@ class ZipHandle(QtCore.QThread):
         return True
 
     def log(self, zip_file, msg):
-        self.log_trigger.emit("{}: {}".format(zip_file, msg))
+        self._log("{}: {}".format(zip_file, msg))